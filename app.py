@@ -1,18 +1,233 @@
-from flask import Flask, render_template, request, Response
-from flask.json import jsonify
+import click
+from concurrent.futures import TimeoutError as CommitTimeout
+from flask import Flask, abort, render_template, request, Response
 import json
 import sqlite3
 import time
-from statistics import median, quantiles, mode
 
-from utils import validate_type_field, validate_value_field, build_sql_from_get, handle_database_connection
+from approximate import approximate_fleet_histogram, approximate_histograms, approximate_summaries, error_bound
+from batch import parse_batch_query, query_devices
+from cache import cached_response, get_cache
+from columnar import get_column_store
+from db import get_database_path, get_pool, get_pools, get_shard_paths, scatter
+from frames import FRAME_MIMETYPE, FrameError, decode_frame
+from histogram import METRICS, Histogram, histogram_metrics
+from ingest import INSERT_READING_SQL, IngestQueueFull, get_writer, get_writers
+from ingest_log import replay_logs
+from latest import load_latest, rebuild_latest, silent_devices
+from metrics import get_metrics, instrument, jsonify, slow_request_profiles
+from partitions import archive_partitions, drop_partitions
+from readings import merged_readings, parse_cursor, query_page, reading_payload, stream_readings
+from replicas import get_read_pool, get_read_pools, refresh_replicas, run_refresher
+from rollups import fleet_histogram, range_histogram, range_totals, rebuild_rollups
+from schema import migrate, roll_up
+from series import date_range, query_series, series_layout, series_payload
+from shards import reshard, shard_paths
+from summaries import gather_summaries, load_summaries, query_summaries, rebuild_summaries
+from utils import validate_reading, handle_database_connection, parse_bool_parameter, \
+    parse_int_parameter, parse_query_filters, QueryFilters
 
 app = Flask(__name__)
+app.config.from_mapping(
+    # Inserts from concurrent requests are committed together once this many
+    # seconds have passed or this many rows are waiting
+    GROUP_COMMIT_WINDOW=0.005,
+    GROUP_COMMIT_MAX_ROWS=1000,
+    # Answer POSTs with a 202 as soon as their readings are validated and
+    # queued instead of waiting for the commit
+    INGEST_ASYNC=False,
+    # POSTs get a 503 with this Retry-After (seconds) while this many rows
+    # are waiting to be committed
+    INGEST_MAX_PENDING_ROWS=100000,
+    INGEST_RETRY_AFTER=1,
+    # Synchronous POSTs give up waiting for their commit after this many
+    # seconds and answer with a 503
+    INGEST_COMMIT_TIMEOUT=30.0,
+    # Append POSTed readings to a local log before acknowledging them, which
+    # makes INGEST_ASYNC safe against crashes: 'off', or how long a POST
+    # waits for its readings to be on disk, 'request' (an fsync each),
+    # 'group' (fsyncs shared within INGEST_LOG_FSYNC_WINDOW seconds or
+    # INGEST_LOG_FSYNC_BYTES) or 'async' (not at all), see ingest_log.py
+    INGEST_LOG_DURABILITY='off',
+    INGEST_LOG_FSYNC_WINDOW=0.002,
+    INGEST_LOG_FSYNC_BYTES=1048576,
+    # Long lived connections handed out by handle_database_connection
+    DATABASE_POOL_SIZE=8,
+    DATABASE_POOL_TIMEOUT=30.0,
+    DATABASE_CACHE_SIZE_KIB=16384,
+    DATABASE_MMAP_SIZE=268435456,
+    DATABASE_CACHED_STATEMENTS=256,
+    # Devices are spread over this many SQLite files by a hash of their uuid,
+    # change it with `flask reshard`
+    DATABASE_SHARDS=1,
+    # Width of the time windows readings are archived and dropped in, a
+    # whole number of days
+    PARTITION_SECONDS=604800,
+    # Answer the summaries and batch query endpoints from read-only
+    # snapshots of the shards (database.replica.db), refreshed every
+    # REPLICA_REFRESH_SECONDS by `flask refresh-replicas --every` or serve.py
+    READ_REPLICAS=False,
+    REPLICA_REFRESH_SECONDS=30,
+    # Replicas are copied this many pages at a time with a pause of
+    # REPLICA_BACKUP_SLEEP seconds between steps; a copy restarted by
+    # inserts more than REPLICA_BACKUP_RESTARTS times finishes in one step
+    REPLICA_BACKUP_PAGES=1024,
+    REPLICA_BACKUP_SLEEP=0.005,
+    REPLICA_BACKUP_RESTARTS=3,
+    # Most of its time the refresher may spend copying, which stretches the
+    # interval between refreshes for big shards
+    REPLICA_REFRESH_DUTY=0.1,
+    # Engine behind the metric and stats endpoints: 'sql' (rollups and
+    # GROUP BY in SQLite) or 'columnar' (memory-mapped NumPy columns, needs
+    # numpy), and how many devices' columns the columnar one keeps open
+    ANALYTIC_ENGINE='sql',
+    COLUMN_STORE_MAX_DEVICES=1024,
+    # With approx=true, metric, summary and fleet quantile answers read a
+    # single granularity of rollup buckets, the coarsest that still splits
+    # the range into this many buckets (see approximate.py)
+    APPROXIMATE_MIN_BUCKETS=24,
+    # Responses of the metric and summary endpoints kept in memory, dropped
+    # when an insert lands in their range or after RESPONSE_CACHE_TTL seconds
+    RESPONSE_CACHE_MAX_BYTES=16777216,
+    RESPONSE_CACHE_TTL=60.0,
+    # How often a background thread drops the cached responses that other
+    # processes' inserts made stale (0 to never)
+    RESPONSE_CACHE_SYNC_SECONDS=0.05,
+    # Per route latency histograms of every request for /metrics, and an
+    # opt-in sampling profiler (every PROFILER_INTERVAL seconds) whose
+    # stacks of requests slower than SLOW_REQUEST_SECONDS go to
+    # /stats/slow-requests/
+    METRICS_ENABLED=True,
+    SLOW_REQUEST_PROFILING=False,
+    SLOW_REQUEST_SECONDS=1.0,
+    PROFILER_INTERVAL=0.005,
+    # Most devices one POST /devices/readings/query/ may ask about
+    BATCH_QUERY_MAX_DEVICES=5000,
+    # Most readings on one page of GET /readings/?limit=
+    READINGS_PAGE_SIZE=10000,
+    # Most buckets a /readings/series/ response may hold
+    SERIES_MAX_POINTS=5000,
+)
+
+instrument(app)
+
+# Setup the SQLite DB, every shard of it, apply the readings a crashed
+# process acknowledged but did not commit and roll them up
+for database in get_shard_paths(app):
+    conn = sqlite3.connect(database)
+    migrate(conn)
+    replayed = replay_logs(conn, database, INSERT_READING_SQL)
+    if replayed:
+        app.logger.warning('Replayed %d readings from the ingest logs of %s', replayed, database)
+    # Along with anything written to the database while the app was down
+    with conn:
+        roll_up(conn)
+    conn.close()
+
+def store_readings(device_uuid, rows):
+    """
+    Hands validated rows to the group commit writer. With INGEST_ASYNC they
+    are only queued, and cached responses they affect are dropped once they
+    are committed; otherwise this blocks until they are committed. Either
+    way, with INGEST_LOG_DURABILITY they are in the ingest log first.
+    Raises IngestQueueFull if the writer is already holding too many rows,
+    and concurrent.futures.TimeoutError if they are not committed within
+    INGEST_COMMIT_TIMEOUT seconds
+    :param device_uuid: the device the readings belong to
+    :param rows: list of (device_uuid, type, value, date_created) tuples
+    :return: bool whether the rows are committed already
+    """
+    cache = get_cache(app)
+    writer = get_writer(app, device_uuid)
+    if not app.config['INGEST_ASYNC']:
+        writer.write(rows, app.config['INGEST_COMMIT_TIMEOUT'])
+        cache.invalidate(rows)
+        return True
+
+    def committed(future):
+        if future.exception() is not None:
+            app.logger.error('Failed to store %d queued readings: %s', len(rows), future.exception())
+            return
+        cache.invalidate(rows)
+
+    writer.submit(rows).add_done_callback(committed)
+    return False
+
+def store_batch(device_uuid, rows, errors):
+    """
+    Stores the valid rows of a posted batch and reports the invalid ones
+    :param device_uuid: the device the readings belong to
+    :param rows: list of (device_uuid, type, value, date_created) tuples
+    :param errors: list of {'index', 'errors'} of the rejected readings
+    :return: response
+    """
+    try:
+        committed = store_readings(device_uuid, rows) if rows else True
+    except IngestQueueFull:
+        return ingest_queue_full()
+    except CommitTimeout:
+        return ingest_timed_out()
+
+    if not errors:
+        status = 201 if committed else 202
+    elif rows:
+        status = 207
+    else:
+        status = 400
+    return jsonify({'inserted' if committed else 'accepted': len(rows), 'errors': errors}), status
+
+def metric_histogram(conn, device_uuid, filters, approximate=False):
+    """
+    Histogram of a device's readings matching the filters, from the engine
+    picked by ANALYTIC_ENGINE, or approximated from rollup buckets
+    :return: (Histogram, error bound of an approximate histogram or None)
+    """
+    if approximate:
+        histogram, edge_readings = approximate_histograms(conn, [device_uuid], filters,
+                                                          app.config['APPROXIMATE_MIN_BUCKETS'])[device_uuid]
+        return histogram, error_bound(histogram.count, edge_readings)
+    if app.config['ANALYTIC_ENGINE'] == 'columnar':
+        return get_column_store(app, device_uuid).histogram(conn, device_uuid, filters), None
+    return range_histogram(conn, device_uuid, filters), None
+
+def metric_totals(conn, device_uuid, filters, approximate=False):
+    """
+    Count, sum, max and min of a device's readings matching the filters,
+    from the engine picked by ANALYTIC_ENGINE, or approximated from rollup
+    buckets
+    :return: ((count, sum, max, min), error bound of approximate totals or None)
+    """
+    if approximate:
+        histogram, error = metric_histogram(conn, device_uuid, filters, approximate)
+        return (histogram.count, histogram.total, histogram.max, histogram.min), error
+    if app.config['ANALYTIC_ENGINE'] == 'columnar':
+        return get_column_store(app, device_uuid).totals(conn, device_uuid, filters), None
+    return range_totals(conn, device_uuid, filters), None
+
+def with_error(payload, error):
+    """
+    Adds the error bound of an approximate answer to its payload
+    :param payload: dict
+    :param error: error bound, None for exact answers
+    :return: dict
+    """
+    if error is not None:
+        payload['error'] = error
+    return payload
 
-# Setup the SQLite DB
-conn = sqlite3.connect('database.db')
-conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
-conn.close()
+def ingest_queue_full():
+    """
+    Response telling a client to send its readings again later
+    """
+    return 'Too many readings are waiting to be stored, retry later', 503, \
+        {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
+
+def ingest_timed_out():
+    """
+    Response telling a client its readings were not committed in time
+    """
+    return 'The readings were not committed in time, they may still be stored', 503, \
+        {'Retry-After': str(app.config['INGEST_RETRY_AFTER'])}
 
 @app.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'])
 @handle_database_connection(app)
@@ -20,7 +235,12 @@ def request_device_readings(device_uuid, conn):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
 
-    POST Parameters:
+    POST Parameters (a single object, a JSON array of objects, an
+    application/x-ndjson body with one object per line or an
+    application/x-readings-frame body of packed records, see frames.py). With INGEST_ASYNC
+    readings are acknowledged with a 202 once queued (and with
+    INGEST_LOG_DURABILITY, once logged), and a full queue is answered with
+    a 503 and a Retry-After header:
     * type -> The type of sensor (temperature or humidity)
     * value -> The integer value of the sensor reading
     * date_created -> The epoch date of the sensor reading.
@@ -30,48 +250,162 @@ def request_device_readings(device_uuid, conn):
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> Page through the readings in date order, this many at a time.
+        The X-Next-Cursor header of a page is missing on the last one.
+    * cursor -> The X-Next-Cursor header of the previous page
+    * stream -> Stream the readings in date order as a JSON array (json)
+        or one object per line (ndjson) instead of building the response in memory
     """
-    cur = conn.cursor()
-
     if request.method == 'POST':
-        # Grab the post parameters
-        post_data = json.loads(request.data)
-        sensor_type = post_data.get('type')
-        value = post_data.get('value')
-        date_created = post_data.get('date_created', int(time.time()))
+        # Binary frames are validated and decoded a batch at a time
+        if request.mimetype == FRAME_MIMETYPE:
+            try:
+                rows, errors = decode_frame(device_uuid, request.get_data())
+            except FrameError as error:
+                return str(error), 400
+            return store_batch(device_uuid, rows, errors)
+
+        # Grab the post parameters, either a single reading, a JSON array or NDJSON
+        malformed = {}
+        if request.mimetype == 'application/x-ndjson':
+            post_data = []
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    post_data.append(json.loads(line))
+                except ValueError as error:
+                    # Reported along with the invalid readings instead of failing the whole batch
+                    malformed[len(post_data)] = f'Line is not valid JSON: {error}'
+                    post_data.append(None)
+        else:
+            try:
+                post_data = json.loads(request.data)
+            except ValueError as error:
+                return f'The body is not valid JSON: {error}', 400
+
+        if not isinstance(post_data, list):
+            # validate data
+            valid, result = validate_reading(device_uuid, post_data)
+            if not valid:
+                return '\n'.join(result), 400
+
+            # Insert data into db
+            try:
+                committed = store_readings(device_uuid, [result])
+            except IngestQueueFull:
+                return ingest_queue_full()
+            except CommitTimeout:
+                return ingest_timed_out()
+
+            # Return success
+            return ('success', 201) if committed else ('accepted', 202)
+
+        # Validate every reading, keeping the good ones and reporting the rest by index
+        rows = []
+        errors = []
+        for index, reading in enumerate(post_data):
+            if index in malformed:
+                errors.append({'index': index, 'errors': [malformed[index]]})
+                continue
+            valid, result = validate_reading(device_uuid, reading)
+            if valid:
+                rows.append(result)
+            else:
+                errors.append({'index': index, 'errors': result})
+        return store_batch(device_uuid, rows, errors)
+    else:
+        limit = parse_int_parameter(request, 'limit')
+        after = parse_cursor(request)
+        stream = request.values.get('stream', None)
+        if stream not in (None, 'json', 'ndjson'):
+            abort(400, "'stream' must be 'json' or 'ndjson'")
+
+        if stream:
+            generator = stream_readings(get_pool(app, device_uuid), device_uuid, parse_query_filters(request), after, limit,
+                                        ndjson=stream == 'ndjson')
+            mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+            return Response(generator, mimetype=mimetype), 200
+
+        if limit is not None or after is not None:
+            limit = min(limit or app.config['READINGS_PAGE_SIZE'], app.config['READINGS_PAGE_SIZE'])
+            page, next_cursor = query_page(conn, device_uuid, parse_query_filters(request), limit, after)
+            response = jsonify(page)
+            if next_cursor is not None:
+                response.headers['X-Next-Cursor'] = next_cursor
+            return response, 200
+
+        rows = merged_readings(conn, device_uuid, parse_query_filters(request))
 
-        # validate data
-        validations = {
-            'sensor_type': validate_type_field(sensor_type),
-            'value': validate_value_field(value)
-        }
+        # Return the JSON
+        return jsonify([reading_payload(row) for row in rows]), 200
 
-        errors = [x for x in validations.values() if not x[0]]
-        if errors:
-            return '\n'.join(x[1] for x in errors), 400
+@app.route('/devices/<string:device_uuid>/readings/series/', methods = ['GET'])
+@handle_database_connection(app)
+def request_device_readings_series(device_uuid, conn):
+    """
+    This endpoint allows clients to GET a device's readings downsampled into
+    fixed width buckets, each with the count, max, min and mean of its readings.
+    Buckets without readings are left out.
 
-        sensor_type = validations.get('sensor_type', sensor_type)[1]
-        value = validations.get('value', value)[1]
+    Mandatory Query Parameters (exactly one of):
+    * bucket -> The width of a bucket in seconds
+    * points -> The most buckets to return, spread evenly over start/end
 
-        # Insert data into db
-        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (device_uuid, sensor_type, value, date_created))
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    """
+    bucket = parse_int_parameter(request, 'bucket')
+    points = parse_int_parameter(request, 'points')
+    if (bucket is None) == (points is None):
+        abort(400, "Exactly one of 'bucket' and 'points' must be given")
+    if points is not None and points > app.config['SERIES_MAX_POINTS']:
+        abort(400, f"'points' can be at most {app.config['SERIES_MAX_POINTS']}")
+
+    filters = parse_query_filters(request)
+    start, end = date_range(conn, device_uuid, filters)
+    if start is None or start > end:
+        return jsonify(series_payload(None, bucket, [])), 200
+
+    origin, width = series_layout(start, end, bucket, points)
+    if (end - origin) // width + 1 > app.config['SERIES_MAX_POINTS']:
+        abort(400, f"The range holds more than {app.config['SERIES_MAX_POINTS']} buckets, use a wider 'bucket'")
+
+    rows = query_series(conn, device_uuid, QueryFilters(start, end, filters.sensor_type), origin, width)
+    return jsonify(series_payload(origin, width, rows)), 200
+
+@app.route('/devices/<string:device_uuid>/readings/stats/', methods = ['GET'])
+@cached_response(app)
+@handle_database_connection(app)
+def request_device_readings_stats(device_uuid, conn):
+    """
+    This endpoint allows clients to GET several metrics of a device's
+    readings at once, all computed from a single histogram query.
 
-        conn.commit()
+    Optional Query Parameters
+    * metrics -> Comma separated metrics out of count, max, min, mean,
+        median, mode, q1 and q3. Defaults to all of them.
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
+    """
+    metrics = request.values.get('metrics', None)
+    metrics = [m.strip() for m in metrics.split(',') if m.strip()] if metrics else METRICS
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        abort(400, f"Unknown metrics {', '.join(unknown)}, the allowed metrics are {', '.join(METRICS)}")
 
-        # Return success
-        return 'success', 201
-    else:
-        selection = f'select * from readings where device_uuid="{device_uuid}" '
-        sql = build_sql_from_get(request, selection)
-        print(sql)
-        cur.execute(sql)
-        rows = cur.fetchall()
+    histogram, error = metric_histogram(conn, device_uuid, parse_query_filters(request),
+                                        parse_bool_parameter(request, 'approx'))
 
-        # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
+    return jsonify(with_error(histogram_metrics(histogram, metrics), error)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/max/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_max(device_uuid, conn):
     """
@@ -83,17 +417,16 @@ def request_device_readings_max(device_uuid, conn):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
-
-    selection = f'select MAX(value) from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    row = cur.fetchone()
+    totals, error = metric_totals(conn, device_uuid, parse_query_filters(request),
+                                  parse_bool_parameter(request, 'approx'))
 
-    return jsonify(dict(zip(['value'], row))), 200
+    return jsonify(with_error({'value': totals[2]}, error)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_min(device_uuid, conn):
     """
@@ -105,17 +438,16 @@ def request_device_readings_min(device_uuid, conn):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
+    totals, error = metric_totals(conn, device_uuid, parse_query_filters(request),
+                                  parse_bool_parameter(request, 'approx'))
 
-    selection = f'select MIN(value) from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    row = cur.fetchone()
-
-    return jsonify(dict(zip(['value'], row))), 200
+    return jsonify(with_error({'value': totals[3]}, error)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/mode/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_mode(device_uuid, conn):
     """
@@ -127,18 +459,17 @@ def request_device_readings_mode(device_uuid, conn):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
-
-    selection = f'select value from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    rows = cur.fetchall()
-    mode_value = mode([x['value'] for x in rows]) if rows else None
+    histogram, error = metric_histogram(conn, device_uuid, parse_query_filters(request),
+                                        parse_bool_parameter(request, 'approx'))
+    mode_value = histogram.mode() if histogram.count else None
 
-    return jsonify({'value': mode_value}), 200
+    return jsonify(with_error({'value': mode_value}, error)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/median/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_median(device_uuid, conn):
     """
@@ -150,18 +481,17 @@ def request_device_readings_median(device_uuid, conn):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
-
-    selection = f'select value from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    rows = cur.fetchall()
-    median_value = int(median([x['value'] for x in rows])) if rows else None
+    histogram, error = metric_histogram(conn, device_uuid, parse_query_filters(request),
+                                        parse_bool_parameter(request, 'approx'))
+    median_value = int(histogram.median()) if histogram.count else None
 
-    return jsonify({'value': median_value}), 200
+    return jsonify(with_error({'value': median_value}, error)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/mean/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_mean(device_uuid, conn):
     """
@@ -173,18 +503,30 @@ def request_device_readings_mean(device_uuid, conn):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
+    (count, total, _, _), error = metric_totals(conn, device_uuid, parse_query_filters(request),
+                                                parse_bool_parameter(request, 'approx'))
+    mean_value = int(total / count) if total else None
 
-    selection = f'select AVG(value) from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    row = cur.fetchone()
-    mean_value = int(row[0]) if row[0] else None
+    return jsonify(with_error({'value': mean_value}, error)), 200
 
-    return jsonify({'value': mean_value}), 200
+@app.route('/devices/<string:device_uuid>/readings/latest/', methods = ['GET'])
+@cached_response(app)
+@handle_database_connection(app)
+def request_device_readings_latest(device_uuid, conn):
+    """
+    This endpoint allows clients to GET the newest reading of each sensor
+    type of a device, by date_created, and when the device last reported.
+
+    Optional Query Parameters
+    * type -> The type of sensor value a client is looking for
+    """
+    return jsonify(load_latest(conn, device_uuid, parse_query_filters(request).sensor_type)), 200
 
 @app.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
+@cached_response(app)
 @handle_database_connection(app)
 def request_device_readings_quartiles(device_uuid, conn):
     """
@@ -195,63 +537,284 @@ def request_device_readings_quartiles(device_uuid, conn):
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
-    """
-    cur = conn.cursor()
 
-    selection = f'select value from readings where device_uuid="{device_uuid}" '
-    sql = build_sql_from_get(request, selection)
-    cur.execute(sql)
-    rows = cur.fetchall()
-    quartiles = [int(q) for q in quantiles(([x['value'] for x in rows]))] if len(rows) >= 2 else [None] * 3
+    Optional Query Parameters
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
+    """
+    histogram, error = metric_histogram(conn, device_uuid, parse_query_filters(request),
+                                        parse_bool_parameter(request, 'approx'))
+    quartiles = [int(q) for q in histogram.quantiles()] if histogram.count >= 2 else [None] * 3
     quartile_dict = {
         'quartile_1': quartiles[0],
         'quartile_3': quartiles[2]
     }
 
 
-    return jsonify(quartile_dict), 200
+    return jsonify(with_error(quartile_dict, error)), 200
 
 @app.route('/devices/summaries/', methods = ['GET'])
-@handle_database_connection(app)
-def request_readings_summary(conn):
+@cached_response(app, read_replicas=True)
+def request_readings_summary():
     """
     This endpoint allows clients to GET a full summary
-    of all sensor data in the database per device.
+    of all sensor data in the database per device, the devices
+    with the most readings first. Every shard is summarized in
+    parallel, from its replica with READ_REPLICAS, and the results merged.
 
     Optional Query Parameters
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * limit -> Only summarize this many devices
+    * offset -> Skip this many devices first
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
     """
-    cur = conn.cursor()
-
-    selection = f'select * from readings WHERE 1=1 '
-    sql = build_sql_from_get(request, selection)
-    sql += 'ORDER BY device_uuid '
-    cur.execute(sql)
-    rows = cur.fetchall()
-    devices = {}
-    for row in rows:
-        if row['device_uuid'] in devices:
-            devices[row['device_uuid']].append(row['value'])
-        else:
-            devices[row['device_uuid']] = [row['value']]
-    payload = []
-    for k, v in devices.items():
-        quartiles = [int(q) for q in quantiles(v)] if len(v) >= 2 else [None] * 3
-        payload.append(
-            {
-                'device_uuid': k,
-                'number_of_readings': len(v),
-                'max_reading_value': max(v),
-                'median_reading_value': int(median(v)),
-                'mean_reading_value': sum(v) // len(v),
-                'quartile_1_value': quartiles[0],
-                'quartile_3_value': quartiles[2]
-            }
-        )
-
-    return jsonify(payload), 200
+    filters = parse_query_filters(request)
+    limit = parse_int_parameter(request, 'limit')
+    offset = parse_int_parameter(request, 'offset', minimum=0) or 0
+    approximate = parse_bool_parameter(request, 'approx')
+    def summarize(conn, limit, offset):
+        if filters.start is None and filters.end is None:
+            # Nothing to filter by date, so the aggregate tables have the answer
+            summaries = load_summaries(conn, filters.sensor_type, limit, offset)
+            if approximate:
+                for summary in summaries:
+                    summary['error'] = error_bound(summary['number_of_readings'], 0)
+            return summaries
+        if approximate:
+            return approximate_summaries(conn, filters, limit, offset, app.config['APPROXIMATE_MIN_BUCKETS'])
+        return query_summaries(conn, filters, limit, offset)
+
+    return jsonify(gather_summaries(get_read_pools(app), summarize, limit, offset)), 200
+
+@app.route('/devices/readings/quantiles/', methods = ['GET'])
+@cached_response(app, read_replicas=True)
+def request_fleet_quantiles():
+    """
+    This endpoint allows clients to GET percentiles of the readings of every
+    device together. The histograms of every shard are built in parallel,
+    from its replica with READ_REPLICAS, and merged.
+
+    Optional Query Parameters
+    * q -> Comma separated fractions between 0 and 1 to cut the readings
+        at. Defaults to 0.25,0.5,0.75,0.9,0.99
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * approx -> true for an approximate answer from whole rollup buckets,
+        with its error bound (see approximate.py)
+    """
+    cut_points = request.values.get('q', None) or '0.25,0.5,0.75,0.9,0.99'
+    try:
+        cut_points = [float(q) for q in cut_points.split(',') if q.strip()]
+    except ValueError:
+        abort(400, "'q' must be comma separated numbers")
+    if not cut_points or not all(0 < q < 1 for q in cut_points):
+        abort(400, "'q' must be between 0 and 1")
+    filters = parse_query_filters(request)
+    approximate = parse_bool_parameter(request, 'approx')
+
+    def histogram(conn):
+        if approximate:
+            return approximate_fleet_histogram(conn, filters, app.config['APPROXIMATE_MIN_BUCKETS'])
+        return fleet_histogram(conn, filters), 0
+
+    fleet = Histogram()
+    edge_readings = 0
+    for shard_histogram, shard_edge_readings in scatter(get_read_pools(app), histogram):
+        fleet.merge(shard_histogram)
+        edge_readings += shard_edge_readings
+    payload = {
+        'number_of_readings': fleet.count,
+        'quantiles': {str(q): int(fleet.quantile(q)) if fleet.count >= 2 else None for q in cut_points}
+    }
+
+    return jsonify(with_error(payload, error_bound(fleet.count, edge_readings) if approximate else None)), 200
+
+@app.route('/devices/silent/', methods = ['GET'])
+def request_silent_devices():
+    """
+    This endpoint allows clients to GET the devices whose newest reading is
+    older than `seconds` ago, the longest silent first.
+
+    Mandatory Query Parameters:
+    * seconds -> How long a device must have been silent
+
+    Optional Query Parameters
+    * type -> Only look at readings of this sensor type
+    """
+    seconds = parse_int_parameter(request, 'seconds', minimum=0)
+    if seconds is None:
+        abort(400, "'seconds' is required")
+    sensor_type = parse_query_filters(request).sensor_type
+    now = int(time.time())
+
+    def find_silent(conn):
+        return silent_devices(conn, now - seconds, sensor_type)
+
+    silent = [device for devices in scatter(get_pools(app), find_silent) for device in devices]
+    silent.sort(key=lambda device: (device[1], device[0]))
+
+    return jsonify([{'device_uuid': device_uuid, 'last_reported': last_reported, 'silent_for': now - last_reported}
+                    for device_uuid, last_reported in silent]), 200
+
+@app.route('/devices/readings/query/', methods = ['POST'])
+def request_devices_readings_query():
+    """
+    This endpoint allows clients to POST one query for metrics of many
+    devices, answered with a few grouped queries per shard instead of one
+    request per device, from the shards' replicas with READ_REPLICAS.
+    Devices without matching readings get a count of 0 and None for the
+    other metrics.
+
+    POST Parameters (a JSON object):
+    * devices -> List of device uuids, at most BATCH_QUERY_MAX_DEVICES
+    * metrics -> List of metrics out of count, max, min, mean, median,
+        mode, q1 and q3. Defaults to all of them.
+    * type -> The type of sensor value a client is looking for
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+
+    Returns an object keyed by device uuid
+    """
+    try:
+        body = json.loads(request.data)
+    except ValueError:
+        abort(400, 'The body must be JSON')
+    devices, metrics, filters = parse_batch_query(body, app.config['BATCH_QUERY_MAX_DEVICES'])
+
+    # Every shard answers for its own devices
+    devices_by_pool = {}
+    for device_uuid in devices:
+        devices_by_pool.setdefault(get_read_pool(app, device_uuid), []).append(device_uuid)
+    results = {}
+    for pool, pool_devices in devices_by_pool.items():
+        with pool.connection() as conn:
+            results.update(query_devices(conn, pool_devices, metrics, filters))
+
+    return jsonify({device_uuid: results[device_uuid] for device_uuid in devices}), 200
+
+@app.route('/stats/pool/', methods = ['GET'])
+def request_pool_stats():
+    """
+    This endpoint allows clients to GET usage counters for the
+    database connection pool of every shard (open, in use, waits and
+    time spent waiting).
+    """
+    return jsonify([pool.stats() for pool in get_pools(app)]), 200
+
+@app.route('/stats/ingest/', methods = ['GET'])
+def request_ingest_stats():
+    """
+    This endpoint allows clients to GET counters for the ingest writer of
+    every shard (rows waiting to be committed, commits, refused POSTs and
+    drain latency).
+    """
+    return jsonify([writer.stats() for writer in get_writers(app)]), 200
+
+@app.route('/stats/cache/', methods = ['GET'])
+def request_cache_stats():
+    """
+    This endpoint allows clients to GET usage counters for the response
+    cache (entries, bytes, hits, misses, evictions and invalidations).
+    """
+    return jsonify(get_cache(app).stats()), 200
+
+@app.route('/stats/slow-requests/', methods = ['GET'])
+def request_slow_request_stats():
+    """
+    This endpoint allows clients to GET the most common stacks of the most
+    recent requests slower than SLOW_REQUEST_SECONDS, sampled while
+    SLOW_REQUEST_PROFILING is on.
+    """
+    return jsonify(slow_request_profiles(app)), 200
+
+@app.route('/metrics', methods = ['GET'])
+def request_metrics():
+    """
+    This endpoint allows clients to GET per route request counts and
+    latency histograms, overall and per phase (connection acquisition, SQL
+    build, execute and fetch, aggregation and serialization), and rows
+    fetched per request, in the Prometheus text format.
+    """
+    return Response(get_metrics(app).render(), mimetype='text/plain; version=0.0.4'), 200
+
+@app.cli.command('rebuild-summaries')
+def rebuild_summaries_command():
+    """
+    Backfills the per device aggregate and latest reading tables from the
+    readings table and the archived partitions.
+    """
+    for database in get_shard_paths(app):
+        conn = sqlite3.connect(database)
+        migrate(conn)
+        rebuild_summaries(conn)
+        rebuild_latest(conn)
+        conn.close()
+
+@app.cli.command('refresh-replicas')
+@click.option('--every', type=float, default=None,
+              help='Keep refreshing them this many seconds apart instead of once')
+def refresh_replicas_command(every):
+    """
+    Replaces the read-only replica of every shard with a fresh snapshot.
+    """
+    if every is None:
+        refresh_replicas(app)
+    else:
+        run_refresher(app, every)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """
+    Backfills the minute, hour and day rollup tables from the readings table
+    and the archived partitions.
+    """
+    for database in get_shard_paths(app):
+        conn = sqlite3.connect(database)
+        migrate(conn)
+        rebuild_rollups(conn)
+        conn.close()
+
+@app.cli.command('archive-partitions')
+@click.option('--before', type=int, required=True, help='Epoch time no archived window may end after')
+def archive_partitions_command(before):
+    """
+    Moves the readings of every whole PARTITION_SECONDS window ending before
+    --before out of the readings table into compressed archive files.
+    """
+    for database in get_shard_paths(app):
+        conn = sqlite3.connect(database)
+        migrate(conn)
+        windows = archive_partitions(conn, database, before, app.config['PARTITION_SECONDS'])
+        conn.close()
+        click.echo(f'Archived {len(windows)} windows of {database}')
+
+@app.cli.command('drop-partitions')
+@click.option('--before', type=int, required=True, help='Epoch time no dropped window may end after')
+def drop_partitions_command(before):
+    """
+    Deletes every reading, archive and rollup of the whole PARTITION_SECONDS
+    windows ending before --before.
+    """
+    for database in get_shard_paths(app):
+        conn = sqlite3.connect(database)
+        migrate(conn)
+        cutoff = drop_partitions(conn, database, before, app.config['PARTITION_SECONDS'])
+        conn.close()
+        click.echo(f'Dropped everything before {cutoff} from {database}')
+
+@app.cli.command('reshard')
+@click.option('--from-shards', type=int, required=True, help='Number of shards the readings are in now')
+def reshard_command(from_shards):
+    """
+    Moves every device to its shard under DATABASE_SHARDS from where it was
+    with --from-shards shards. Run it with the app stopped.
+    """
+    moved = reshard(shard_paths(get_database_path(app), from_shards), get_shard_paths(app))
+    click.echo(f'Moved {moved} devices')
 
 if __name__ == '__main__':
     app.run()
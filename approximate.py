@@ -0,0 +1,191 @@
+"""
+Approximate answers with a known error bound, for wide ranges over many devices.
+
+Readings only hold integers in [0, 100], so the per value histograms kept
+in every rollup bucket already are exact sketches of their readings that
+merge by adding counters. What makes exact answers over a wide range
+expensive is time: the range edges have to be pieced together from
+finer buckets and raw readings. Approximate answers read a single
+granularity instead, every bucket overlapping [start, end] whole, the
+coarsest one that still splits the range into `min_buckets` buckets.
+
+Only the (at most two) buckets a range edge cuts through can hold readings
+outside the range, so the answer is computed from the right readings plus
+at most that many others. That count is returned as the error bound:
+every count is high by at most `readings`, and every quantile is the
+exact quantile of a set of readings at most a `rank` fraction of which are
+not in the range.
+"""
+from collections import namedtuple
+
+from histogram import Histogram
+from rollups import EVERY_DEVICE, ROLLUP_HISTOGRAM_SELECTION, device_chunks, in_devices
+from schema import ROLLUP_GRANULARITIES
+from summaries import rank_summaries, summaries_from_rows
+from utils import QueryFilters, build_sql
+
+EDGE_SELECTION = 'select device_uuid, SUM(readings_count) from readings_rollups where granularity = ? '
+
+# One granularity of rollup buckets covering a range: every bucket starting
+# in [first, last] (None when unbounded), of which the ones in `edges` also
+# hold readings outside the range
+Approximation = namedtuple('Approximation', 'granularity first last edges')
+
+
+def plan_approximation(start, end, min_buckets=24, granularities=ROLLUP_GRANULARITIES):
+    """
+    Picks the rollup buckets an approximate answer over [start, end] reads
+    :param start: first epoch second, or None
+    :param end: last epoch second, or None
+    :param min_buckets: fewest buckets a bounded range is split into
+    :param granularities: bucket widths to pick from, coarsest first
+    :return: Approximation
+    """
+    granularity = granularities[0]
+    if start is not None and end is not None:
+        for granularity in granularities:
+            if end - start + 1 >= granularity * min_buckets:
+                break
+
+    first = None if start is None else start - start % granularity
+    last = None if end is None else end - end % granularity
+    edges = []
+    if start is not None and start != first:
+        edges.append(first)
+    if end is not None and (end + 1) % granularity and last not in edges:
+        edges.append(last)
+    return Approximation(granularity, first, last, edges)
+
+
+def covered_filters(filters):
+    """
+    Widens filters to the readings an approximate answer may count, whole
+    buckets of the coarsest granularity, e.g. to know which inserts can
+    change it
+    :param filters: QueryFilters
+    :return: QueryFilters
+    """
+    granularity = ROLLUP_GRANULARITIES[0]
+    start = None if filters.start is None else filters.start - filters.start % granularity
+    end = None if filters.end is None else filters.end - filters.end % granularity + granularity - 1
+    return QueryFilters(start, end, filters.sensor_type)
+
+
+def error_bound(count, edge_readings):
+    """
+    Formats the error bound of an approximate answer
+    :param count: readings the answer was computed from
+    :param edge_readings: readings of the buckets cut by the range edges
+    :return: dict
+    """
+    return {'readings': edge_readings, 'rank': edge_readings / count if count else 0.0}
+
+
+def approximate_histograms(conn, device_uuids, filters, min_buckets=24):
+    """
+    Approximate histograms of several devices' readings matching the
+    filters, read from one granularity of rollup buckets
+    :param conn: sqlite3 connection
+    :param device_uuids: list of devices
+    :param filters: QueryFilters
+    :param min_buckets: fewest buckets a bounded range is split into
+    :return: dict of device_uuid to (Histogram, readings of its edge buckets)
+    """
+    if _empty(filters):
+        return {device_uuid: (Histogram(), 0) for device_uuid in device_uuids}
+    plan = plan_approximation(filters.start, filters.end, min_buckets)
+
+    histograms = {device_uuid: Histogram() for device_uuid in device_uuids}
+    edge_readings = dict.fromkeys(device_uuids, 0)
+    segment = QueryFilters(plan.first, plan.last, filters.sensor_type)
+    for devices in device_chunks(list(histograms)):
+        sql, params = build_sql(in_devices(ROLLUP_HISTOGRAM_SELECTION, devices), segment,
+                                [plan.granularity, *devices], date_column='bucket')
+        sql += 'GROUP BY device_uuid, value'
+        for device_uuid, value, count, first_seen in conn.execute(sql, params):
+            histograms[device_uuid].add(value, count, first_seen)
+        for device_uuid, count in _edge_readings(conn, devices, plan, filters.sensor_type):
+            edge_readings[device_uuid] += count
+    return {device_uuid: (histograms[device_uuid], edge_readings[device_uuid]) for device_uuid in histograms}
+
+
+def approximate_fleet_histogram(conn, filters, min_buckets=24):
+    """
+    Approximate histogram of the readings of every device matching the filters
+    :param conn: sqlite3 connection
+    :param filters: QueryFilters
+    :param min_buckets: fewest buckets a bounded range is split into
+    :return: (Histogram, readings of the edge buckets)
+    """
+    fleet = Histogram()
+    if _empty(filters):
+        return fleet, 0
+    plan = plan_approximation(filters.start, filters.end, min_buckets)
+    segment = QueryFilters(plan.first, plan.last, filters.sensor_type)
+    sql, params = build_sql('select value, SUM(readings_count), MIN(first_rowid) from readings_rollup_histograms '
+                            'where granularity = ? ' + EVERY_DEVICE, segment, [plan.granularity],
+                            date_column='bucket')
+    for value, count, first_seen in conn.execute(sql + 'GROUP BY value', params):
+        fleet.add(value, count, first_seen)
+
+    edge_readings = 0
+    if plan.edges:
+        sql, params = build_sql('select SUM(readings_count) from readings_rollups where granularity = ? ' +
+                                EVERY_DEVICE, QueryFilters(None, None, filters.sensor_type), [plan.granularity])
+        sql += f'AND bucket IN ({", ".join("?" * len(plan.edges))})'
+        edge_readings = conn.execute(sql, params + plan.edges).fetchone()[0] or 0
+    return fleet, edge_readings
+
+
+def approximate_summaries(conn, filters, limit=None, offset=0, min_buckets=24):
+    """
+    Like summaries.query_summaries from one granularity of rollup buckets,
+    each summary with the error bound of its device
+    :param conn: sqlite3 connection
+    :param filters: QueryFilters
+    :param limit: only summarize this many devices, the ones with the most readings
+    :param offset: skip this many devices with the most readings first
+    :param min_buckets: fewest buckets a bounded range is split into
+    :return: list of dicts ordered by number of readings, most first
+    """
+    if _empty(filters):
+        return []
+    plan = plan_approximation(filters.start, filters.end, min_buckets)
+    segment = QueryFilters(plan.first, plan.last, filters.sensor_type)
+    selection = 'select device_uuid, value, SUM(readings_count) from readings_rollup_histograms where granularity = ? '
+    params = [plan.granularity]
+    if limit is not None or offset:
+        ranked, ranked_params = build_sql('select device_uuid from readings_rollups where granularity = ? ', segment,
+                                          [plan.granularity], date_column='bucket')
+        ranked += 'GROUP BY device_uuid ORDER BY SUM(readings_count) DESC, device_uuid LIMIT ? OFFSET ?'
+        selection += f'AND device_uuid IN ({ranked}) '
+        params += ranked_params + [-1 if limit is None else limit, offset]
+    sql, params = build_sql(selection, segment, params, date_column='bucket')
+    sql += 'GROUP BY device_uuid, value ORDER BY device_uuid'
+    summaries = summaries_from_rows(conn.execute(sql, params))
+
+    edge_readings = dict(_edge_readings(conn, [summary['device_uuid'] for summary in summaries], plan,
+                                        filters.sensor_type))
+    for summary in summaries:
+        summary['error'] = error_bound(summary['number_of_readings'], edge_readings.get(summary['device_uuid'], 0))
+    return rank_summaries(summaries)
+
+
+def _empty(filters):
+    return filters.start is not None and filters.end is not None and filters.start > filters.end
+
+
+def _edge_readings(conn, device_uuids, plan, sensor_type):
+    """
+    Readings per device in the buckets the range edges cut through
+    :return: list of (device_uuid, count)
+    """
+    if not plan.edges or not device_uuids:
+        return []
+    counts = []
+    for devices in device_chunks(device_uuids):
+        sql, params = build_sql(in_devices(EDGE_SELECTION, devices), QueryFilters(None, None, sensor_type),
+                                [plan.granularity, *devices])
+        sql += f'AND bucket IN ({", ".join("?" * len(plan.edges))}) GROUP BY device_uuid'
+        counts.extend(conn.execute(sql, params + plan.edges).fetchall())
+    return counts
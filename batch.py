@@ -0,0 +1,82 @@
+"""
+Metrics of many devices in one request, for fleet dashboards.
+
+The devices of a request are grouped by shard, and each shard answers with
+the grouped range queries of rollups.range_totals_by_device or
+rollups.range_histograms: one query per segment of the date range for up
+to DEVICES_PER_QUERY devices, rather than one request, connection and
+query per device. Count, max, min and mean only need the rollup totals;
+median, mode and the quartiles need histograms.
+"""
+from flask import abort
+
+from histogram import METRICS, histogram_metrics
+from rollups import range_histograms, range_totals_by_device
+from utils import QueryFilters, validate_type_field
+
+# Metrics answered from count, sum, max and min alone
+TOTALS_METRICS = ('count', 'max', 'min', 'mean')
+
+
+def parse_batch_query(body, max_devices):
+    """
+    Returns the devices, metrics and filters of a batch query body
+    Aborts with a 400 if the body is not a valid batch query
+    :param body: decoded JSON body with devices, metrics and optional type, start and end
+    :param max_devices: most devices a query may name
+    :return: (list of device uuids, list of metrics, QueryFilters)
+    """
+    if not isinstance(body, dict):
+        abort(400, "The body must be a JSON object with a 'devices' list")
+
+    devices = body.get('devices')
+    if not isinstance(devices, list) or not devices or not all(isinstance(d, str) for d in devices):
+        abort(400, "'devices' must be a non empty list of device uuids")
+    # Keep the order the devices were asked for, without repeats
+    devices = list(dict.fromkeys(devices))
+    if len(devices) > max_devices:
+        abort(400, f"'devices' can name at most {max_devices} devices")
+
+    metrics = body.get('metrics', list(METRICS))
+    if not isinstance(metrics, list) or not metrics or not all(isinstance(m, str) for m in metrics):
+        abort(400, "'metrics' must be a non empty list of metric names")
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        abort(400, f"Unknown metrics {', '.join(unknown)}, the allowed metrics are {', '.join(METRICS)}")
+
+    bounds = {}
+    for name in ('start', 'end'):
+        bound = body.get(name)
+        if bound is not None and (not isinstance(bound, int) or isinstance(bound, bool)):
+            abort(400, f"'{name}' must be an integer epoch time")
+        bounds[name] = bound
+
+    sensor_type = body.get('type')
+    if sensor_type is not None:
+        valid, sensor_type = validate_type_field(sensor_type)
+        if not valid:
+            abort(400, sensor_type)
+
+    return devices, metrics, QueryFilters(bounds['start'], bounds['end'], sensor_type)
+
+
+def query_devices(conn, device_uuids, metrics, filters):
+    """
+    Computes metrics for every device of one shard
+    :param conn: sqlite3 connection to the shard
+    :param device_uuids: list of devices in the shard
+    :param metrics: names from METRICS
+    :param filters: QueryFilters
+    :return: dict of device_uuid to dict of metrics
+    """
+    if all(metric in TOTALS_METRICS for metric in metrics):
+        results = {}
+        for device_uuid, (count, total, maximum, minimum) in range_totals_by_device(conn, device_uuids,
+                                                                                    filters).items():
+            values = {'count': count, 'max': maximum, 'min': minimum,
+                      'mean': int(total / count) if count else None}
+            results[device_uuid] = {metric: values[metric] for metric in metrics}
+        return results
+
+    return {device_uuid: histogram_metrics(histogram, metrics)
+            for device_uuid, histogram in range_histograms(conn, device_uuids, filters).items()}
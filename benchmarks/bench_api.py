@@ -0,0 +1,345 @@
+"""
+Load test of every route of the readings API against a synthetic fleet.
+
+Generates a fleet of devices (device count, readings per device, time span
+and share of humidity readings are configurable, and the same seed gives
+the same fleet) into the app's SQLite shards, then sends each endpoint
+`--requests` requests with random devices, types and date ranges. Every
+endpoint runs on its own, through the Flask test client (one client, no
+network) and through a real threaded WSGI server hit by `--concurrency`
+clients, and its throughput and p50/p95/p99 latency are reported as JSON.
+
+    python -m benchmarks.bench_api --devices 1000 --readings-per-device 1000 --output baseline.json
+    python -m benchmarks.bench_api --devices 1000 --readings-per-device 1000 --baseline baseline.json
+
+With --baseline the run is compared to a stored report: an endpoint whose
+p95 grew, or whose throughput fell, by more than --tolerance is listed under
+"regressions" and the exit status is 1. The fleet is built in a temporary
+directory unless --directory is given, in which case it is kept and reused
+by later runs with the same fleet options.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from frames import FRAME_MIMETYPE, encode_frame
+from schema import migrate, roll_up
+from shards import shard_index, shard_paths
+from utils import SENSOR_TYPES
+
+FLEET_START = 1600000000
+FLEET_FILE = 'fleet.json'
+
+
+def generate_fleet(database, shards, devices, per_device, span, humidity_share, seed=0, chunk=100000):
+    """
+    Inserts `per_device` readings for each of `devices` devices at random
+    times within `span` seconds, into the shard each device hashes to
+    """
+    rng = random.Random(seed)
+    paths = shard_paths(database, shards)
+    conns = []
+    for path in paths:
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        migrate(conn)
+        conns.append(conn)
+
+    batches = [[] for _ in paths]
+    for device in range(devices):
+        device_uuid = f'device-{device}'
+        batch = batches[shard_index(device_uuid, shards)]
+        for date_created in sorted(rng.randrange(span) for _ in range(per_device)):
+            sensor_type = 'humidity' if rng.random() < humidity_share else 'temperature'
+            batch.append((device_uuid, sensor_type, rng.randint(0, 100), FLEET_START + date_created))
+        for conn, rows in zip(conns, batches):
+            if len(rows) >= chunk:
+                conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+                roll_up(conn)
+                conn.commit()
+                rows.clear()
+    for conn, rows in zip(conns, batches):
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        roll_up(conn)
+        conn.commit()
+        conn.close()
+
+
+def random_filters(rng, fleet):
+    """
+    Query string of a random type and date range, each left out now and then
+    """
+    args = []
+    if rng.random() < 0.5:
+        args.append(f'type={rng.choice(SENSOR_TYPES)}')
+    if rng.random() < 0.8:
+        start = FLEET_START + rng.randrange(fleet['span'])
+        end = start + rng.randrange(fleet['span'] // 10 + 1)
+        args += [f'start={start}', f'end={end}']
+    return '&'.join(args)
+
+
+def device(rng, fleet):
+    return f'/devices/device-{rng.randrange(fleet["devices"])}'
+
+
+def metric(name):
+    return lambda rng, fleet: ('GET', f'{device(rng, fleet)}/readings/{name}/?{random_filters(rng, fleet)}', None, None)
+
+
+def writer(rng, fleet):
+    # Posts go to devices of their own so the fleet queried stays the same run after run
+    return f'/devices/writer-{rng.randrange(fleet["devices"])}'
+
+
+def post_reading(rng, fleet):
+    body = json.dumps({'type': rng.choice(SENSOR_TYPES), 'value': rng.randint(0, 100),
+                       'date_created': FLEET_START + fleet['span'] + rng.randrange(3600)})
+    return 'POST', f'{writer(rng, fleet)}/readings/', body.encode(), 'application/json'
+
+
+def post_frame(rng, fleet):
+    date_created = FLEET_START + fleet['span'] + rng.randrange(3600)
+    body = encode_frame([(date_created + i, rng.choice(SENSOR_TYPES), rng.randint(0, 100)) for i in range(100)])
+    return 'POST', f'{writer(rng, fleet)}/readings/', body, FRAME_MIMETYPE
+
+
+def batch_query(rng, fleet):
+    body = {'devices': [f'device-{rng.randrange(fleet["devices"])}' for _ in range(50)]}
+    if rng.random() < 0.5:
+        body['type'] = rng.choice(SENSOR_TYPES)
+    if rng.random() < 0.8:
+        body['start'] = FLEET_START + rng.randrange(fleet['span'])
+        body['end'] = body['start'] + rng.randrange(fleet['span'] // 10 + 1)
+    return 'POST', '/devices/readings/query/', json.dumps(body).encode(), 'application/json'
+
+
+# Endpoint name -> function of (rng, fleet) returning (method, path, body, content type)
+ENDPOINTS = {
+    'readings-page': lambda rng, fleet: ('GET', f'{device(rng, fleet)}/readings/?limit=100&{random_filters(rng, fleet)}',
+                                         None, None),
+    'readings-stream': lambda rng, fleet: ('GET', f'{device(rng, fleet)}/readings/?stream=ndjson&'
+                                                  f'{random_filters(rng, fleet)}', None, None),
+    'series': lambda rng, fleet: ('GET', f'{device(rng, fleet)}/readings/series/?points=100&'
+                                         f'{random_filters(rng, fleet)}', None, None),
+    'stats': metric('stats'),
+    'max': metric('max'),
+    'min': metric('min'),
+    'mode': metric('mode'),
+    'median': metric('median'),
+    'mean': metric('mean'),
+    'quartiles': metric('quartiles'),
+    'latest': lambda rng, fleet: ('GET', f'{device(rng, fleet)}/readings/latest/?type={rng.choice(SENSOR_TYPES)}',
+                                  None, None),
+    'summaries': lambda rng, fleet: ('GET', f'/devices/summaries/?limit=20&offset={rng.randrange(fleet["devices"])}&'
+                                            f'{random_filters(rng, fleet)}', None, None),
+    'batch-query': batch_query,
+    'quantiles': lambda rng, fleet: ('GET', f'/devices/readings/quantiles/?q=0.5,0.9,0.99&'
+                                            f'{"approx=true&" if rng.random() < 0.5 else ""}'
+                                            f'{random_filters(rng, fleet)}', None, None),
+    'silent': lambda rng, fleet: ('GET', f'/devices/silent/?seconds={rng.randrange(fleet["span"])}', None, None),
+    'stats-pool': lambda rng, fleet: ('GET', '/stats/pool/', None, None),
+    'stats-ingest': lambda rng, fleet: ('GET', '/stats/ingest/', None, None),
+    'stats-cache': lambda rng, fleet: ('GET', '/stats/cache/', None, None),
+    'stats-slow-requests': lambda rng, fleet: ('GET', '/stats/slow-requests/', None, None),
+    'metrics': lambda rng, fleet: ('GET', '/metrics', None, None),
+    'post-reading': post_reading,
+    'post-frame': post_frame,
+}
+
+
+def percentile(latencies, fraction):
+    """
+    Nearest rank percentile of sorted latencies
+    """
+    return latencies[min(len(latencies) - 1, max(0, round(fraction * len(latencies)) - 1))]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def drive_client(app, requests):
+    """
+    Sends the requests one after the other through the Flask test client
+    :return: (latencies in seconds, error count, elapsed seconds)
+    """
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    began = time.perf_counter()
+    for method, path, body, content_type in requests:
+        sent = time.perf_counter()
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        response.get_data()
+        latencies.append(time.perf_counter() - sent)
+        errors += response.status_code >= 400
+    return latencies, errors, time.perf_counter() - began
+
+
+def drive_server(url, requests, concurrency):
+    """
+    Sends the requests to a running server from `concurrency` threads
+    :return: (latencies in seconds, error count, elapsed seconds)
+    """
+
+    def send(request):
+        method, path, body, content_type = request
+        headers = {'Content-Type': content_type} if content_type else {}
+        sent = time.perf_counter()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url + path, body, headers, method=method)) as response:
+                response.read()
+            failed = False
+        except urllib.error.HTTPError as error:
+            error.read()
+            failed = True
+        return time.perf_counter() - sent, failed
+
+    began = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(send, requests))
+    elapsed = time.perf_counter() - began
+    return [latency for latency, _ in results], sum(failed for _, failed in results), elapsed
+
+
+def run(args):
+    from werkzeug.serving import make_server
+
+    # The app keeps its databases in the working directory, so it is only
+    # imported once we are in the fleet's directory
+    from app import app
+    app.config['DATABASE_SHARDS'] = args.shards
+    if not args.cache:
+        app.config['RESPONSE_CACHE_MAX_BYTES'] = 0
+
+    fleet = {'devices': args.devices, 'readings_per_device': args.readings_per_device, 'span': args.span,
+             'humidity_share': args.humidity_share, 'shards': args.shards, 'seed': args.seed}
+    stored = None
+    if os.path.exists(FLEET_FILE):
+        with open(FLEET_FILE) as file:
+            stored = json.load(file)
+    if stored != fleet:
+        for path in shard_paths('database.db', args.shards):
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        began = time.perf_counter()
+        generate_fleet('database.db', args.shards, args.devices, args.readings_per_device, args.span,
+                       args.humidity_share, args.seed)
+        print(f'Generated the fleet in {time.perf_counter() - began:.1f}s', file=sys.stderr)
+        with open(FLEET_FILE, 'w') as file:
+            json.dump(fleet, file)
+
+    endpoints = args.endpoints.split(',') if args.endpoints else list(ENDPOINTS)
+    results = {}
+    for driver in args.drivers.split(','):
+        server = None
+        if driver == 'server':
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        results[driver] = {}
+        for name in endpoints:
+            rng = random.Random(f'{args.seed}-{name}')
+            requests = [ENDPOINTS[name](rng, fleet) for _ in range(args.requests)]
+            if server is None:
+                measured = drive_client(app, requests)
+            else:
+                measured = drive_server(f'http://127.0.0.1:{server.server_port}', requests, args.concurrency)
+            results[driver][name] = summarize(*measured)
+            print(f'{driver} {name}: {results[driver][name]}', file=sys.stderr)
+        if server is not None:
+            server.shutdown()
+    return {'fleet': fleet, 'requests': args.requests, 'concurrency': args.concurrency, 'results': results}
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns the endpoints of a report that got slower than in the baseline
+    by more than the tolerance, by p95 latency or throughput
+    :return: list of dicts
+    """
+    regressions = []
+    for driver, endpoints in report['results'].items():
+        for name, current in endpoints.items():
+            previous = baseline.get('results', {}).get(driver, {}).get(name)
+            if previous is None:
+                continue
+            if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append({'driver': driver, 'endpoint': name, 'metric': 'p95_ms',
+                                    'baseline': previous['p95_ms'], 'current': current['p95_ms']})
+            if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+                regressions.append({'driver': driver, 'endpoint': name, 'metric': 'throughput_rps',
+                                    'baseline': previous['throughput_rps'], 'current': current['throughput_rps']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--readings-per-device', type=int, default=1000)
+    parser.add_argument('--span', type=int, default=30 * 86400,
+                        help='seconds the readings of a device are spread over')
+    parser.add_argument('--humidity-share', type=float, default=0.5,
+                        help='fraction of the readings that are humidity ones')
+    parser.add_argument('--shards', type=int, default=1, help='DATABASE_SHARDS to run with')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and driver')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients of the server driver')
+    parser.add_argument('--drivers', default='client,server', help='comma separated out of client and server')
+    parser.add_argument('--endpoints', default='',
+                        help=f'comma separated endpoints to run, out of {", ".join(ENDPOINTS)}; all by default')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache on')
+    parser.add_argument('--directory', help='keep the fleet in this directory and reuse it')
+    parser.add_argument('--output', help='also write the report to this file, e.g. to use as a baseline')
+    parser.add_argument('--baseline', help='report of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change in p95 latency or throughput that counts as a regression')
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as directory:
+        directory = os.path.abspath(args.directory) if args.directory else directory
+        os.makedirs(directory, exist_ok=True)
+        os.chdir(directory)
+        try:
+            report = run(args)
+        finally:
+            os.chdir(cwd)
+
+    if baseline is not None:
+        report['regressions'] = compare(report, baseline, args.tolerance)
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
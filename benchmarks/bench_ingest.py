@@ -0,0 +1,112 @@
+"""
+Ingest throughput of POST /devices/<uuid>/readings/ by body format.
+
+Posts the same synthetic readings through the Flask test client as one
+JSON object per request (json-single), JSON arrays (json-batch) and binary
+frames (binary-batch, see frames.py), against a fresh database in a
+temporary directory, and reports rows stored per second for each. Rows
+parsed and validated per second, without the request or the insert, are
+reported next to them since the inserts (and their rollup triggers) bound
+both batch formats end to end.
+
+    python -m benchmarks.bench_ingest --rows 100000 --batch 1000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from frames import FRAME_MIMETYPE, decode_frame, encode_frame
+from utils import SENSOR_TYPES, validate_reading
+
+
+def readings(rows, seed=0):
+    """
+    Returns `rows` random (date_created, type, value) readings, one a second
+    """
+    rng = random.Random(seed)
+    return [(1600000000 + i, SENSOR_TYPES[i % 2], rng.randint(0, 100)) for i in range(rows)]
+
+
+def json_single(data, batch):
+    for date_created, sensor_type, value in data:
+        yield json.dumps({'type': sensor_type, 'value': value, 'date_created': date_created}), 'application/json'
+
+
+def json_batch(data, batch):
+    for offset in range(0, len(data), batch):
+        yield json.dumps([{'type': t, 'value': v, 'date_created': d} for d, t, v in data[offset:offset + batch]]), \
+            'application/json'
+
+
+def binary_batch(data, batch):
+    for offset in range(0, len(data), batch):
+        yield encode_frame(data[offset:offset + batch]), FRAME_MIMETYPE
+
+
+def parse(body, content_type):
+    """
+    What the endpoint does to a body before storing it
+    """
+    if content_type == FRAME_MIMETYPE:
+        return decode_frame('device', body)
+    post_data = json.loads(body)
+    return [validate_reading('device', reading) for reading in (post_data if isinstance(post_data, list) else [post_data])]
+
+
+FORMATS = (('json-single', json_single), ('json-batch', json_batch), ('binary-batch', binary_batch))
+
+
+def run(rows, single_rows, batch):
+    # The app keeps its databases in the working directory
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            from app import app
+            client = app.test_client()
+            for name, encode in FORMATS:
+                data = readings(single_rows if name == 'json-single' else rows)
+                # Bodies are encoded up front, the device would have done it
+                bodies = list(encode(data, batch))
+                began = time.perf_counter()
+                for body, content_type in bodies:
+                    parse(body, content_type)
+                parsing = time.perf_counter() - began
+
+                began = time.perf_counter()
+                for body, content_type in bodies:
+                    response = client.post(f'/devices/{name}/readings/', data=body, content_type=content_type)
+                    assert response.status_code == 201, response.data
+                elapsed = time.perf_counter() - began
+                results.append({
+                    'format': name,
+                    'rows': len(data),
+                    'requests': len(bodies),
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(len(data) / elapsed),
+                    'parsed_rows_per_second': round(len(data) / parsing),
+                })
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='readings posted by each batch format')
+    parser.add_argument('--single-rows', type=int, default=5000,
+                        help='readings posted one request each, which is much slower')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='readings per batch request')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.rows, args.single_rows, args.batch), indent=2))
+
+
+if __name__ == '__main__':
+    main()
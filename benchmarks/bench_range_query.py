@@ -0,0 +1,105 @@
+"""
+Per-device range query latency with and without the covering index.
+
+Builds a synthetic readings table for every requested size, times the
+query the /readings/ endpoints run for one device and a date range on the
+bare table, then adds the index through `schema.migrate` and times it again.
+Without the index latency grows with the table (a full scan); with it
+latency only depends on the rows returned.
+
+    python -m benchmarks.bench_range_query --rows 1000000,10000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from schema import SCHEMA, migrate
+from utils import SENSOR_TYPES, QueryFilters, build_sql
+
+SELECTION = 'select value from readings where device_uuid = ? '
+
+
+def fill(conn, rows, devices, seed=0, chunk=100000):
+    """
+    Inserts `rows` readings spread evenly over `devices` devices, one reading
+    per device per minute
+    """
+    rng = random.Random(seed)
+    conn.execute(SCHEMA[0])
+    for offset in range(0, rows, chunk):
+        conn.executemany(
+            'insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+            ((f'device-{i % devices}', SENSOR_TYPES[(i // devices) % 2], rng.randint(0, 100), (i // devices) * 60)
+             for i in range(offset, min(offset + chunk, rows)))
+        )
+    conn.commit()
+
+
+def time_queries(conn, devices, span, queries, window, seed=1):
+    """
+    Runs `queries` random per-device range queries
+    :return: (median latency in ms, mean rows returned)
+    """
+    rng = random.Random(seed)
+    latencies = []
+    returned = []
+    for _ in range(queries):
+        start = rng.randint(0, max(span - window, 0))
+        filters = QueryFilters(start, start + window, rng.choice(SENSOR_TYPES))
+        sql, params = build_sql(SELECTION, filters, [f'device-{rng.randrange(devices)}'])
+        began = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        latencies.append((time.perf_counter() - began) * 1000)
+        returned.append(len(rows))
+    return statistics.median(latencies), statistics.mean(returned)
+
+
+def run(sizes, per_device, queries, window):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in sizes:
+            path = os.path.join(directory, f'bench-{rows}.db')
+            conn = sqlite3.connect(path)
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            devices = max(rows // per_device, 1)
+            fill(conn, rows, devices)
+            span = (rows // devices) * 60
+
+            scan_ms, returned = time_queries(conn, devices, span, queries, window)
+            migrate(conn)
+            index_ms, _ = time_queries(conn, devices, span, queries, window)
+            conn.close()
+
+            results.append({
+                'rows': rows,
+                'devices': devices,
+                'rows_returned': returned,
+                'full_scan_median_ms': round(scan_ms, 3),
+                'indexed_median_ms': round(index_ms, 3),
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='1000000,10000000',
+                        help='comma separated table sizes to benchmark')
+    parser.add_argument('--readings-per-device', type=int, default=1000,
+                        help='the device count grows with the table so every query returns the same rows')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--window', type=int, default=3600,
+                        help='width of the queried date range in seconds')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.rows.split(',')]
+    print(json.dumps(run(sizes, args.readings_per_device, args.queries, args.window), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+
+from approximate import covered_filters
+from db import get_database_path, get_shard_paths
+from ingest import committed_rowids
+from replicas import replica_generation
+from utils import parse_bool_parameter, parse_query_filters
+
+# Rough bytes an entry costs on top of its body (key, headers, bookkeeping)
+ENTRY_OVERHEAD = 256
+# Most rowid ranges between skipped ones a change feed asks for in one query
+MAX_CHANGE_GAPS = 64
+CHANGES_SELECTION = 'select device_uuid, type, MIN(date_created), MAX(date_created) from readings where '
+
+
+class _Entry:
+    """
+    A cached response body and the readings it was computed from
+    """
+
+    def __init__(self, body, mimetype, etag, device_uuid, filters, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.device_uuid = device_uuid
+        self.filters = filters
+        self.expires = expires
+        self.size = len(body) + ENTRY_OVERHEAD
+
+    def covers(self, device_uuid, sensor_type, first_date, last_date):
+        """
+        Whether new readings of a device and type dated from first_date to
+        last_date may fall inside the readings this entry was computed from
+        """
+        if self.device_uuid is not None and self.device_uuid != device_uuid:
+            return False
+        if self.filters.sensor_type and self.filters.sensor_type != sensor_type:
+            return False
+        if self.filters.start is not None and last_date < self.filters.start:
+            return False
+        if self.filters.end is not None and first_date > self.filters.end:
+            return False
+        return True
+
+
+class ResponseCache:
+    """
+    An LRU cache of response bodies bounded by their total size in bytes,
+    with entries also expiring `ttl` seconds after they were stored.
+
+    Entries are keyed on the endpoint, the device (None for endpoints that
+    cover every device), the type/start/end filters and any other query
+    parameters. An insert only drops the entries whose device, type and date
+    range the new reading falls in, so polling a closed range of history
+    keeps hitting the cache while readings keep arriving.
+
+    Every invalidation bumps a version, per device and overall, and a
+    response computed while one of its versions moved is not stored, so a
+    slow request never caches a result that an insert made stale. Inserts
+    made by other processes come in through `sync_cache`, which a thread
+    runs in the background.
+    """
+
+    def __init__(self, max_bytes=16777216, ttl=60.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_device = {}
+        self._versions = {}
+        self._version = 0
+        self._generation = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        """
+        Returns the cached entry for a key, or None if missing or expired
+        :param key: cache key
+        :return: Union[_Entry, None]
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def version(self, device_uuid):
+        """
+        Returns a token to hand back to `put` once the response is computed
+        :param device_uuid: the device the response is about, or None for every device
+        :return: tuple
+        """
+        with self._lock:
+            return self._current_version(device_uuid)
+
+    def put(self, key, version, body, mimetype, etag, device_uuid, filters):
+        """
+        Stores a response body unless an insert invalidated its device since
+        `version` was taken or it is too big for the cache on its own
+        :param key: cache key
+        :param version: token returned by `version` before computing the body
+        :param body: bytes
+        :param mimetype: mimetype of the body
+        :param etag: ETag of the body
+        :param device_uuid: the device the response is about, or None for every device
+        :param filters: QueryFilters the response was computed with
+        """
+        entry = _Entry(body, mimetype, etag, device_uuid, filters, time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            if self._current_version(device_uuid) != version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._by_device.setdefault(device_uuid, set()).add(key)
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, rows):
+        """
+        Drops every entry computed from readings that the new rows belong with
+        :param rows: inserted (device_uuid, type, value, date_created) tuples
+        """
+        self.invalidate_ranges([(device_uuid, sensor_type, date_created, date_created)
+                                for device_uuid, sensor_type, _, date_created in rows])
+
+    def invalidate_ranges(self, changes):
+        """
+        Drops every entry computed from readings that new readings may belong
+        with, given per device and type as the range of their dates
+        :param changes: (device_uuid, type, first date_created, last date_created) tuples
+        """
+        with self._lock:
+            self._version += 1
+            for device_uuid, sensor_type, first_date, last_date in changes:
+                self._versions[device_uuid] = self._versions.get(device_uuid, 0) + 1
+                for owner in (device_uuid, None):
+                    for key in list(self._by_device.get(owner, ())):
+                        if self._entries[key].covers(device_uuid, sensor_type, first_date, last_date):
+                            self._remove(key)
+                            self._invalidations += 1
+
+    def clear(self):
+        """
+        Drops every entry, e.g. after writing to the database behind the app's back
+        """
+        with self._lock:
+            self._entries.clear()
+            self._by_device.clear()
+            self._bytes = 0
+            self._versions.clear()
+            self._generation += 1
+
+    def stats(self):
+        """
+        Returns usage counters for the cache
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations
+            }
+
+    def _current_version(self, device_uuid):
+        if device_uuid is None:
+            return self._generation, self._version
+        return self._generation, self._versions.get(device_uuid, 0)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        keys = self._by_device[entry.device_uuid]
+        keys.discard(key)
+        if not keys:
+            del self._by_device[entry.device_uuid]
+
+
+class ChangeFeed:
+    """
+    Follows the readings committed to a shard by every process, so that a
+    cache can drop what other processes' inserts made stale. Checking costs
+    one PRAGMA data_version on a connection of the feed's own, which only
+    changes once another connection committed; the new readings are then
+    the ones past the last rowid seen, collapsed by one grouped query into
+    the range of dates of each device and type.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._conn = sqlite3.connect(database, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        self._schema_version = self._conn.execute('PRAGMA schema_version').fetchone()[0]
+        self._last_rowid = self._max_rowid()
+
+    def changes(self, skip=()):
+        """
+        Returns what was committed since the last call, or None when what
+        changed cannot be told (e.g. the table was rebuilt)
+        :param skip: (first, last) rowid ranges whose readings to leave out,
+            e.g. the ones this process committed and invalidated already
+        :return: Union[list of (device_uuid, type, first date_created, last date_created), None]
+        """
+        with self._lock:
+            try:
+                data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+                if data_version == self._data_version:
+                    return []
+                self._data_version = data_version
+                schema_version = self._conn.execute('PRAGMA schema_version').fetchone()[0]
+                if schema_version != self._schema_version:
+                    # Rowids of a rebuilt table start over
+                    self._schema_version = schema_version
+                    self._last_rowid = self._max_rowid()
+                    return None
+                last_rowid = self._max_rowid()
+                if last_rowid < self._last_rowid:
+                    self._last_rowid = last_rowid
+                    return None
+                gaps = _gaps(self._last_rowid, last_rowid, skip)
+                self._last_rowid = last_rowid
+                if not gaps:
+                    return []
+                sql = CHANGES_SELECTION + ' OR '.join(['(rowid > ? AND rowid <= ?)'] * len(gaps))
+                sql += ' GROUP BY device_uuid, type'
+                return [tuple(row) for row in self._conn.execute(sql, [rowid for gap in gaps for rowid in gap])]
+            except sqlite3.Error:
+                self._last_rowid = 0
+                return None
+
+    def _max_rowid(self):
+        try:
+            return self._conn.execute('select MAX(rowid) from readings').fetchone()[0] or 0
+        except sqlite3.Error:
+            return 0
+
+
+def _gaps(after, last, skip):
+    """
+    Splits the rowids in (after, last] around the ranges to skip
+    :return: list of (after, last) ranges, each rowid > after and <= last
+    """
+    gaps = []
+    for first, end in sorted(skip):
+        if end <= after or first > last:
+            continue
+        if first > after + 1:
+            gaps.append((after, first - 1))
+        after = end
+    if after < last:
+        gaps.append((after, last))
+    if len(gaps) > MAX_CHANGE_GAPS:
+        # Better some readings invalidated twice than a statement this long
+        return [(gaps[0][0], last)]
+    return gaps
+
+
+_feeds = {}
+_syncers = {}
+_feeds_lock = threading.Lock()
+
+
+def sync_cache(app, cache):
+    """
+    Drops the cache entries that readings committed by other processes
+    since the last sync made stale
+    :param app: Flask app
+    :param cache: ResponseCache of the app's database
+    """
+    for database in get_shard_paths(app):
+        with _feeds_lock:
+            feed = _feeds.get(database)
+            if feed is None:
+                feed = ChangeFeed(database)
+                _feeds[database] = feed
+        # This process's own inserts were invalidated when they were committed
+        changes = feed.changes(committed_rowids(database))
+        if changes is None:
+            cache.clear()
+        elif changes:
+            cache.invalidate_ranges(changes)
+
+
+def _run_syncer(app, cache, every):
+    while True:
+        time.sleep(every)
+        try:
+            sync_cache(app, cache)
+        except Exception:
+            app.logger.exception('Failed to sync the response cache')
+            cache.clear()
+
+
+def _start_syncer(app, cache):
+    """
+    Starts the thread syncing a cache with other processes' inserts every
+    RESPONSE_CACHE_SYNC_SECONDS, once per process
+    """
+    database = get_database_path(app)
+    with _feeds_lock:
+        if database in _syncers:
+            return
+        thread = threading.Thread(target=_run_syncer, args=(app, cache, app.config['RESPONSE_CACHE_SYNC_SECONDS']),
+                                  name=f'cache-sync-{database}', daemon=True)
+        _syncers[database] = thread
+    thread.start()
+
+
+def _forget_feeds():
+    # Same as db._forget_pools; the syncer threads did not survive the fork either
+    global _feeds, _syncers, _feeds_lock
+    _inherited.append(_feeds)
+    _feeds = {}
+    _syncers = {}
+    _feeds_lock = threading.Lock()
+
+
+_inherited = []
+os.register_at_fork(after_in_child=_forget_feeds)
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(app):
+    """
+    Returns the response cache for the database the app is pointed at,
+    creating it on first use
+    :param app: Flask app
+    :return: ResponseCache
+    """
+    database = get_database_path(app)
+    with _caches_lock:
+        cache = _caches.get(database)
+        if cache is None:
+            cache = ResponseCache(max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+                                  ttl=app.config['RESPONSE_CACHE_TTL'])
+            _caches[database] = cache
+            # Starts the feeds at the current readings, before anything is cached
+            sync_cache(app, cache)
+    # Under TESTING the tests sync when they mean to
+    if app.config['RESPONSE_CACHE_SYNC_SECONDS'] and not app.testing and database not in _syncers:
+        _start_syncer(app, cache)
+    return cache
+
+
+def cached_response(app, read_replicas=False):
+    """
+    Decorator that serves a GET endpoint's 200 responses from the response
+    cache, and answers with a 304 when the client already holds the
+    response's ETag. It goes outside handle_database_connection so that a
+    hit never borrows a connection.
+    :param app: Flask app
+    :param read_replicas: whether the endpoint reads get_read_pools, whose
+        answers are then cached per replica generation, so an answer from a
+        replica that lagged an insert lasts no longer than the replica
+    :return:
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_cache(app)
+            device_uuid = kwargs.get('device_uuid')
+            filters = parse_query_filters(request)
+            extra = tuple(sorted((name, value) for name, value in request.args.items(multi=True)
+                                 if name not in ('type', 'start', 'end')))
+            key = (request.endpoint, device_uuid, filters, extra)
+            if read_replicas:
+                key += (replica_generation(app),)
+
+            entry = cache.get(key)
+            if entry is not None:
+                response = app.response_class(entry.body, mimetype=entry.mimetype)
+                response.set_etag(entry.etag)
+            else:
+                version = cache.version(device_uuid)
+                response = app.make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response.add_etag()
+                if parse_bool_parameter(request, 'approx'):
+                    # Approximate answers also count readings just outside the range
+                    filters = covered_filters(filters)
+                cache.put(key, version, response.get_data(), response.mimetype, response.get_etag()[0],
+                          device_uuid, filters)
+
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
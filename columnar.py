@@ -0,0 +1,299 @@
+"""
+Columnar read path for the metric endpoints, used when ANALYTIC_ENGINE is
+'columnar'.
+
+Every device's readings, archived ones included, are kept as four NumPy
+columns sorted by (date_created, rowid): dates (int64), values (uint8),
+type codes (uint8) and rowids (int64). A device's columns are saved one
+after the other in a single file in a `<database>.columns` directory, after
+a JSON header line saying what they were built from, and memory-mapped, so
+processes share them through the page cache and a device's columns cost no
+Python objects per reading. The file is only ever replaced whole, by a
+rename, so a process never reads columns of one version with the header of
+another. A range is two searchsorted calls on the dates and the counts
+per value a single bincount, after which the usual Histogram answers every
+metric.
+
+When the device's count in device_summaries grew, the readings past the
+last rowid the columns hold are merged in. Columns are only rebuilt from
+SQLite when the set of archived partitions changed, or when the new rows do
+not add up to the new count (readings were deleted or moved to another
+shard).
+
+NumPy is only needed for this engine, the default SQL engine works without
+it.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from db import get_shard_path
+from histogram import MAX_VALUE, MIN_VALUE, Histogram
+from partitions import archived_blocks
+from utils import SENSOR_TYPES
+
+COLUMNS = (('dates', 'int64'), ('rowids', 'int64'), ('values', 'uint8'), ('types', 'uint8'))
+
+# Column files start with a JSON header line padded to a multiple of this
+HEADER_ALIGNMENT = 64
+
+VERSION_SELECTION = ('select SUM(readings_count), '
+                     '(select COUNT(*) from archived_partitions), (select MAX(window_start) from archived_partitions) '
+                     'from device_summaries where device_uuid = ?')
+COLUMNS_SELECTION = 'select date_created, value, type, rowid from readings where device_uuid = ? ORDER BY rowid'
+# The unary + keeps SQLite off the device index, so only the rows inserted
+# since the columns were built are read, in rowid order
+NEW_ROWS_SELECTION = ('select date_created, value, type, rowid from readings where +device_uuid = ? AND rowid > ? '
+                      'ORDER BY rowid')
+
+
+class DeviceColumns:
+    """
+    One device's readings as columns sorted by (date_created, rowid)
+    """
+
+    def __init__(self, version, last_rowid, dates, values, types, rowids):
+        self.version = version
+        self.last_rowid = last_rowid
+        self.dates = dates
+        self.values = values
+        self.types = types
+        self.rowids = rowids
+
+    def histogram(self, filters):
+        """
+        Histogram of the readings matching the filters
+        :param filters: QueryFilters
+        :return: Histogram
+        """
+        low = 0 if filters.start is None else int(np.searchsorted(self.dates, filters.start, 'left'))
+        high = len(self.dates) if filters.end is None else int(np.searchsorted(self.dates, filters.end, 'right'))
+        values = self.values[low:high]
+        rowids = self.rowids[low:high]
+        if filters.sensor_type:
+            if filters.sensor_type not in SENSOR_TYPES:
+                return Histogram()
+            matching = self.types[low:high] == SENSOR_TYPES.index(filters.sensor_type)
+            values = values[matching]
+            rowids = rowids[matching]
+
+        offsets = values.astype(np.intp) - MIN_VALUE
+        counts = np.bincount(offsets, minlength=MAX_VALUE - MIN_VALUE + 1)
+        first_seen = np.full(len(counts), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first_seen, offsets, rowids)
+        return Histogram.from_counts(counts.tolist(), first_seen.tolist())
+
+
+class ColumnStore:
+    """
+    Memory-mapped columns of the devices of one database file, the most
+    recently used `max_devices` of them held open
+    """
+
+    def __init__(self, directory, max_devices=1024):
+        if np is None:
+            raise RuntimeError("The columnar analytic engine needs numpy, run 'pip install numpy'")
+        self.directory = directory
+        self.max_devices = max_devices
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def version(self, conn, device_uuid):
+        """
+        Returns what the device's columns must have been built from to be current
+        :param conn: sqlite3 connection
+        :param device_uuid: the device
+        :return: list
+        """
+        return list(conn.execute(VERSION_SELECTION, (device_uuid,)).fetchone())
+
+    def columns(self, conn, device_uuid):
+        """
+        Returns the device's columns, loading, extending or rebuilding them if needed
+        :param conn: sqlite3 connection
+        :param device_uuid: the device
+        :return: DeviceColumns
+        """
+        # The version and the rows the columns are extended or built from have
+        # to come from one snapshot, or an insert committed in between gets
+        # saved under a version that does not count it and rebuilt next time
+        began = not conn.in_transaction
+        if began:
+            conn.execute('BEGIN')
+        try:
+            return self._columns(conn, device_uuid)
+        finally:
+            if began:
+                conn.execute('COMMIT')
+
+    def _columns(self, conn, device_uuid):
+        version = self.version(conn, device_uuid)
+        with self._lock:
+            columns = self._open.get(device_uuid)
+        if columns is None or columns.version != version:
+            # Another process may have brought the file up to date
+            loaded = self._load(device_uuid)
+            if loaded is not None and (columns is None or loaded.version == version
+                                       or loaded.last_rowid > columns.last_rowid):
+                columns = loaded
+
+        if columns is not None and columns.version != version:
+            if columns.version[1:] == version[1:] and (columns.version[0] or 0) < (version[0] or 0):
+                columns = self._extend(conn, device_uuid, columns, version)
+            else:
+                columns = None
+            if columns is not None:
+                self._save(device_uuid, columns)
+        if columns is None:
+            columns = self._build(conn, device_uuid, version)
+            self._save(device_uuid, columns)
+
+        with self._lock:
+            self._open[device_uuid] = columns
+            self._open.move_to_end(device_uuid)
+            while len(self._open) > self.max_devices:
+                self._open.popitem(last=False)
+        return columns
+
+    def histogram(self, conn, device_uuid, filters):
+        """
+        Histogram of a device's readings matching the filters
+        :param conn: sqlite3 connection
+        :param device_uuid: the device
+        :param filters: QueryFilters
+        :return: Histogram
+        """
+        return self.columns(conn, device_uuid).histogram(filters)
+
+    def totals(self, conn, device_uuid, filters):
+        """
+        Count, sum, max and min of a device's readings matching the filters,
+        like rollups.range_totals
+        :return: (count, sum, max, min) where max and min are None without readings
+        """
+        histogram = self.histogram(conn, device_uuid, filters)
+        return histogram.count, histogram.total, histogram.max, histogram.min
+
+    def _path(self, device_uuid):
+        digest = hashlib.sha1(device_uuid.encode()).hexdigest()
+        return os.path.join(self.directory, f'{digest}.columns')
+
+    def _load(self, device_uuid):
+        path = self._path(device_uuid)
+        try:
+            with open(path, 'rb') as column_file:
+                header = column_file.readline()
+            meta = json.loads(header)
+            if meta['device_uuid'] != device_uuid:
+                return None
+            arrays = {}
+            offset = len(header)
+            length = meta['length']
+            for name, dtype in COLUMNS:
+                if length:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(length,))
+                else:
+                    arrays[name] = np.empty(0, dtype=dtype)
+                offset += length * np.dtype(dtype).itemsize
+        except (OSError, ValueError, KeyError):
+            return None
+        return DeviceColumns(meta['version'], meta['last_rowid'], arrays['dates'], arrays['values'],
+                             arrays['types'], arrays['rowids'])
+
+    def _build(self, conn, device_uuid, version):
+        dates, values, types, rowids, last_rowid = _rows_to_columns(
+            conn.execute(COLUMNS_SELECTION, (device_uuid,)).fetchall(), 0)
+        dates, values, types, rowids = [dates], [values], [types], [rowids]
+        for sensor_type, block_dates, block_values, block_rowids in archived_blocks(conn, device_uuid):
+            if sensor_type not in SENSOR_TYPES:
+                continue
+            dates.append(np.array(block_dates, dtype=np.int64))
+            values.append(np.frombuffer(block_values, dtype=np.uint8))
+            types.append(np.full(len(block_dates), SENSOR_TYPES.index(sensor_type), dtype=np.uint8))
+            rowids.append(np.array(block_rowids, dtype=np.int64))
+
+        dates, values, types, rowids = (np.concatenate(column) for column in (dates, values, types, rowids))
+        order = np.lexsort((rowids, dates))
+        return DeviceColumns(version, last_rowid, dates[order], values[order], types[order], rowids[order])
+
+    def _extend(self, conn, device_uuid, columns, version):
+        rows = conn.execute(NEW_ROWS_SELECTION, (device_uuid, columns.last_rowid)).fetchall()
+        if (columns.version[0] or 0) + len(rows) != version[0]:
+            # Something else than inserts changed the device's readings
+            return None
+        dates, values, types, rowids, last_rowid = _rows_to_columns(rows, columns.last_rowid)
+        order = np.lexsort((rowids, dates))
+        # New rowids are all higher, so they go after the readings of the same date
+        positions = np.searchsorted(columns.dates, dates[order], 'right')
+        return DeviceColumns(version, last_rowid,
+                             *(np.insert(getattr(columns, name), positions, array[order])
+                               for name, array in (('dates', dates), ('values', values), ('types', types),
+                                                   ('rowids', rowids))))
+
+    def _save(self, device_uuid, columns):
+        # Header and columns go to a temporary file renamed over the old one,
+        # so readers see either the whole old file or the whole new one
+        header = json.dumps({'device_uuid': device_uuid, 'version': columns.version,
+                             'last_rowid': columns.last_rowid, 'length': len(columns.dates)}).encode()
+        header += b' ' * (-(len(header) + 1) % HEADER_ALIGNMENT) + b'\n'
+        path = self._path(device_uuid)
+        temporary = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as column_file:
+            column_file.write(header)
+            for name, dtype in COLUMNS:
+                column_file.write(np.ascontiguousarray(getattr(columns, name), dtype=dtype).tobytes())
+        os.replace(temporary, path)
+
+
+def _rows_to_columns(rows, last_rowid):
+    """
+    Turns (date_created, value, type, rowid) rows into columns, leaving out
+    unknown types
+    :return: (dates, values, types, rowids, highest rowid seen)
+    """
+    if rows:
+        last_rowid = max(last_rowid, rows[-1][3])
+    rows = [row for row in rows if row[2] in SENSOR_TYPES]
+    table = np.array(rows, dtype=object).reshape(-1, 4)
+    return (table[:, 0].astype(np.int64), table[:, 1].astype(np.uint8),
+            np.array([SENSOR_TYPES.index(t) for t in table[:, 2]], dtype=np.uint8), table[:, 3].astype(np.int64),
+            last_rowid)
+
+
+def column_directory(database):
+    """
+    Returns the directory holding the columns of a database file
+    :param database: path of the database
+    :return: str
+    """
+    stem, _ = os.path.splitext(database)
+    return f'{stem}.columns'
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_column_store(app, device_uuid=None):
+    """
+    Returns the column store for the shard holding a device, creating it on
+    first use
+    :param app: Flask app
+    :param device_uuid: the device
+    :return: ColumnStore
+    """
+    database = get_shard_path(app, device_uuid)
+    with _stores_lock:
+        store = _stores.get(database)
+        if store is None:
+            store = ColumnStore(column_directory(database), max_devices=app.config['COLUMN_STORE_MAX_DEVICES'])
+            _stores[database] = store
+        return store
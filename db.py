@@ -0,0 +1,282 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from metrics import InstrumentedConnection
+from shards import shard_index, shard_paths
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection could be checked out of the pool in time
+    """
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long lived SQLite connections to one database file.
+
+    Every connection is configured once when it is opened (WAL journal,
+    synchronous=NORMAL, page cache and mmap sizes, statement cache) and then
+    reused across requests, so requests no longer pay for opening the file,
+    parsing the schema and starting with a cold page cache.
+    """
+
+    def __init__(self, database, size=8, timeout=30.0, cache_size_kib=16384, mmap_size=268435456,
+                 cached_statements=256, read_only=False):
+        self.database = database
+        self.read_only = read_only
+        self.size = size
+        self.timeout = timeout
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def connect(self):
+        """
+        Opens a new connection configured the way the pool hands them out
+        :return: sqlite3.Connection
+        """
+        if self.read_only:
+            # A snapshot is only ever replaced whole, never written in place,
+            # so it can be read without any locking
+            file_id = self.file_id()
+            conn = sqlite3.connect(f'file:{quote(os.path.abspath(self.database))}?mode=ro&immutable=1', uri=True,
+                                   check_same_thread=False, cached_statements=self.cached_statements,
+                                   factory=InstrumentedConnection)
+            conn.file_id = file_id
+        else:
+            conn = sqlite3.connect(self.database, check_same_thread=False, cached_statements=self.cached_statements,
+                                   factory=InstrumentedConnection)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kib)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        return conn
+
+    def acquire(self, timeout=None):
+        """
+        Checks a connection out of the pool, opening one if the pool is not
+        full yet and waiting for one to be released otherwise
+        :param timeout: seconds to wait, defaults to the pool timeout
+        :return: sqlite3.Connection
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is None:
+            with self._lock:
+                can_open = self._created < self.size
+                if can_open:
+                    self._created += 1
+            if can_open:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.monotonic()
+                try:
+                    conn = self._idle.get(timeout=self.timeout if timeout is None else timeout)
+                except queue.Empty:
+                    raise PoolTimeout(f'No connection to {self.database} available') from None
+                finally:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_time += time.monotonic() - started
+
+        if self.read_only and conn.file_id != self.file_id():
+            # The snapshot was replaced since this connection opened it
+            conn.close()
+            try:
+                conn = self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+        return conn
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool, rolling back anything left uncommitted
+        :param conn: connection previously returned by acquire
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager around acquire/release
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """
+        Returns usage counters for the pool
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'database': self.database,
+                'size': self.size,
+                'open': self._created,
+                'in_use': self._in_use,
+                'idle': self._created - self._in_use,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': self._wait_time
+            }
+
+    def file_id(self):
+        """
+        Returns what identifies the database file currently at the pool's path
+        :return: tuple
+        """
+        stat = os.stat(self.database)
+        return stat.st_dev, stat.st_ino, stat.st_mtime_ns
+
+    def close(self):
+        """
+        Closes every idle connection
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def get_database_path(app):
+    """
+    Returns the database file the app should be using, before sharding
+    :param app: Flask app
+    :return: str
+    """
+    if app.config['TESTING']:
+        return 'test_database.db'
+    return 'database.db'
+
+
+def get_shard_paths(app):
+    """
+    Returns the files the app's readings are sharded across
+    :param app: Flask app
+    :return: list of str
+    """
+    return shard_paths(get_database_path(app), app.config['DATABASE_SHARDS'])
+
+
+def get_shard_path(app, device_uuid=None):
+    """
+    Returns the file holding a device's readings. Without a device this is
+    the first shard, which is the whole database unless DATABASE_SHARDS is
+    above 1.
+    :param app: Flask app
+    :param device_uuid: the device
+    :return: str
+    """
+    paths = get_shard_paths(app)
+    if device_uuid is None:
+        return paths[0]
+    return paths[shard_index(device_uuid, len(paths))]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(app, database):
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            pool = ConnectionPool(database,
+                                  size=app.config['DATABASE_POOL_SIZE'],
+                                  timeout=app.config['DATABASE_POOL_TIMEOUT'],
+                                  cache_size_kib=app.config['DATABASE_CACHE_SIZE_KIB'],
+                                  mmap_size=app.config['DATABASE_MMAP_SIZE'],
+                                  cached_statements=app.config['DATABASE_CACHED_STATEMENTS'])
+            _pools[database] = pool
+        return pool
+
+
+def get_pool(app, device_uuid=None):
+    """
+    Returns the connection pool for the shard holding a device (see
+    get_shard_path), creating it on first use
+    :param app: Flask app
+    :param device_uuid: the device
+    :return: ConnectionPool
+    """
+    return _get_pool(app, get_shard_path(app, device_uuid))
+
+
+def get_pools(app):
+    """
+    Returns the connection pool of every shard
+    :param app: Flask app
+    :return: list of ConnectionPool
+    """
+    return [_get_pool(app, database) for database in get_shard_paths(app)]
+
+
+def _forget_pools():
+    # SQLite connections must not be used across fork, nor closed in the
+    # child, so a forked process keeps its parent's pools out of reach
+    global _pools, _pools_lock
+    _inherited.append(_pools)
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+
+_inherited = []
+os.register_at_fork(after_in_child=_forget_pools)
+
+
+def scatter(pools, func):
+    """
+    Calls func with a connection from each pool, the pools in parallel
+    when there are several
+    :param pools: list of ConnectionPool
+    :param func: callable taking a sqlite3 connection
+    :return: list of results in the order of the pools
+    """
+    def call(pool):
+        with pool.connection() as conn:
+            return func(conn)
+
+    if len(pools) == 1:
+        return [call(pools[0])]
+    with ThreadPoolExecutor(max_workers=len(pools)) as executor:
+        return list(executor.map(call, pools))
@@ -0,0 +1,107 @@
+"""
+Compact binary ingest format, posted with Content-Type
+application/x-readings-frame.
+
+A frame is a run of fixed width little endian records, one per reading:
+
+    int64 date_created | uint8 type code | uint8 value      (10 bytes)
+
+where the type code is the index of the type in SENSOR_TYPES. A frame may
+start with a 12 byte batch header:
+
+    4 bytes b'RDGF' | uint16 version (1) | uint16 record size (10) | uint32 record count
+
+Since 12 is not a multiple of 10 the body length alone tells whether a
+header is there. Records are unpacked straight from a memoryview of the
+request body, and the type and value columns are checked for the whole
+batch at once as strided byte slices; only a batch that fails those checks
+is walked record by record to report the bad ones.
+"""
+import struct
+
+from histogram import MAX_VALUE
+from utils import SENSOR_TYPES
+
+FRAME_MIMETYPE = 'application/x-readings-frame'
+FRAME_MAGIC = b'RDGF'
+FRAME_VERSION = 1
+
+RECORD = struct.Struct('<qBB')
+HEADER = struct.Struct('<4sHHI')
+
+# Offsets of the type and value bytes inside a record
+TYPE_OFFSET = 8
+VALUE_OFFSET = 9
+
+
+class FrameError(ValueError):
+    """
+    Raised when a body is not a well formed frame
+    """
+
+
+def encode_frame(readings, header=True):
+    """
+    Packs readings into a frame, for clients and tests
+    :param readings: iterable of (date_created, type, value)
+    :param header: start the frame with a batch header
+    :return: bytes
+    """
+    records = [RECORD.pack(date_created, SENSOR_TYPES.index(sensor_type), value)
+               for date_created, sensor_type, value in readings]
+    if header:
+        records.insert(0, HEADER.pack(FRAME_MAGIC, FRAME_VERSION, RECORD.size, len(records)))
+    return b''.join(records)
+
+
+def frame_records(body):
+    """
+    Returns a memoryview over the records of a frame, without copying them
+    Raises FrameError if the body is not a frame
+    :param body: bytes
+    :return: memoryview
+    """
+    view = memoryview(body)
+    if len(view) >= HEADER.size and len(view) % RECORD.size == HEADER.size % RECORD.size:
+        magic, version, record_size, count = HEADER.unpack_from(view)
+        if magic != FRAME_MAGIC or version != FRAME_VERSION or record_size != RECORD.size:
+            raise FrameError(f'Frame header must be {FRAME_MAGIC!r}, version {FRAME_VERSION} '
+                             f'and record size {RECORD.size}')
+        view = view[HEADER.size:]
+        if count != len(view) // RECORD.size:
+            raise FrameError(f'Frame header counts {count} records but the body holds {len(view) // RECORD.size}')
+    elif len(view) % RECORD.size:
+        raise FrameError(f'Frame records are {RECORD.size} bytes, optionally after a {HEADER.size} byte header')
+    return view
+
+
+def decode_frame(device_uuid, body):
+    """
+    Returns the rows ready for insertion and the errors of the bad records of a frame
+    Raises FrameError if the body is not a frame
+    :param device_uuid: the device the readings belong to
+    :param body: bytes
+    :return: (list of (device_uuid, type, value, date_created), list of {'index', 'errors'})
+    """
+    view = frame_records(body)
+    types = view[TYPE_OFFSET::RECORD.size].tobytes()
+    values = view[VALUE_OFFSET::RECORD.size].tobytes()
+
+    if max(types, default=0) < len(SENSOR_TYPES) and max(values, default=0) <= MAX_VALUE:
+        rows = [(device_uuid, SENSOR_TYPES[code], value, date_created)
+                for date_created, code, value in RECORD.iter_unpack(view)]
+        return rows, []
+
+    rows = []
+    errors = []
+    for index, (date_created, code, value) in enumerate(RECORD.iter_unpack(view)):
+        record_errors = []
+        if code >= len(SENSOR_TYPES):
+            record_errors.append(f'The only allowed sensor type codes are 0 to {len(SENSOR_TYPES) - 1}')
+        if value > MAX_VALUE:
+            record_errors.append("The only allowed values are integers between 0 and 100 inclusive")
+        if record_errors:
+            errors.append({'index': index, 'errors': record_errors})
+        else:
+            rows.append((device_uuid, SENSOR_TYPES[code], value, date_created))
+    return rows, errors
@@ -0,0 +1,219 @@
+"""
+Exact order statistics over the sensor value domain.
+
+Readings only ever hold integers in [0, 100] (see validate_value_field), so
+101 counters describe any set of readings completely. Medians and quartiles
+come from a cumulative scan over the counters and give exactly what the
+`statistics` module gives on the full list of values, in constant memory.
+"""
+from statistics import StatisticsError
+
+from utils import build_sql
+
+MIN_VALUE = 0
+MAX_VALUE = 100
+
+# Counts per value, plus the rowid of each value's first reading so that mode
+# can break ties the way statistics.mode does (first value seen wins)
+HISTOGRAM_SELECTION = 'select value, COUNT(*), MIN(rowid) from readings where device_uuid = ? '
+
+
+class Histogram:
+    """
+    Count of readings per value in [MIN_VALUE, MAX_VALUE]
+    """
+
+    def __init__(self):
+        self.counts = [0] * (MAX_VALUE - MIN_VALUE + 1)
+        self.first_seen = [None] * (MAX_VALUE - MIN_VALUE + 1)
+        self.count = 0
+        self.total = 0
+
+    @classmethod
+    def from_counts(cls, counts, first_seen=None):
+        """
+        Builds a histogram from its counters
+        :param counts: number of readings of every value from MIN_VALUE to MAX_VALUE
+        :param first_seen: optional position of the earliest reading of every value
+        :return: Histogram
+        """
+        histogram = cls()
+        histogram.counts = [int(count) for count in counts]
+        histogram.count = sum(histogram.counts)
+        histogram.total = sum((offset + MIN_VALUE) * count for offset, count in enumerate(histogram.counts))
+        if first_seen is not None:
+            histogram.first_seen = [int(position) if count else None
+                                    for position, count in zip(first_seen, histogram.counts)]
+        return histogram
+
+    def add(self, value, count=1, first_seen=None):
+        """
+        Records `count` readings of `value`
+        :param first_seen: optional position (e.g. rowid) of the earliest of them
+        """
+        offset = value - MIN_VALUE
+        self.counts[offset] += count
+        self.count += count
+        self.total += value * count
+        if first_seen is not None and (self.first_seen[offset] is None or first_seen < self.first_seen[offset]):
+            self.first_seen[offset] = first_seen
+
+    def merge(self, other):
+        """
+        Adds every reading of another histogram to this one
+        """
+        for offset, count in enumerate(other.counts):
+            if count:
+                self.add(offset + MIN_VALUE, count, other.first_seen[offset])
+
+    @property
+    def max(self):
+        for index in range(len(self.counts) - 1, -1, -1):
+            if self.counts[index]:
+                return index + MIN_VALUE
+        return None
+
+    @property
+    def min(self):
+        for index, count in enumerate(self.counts):
+            if count:
+                return index + MIN_VALUE
+        return None
+
+    def nth(self, index):
+        """
+        Returns the value at `index` in the sorted readings
+        :param index: 0 based position
+        :return: int
+        """
+        if not 0 <= index < self.count:
+            raise IndexError('histogram index out of range')
+        seen = 0
+        for offset, count in enumerate(self.counts):
+            seen += count
+            if seen > index:
+                return offset + MIN_VALUE
+
+    def mode(self):
+        """
+        Most common value. Ties go to the value seen first when first_seen
+        positions were recorded, as with statistics.mode, and to the lowest
+        value otherwise
+        :return: int
+        """
+        if self.count == 0:
+            raise StatisticsError('no mode for empty data')
+        best = None
+        for offset, count in enumerate(self.counts):
+            if not count:
+                continue
+            if best is None or count > self.counts[best]:
+                best = offset
+            elif count == self.counts[best] and self.first_seen[offset] is not None \
+                    and self.first_seen[best] is not None and self.first_seen[offset] < self.first_seen[best]:
+                best = offset
+        return best + MIN_VALUE
+
+    def median(self):
+        """
+        Same result as statistics.median over the readings
+        :return: Union[int, float]
+        """
+        n = self.count
+        if n == 0:
+            raise StatisticsError('no median for empty data')
+        if n % 2 == 1:
+            return self.nth(n // 2)
+        return (self.nth(n // 2 - 1) + self.nth(n // 2)) / 2
+
+    def quantiles(self, n=4):
+        """
+        Same result as statistics.quantiles(readings, n=n) with the default
+        exclusive method
+        :return: list of n - 1 cut points
+        """
+        ld = self.count
+        if ld < 2:
+            raise StatisticsError('must have at least two data points')
+        m = ld + 1
+        result = []
+        for i in range(1, n):
+            j = i * m // n
+            j = 1 if j < 1 else ld - 1 if j > ld - 1 else j
+            delta = i * m - j * n
+            result.append((self.nth(j - 1) * (n - delta) + self.nth(j) * delta) / n)
+        return result
+
+    def quantile(self, q):
+        """
+        Cut point below which a `q` fraction of the readings fall, with the
+        same exclusive method as quantiles, so quantile(i / n) is the i-th
+        of quantiles(n)
+        :param q: fraction in (0, 1)
+        :return: float
+        """
+        ld = self.count
+        if ld < 2:
+            raise StatisticsError('must have at least two data points')
+        # Rounded so that e.g. 0.29 * 100 lands on 29, not just below it
+        position = round(q * (ld + 1), 9)
+        j = int(position)
+        j = 1 if j < 1 else ld - 1 if j > ld - 1 else j
+        delta = position - j
+        return self.nth(j - 1) * (1 - delta) + self.nth(j) * delta
+
+
+def query_histogram(conn, device_uuid, filters):
+    """
+    Builds the histogram of a device's readings matching the filters. The
+    counting is a GROUP BY in SQLite, so at most 101 rows come back however
+    many readings match.
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :return: Histogram
+    """
+    sql, params = build_sql(HISTOGRAM_SELECTION, filters, [device_uuid])
+    sql += 'GROUP BY value'
+    histogram = Histogram()
+    for value, count, first_seen in conn.execute(sql, params):
+        histogram.add(value, count, first_seen)
+    return histogram
+
+
+# Statistics a Histogram can answer for the stats endpoint
+METRICS = ('count', 'max', 'min', 'mean', 'median', 'mode', 'q1', 'q3')
+
+
+def histogram_metrics(histogram, metrics=METRICS):
+    """
+    Computes any of METRICS from one histogram, rounded the way the single
+    metric endpoints round them. Metrics that need more readings than there
+    are come back as None.
+    :param histogram: Histogram
+    :param metrics: names from METRICS
+    :return: dict
+    """
+    count = histogram.count
+    quartiles = None
+    result = {}
+    for metric in metrics:
+        if metric == 'count':
+            result[metric] = count
+        elif metric == 'max':
+            result[metric] = histogram.max
+        elif metric == 'min':
+            result[metric] = histogram.min
+        elif metric == 'mean':
+            result[metric] = int(histogram.total / count) if count else None
+        elif metric == 'median':
+            result[metric] = int(histogram.median()) if count else None
+        elif metric == 'mode':
+            result[metric] = histogram.mode() if count else None
+        elif metric in ('q1', 'q3'):
+            if quartiles is None:
+                quartiles = [int(q) for q in histogram.quantiles()] if count >= 2 else [None] * 3
+            result[metric] = quartiles[0] if metric == 'q1' else quartiles[2]
+        else:
+            raise ValueError(f'Unknown metric {metric!r}')
+    return result
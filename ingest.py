@@ -0,0 +1,302 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from db import get_pool, get_pools, get_shard_path
+from ingest_log import UPDATE_POSITION_SQL, IngestLog
+from schema import roll_up
+
+INSERT_READING_SQL = 'insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)'
+# Most committed rowid ranges a writer remembers for committed_rowids
+MAX_COMMITTED_RANGES = 1024
+
+
+class IngestQueueFull(Exception):
+    """
+    Raised when the writer already holds as many uncommitted rows as it may
+    """
+
+
+class _Submission:
+    """
+    A group of validated rows handed to the writer by one request
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.sequence = None
+
+
+class GroupCommitWriter:
+    """
+    Background writer that combines the inserts of concurrent requests into
+    a single executemany transaction, which also adds the batch to the
+    rollup tables (see schema.roll_up).
+
+    A batch is committed once `window` seconds have passed since its first
+    row arrived or once it holds `max_rows` rows, whichever comes first, so
+    many requests share one commit (and one fsync) instead of paying for
+    their own.
+
+    `connect` is an optional factory for the writer's own connection, used
+    to give it the same configuration as the pooled ones.
+
+    At most `max_pending` rows wait to be committed at any time; past that
+    submissions are refused with IngestQueueFull rather than piling up, so
+    a burst is pushed back to the clients instead of into memory.
+
+    With an IngestLog every submission is appended to it before it is
+    queued, and `submit` only returns once the record is as durable as the
+    log's mode promises, so rows acknowledged before their commit are
+    replayed after a crash (see ingest_log.py).
+    """
+
+    def __init__(self, database, window=0.005, max_rows=1000, connect=None, max_pending=None, log=None):
+        self.database = database
+        self.log = log
+        self._connect = connect
+        self.window = window
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.batches_committed = 0
+        self.rows_committed = 0
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._rejected = 0
+        self._drained = 0
+        self._drain_time = 0.0
+        self._drain_max = 0.0
+        self._committed = deque(maxlen=MAX_COMMITTED_RANGES)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f'group-commit-{database}', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """
+        Queues rows for the next group commit
+        Raises IngestQueueFull if they would take the writer past max_pending rows
+        :param rows: list of (device_uuid, type, value, date_created) tuples
+        :return: Future resolving to the number of rows inserted
+        """
+        submission = _Submission(list(rows))
+        if not submission.rows:
+            submission.future.set_result(0)
+            return submission.future
+        with self._lock:
+            if self.max_pending is not None and self._pending + len(submission.rows) > self.max_pending:
+                self._rejected += 1
+                raise IngestQueueFull(f'{self._pending} rows are already waiting for {self.database}')
+            self._pending += len(submission.rows)
+            if self.log is not None:
+                # Under the lock so that records are applied in log order
+                submission.sequence = self.log.append(submission.rows)
+            self._queue.put(submission)
+        if self.log is not None:
+            self.log.wait(submission.sequence)
+        return submission.future
+
+    def write(self, rows, timeout=None):
+        """
+        Queues rows and blocks until the transaction holding them is committed
+        :param rows: list of (device_uuid, type, value, date_created) tuples
+        :param timeout: seconds to wait for the commit
+        :return: int
+        """
+        return self.submit(rows).result(timeout)
+
+    def stats(self):
+        """
+        Returns counters for the writer: rows waiting to be committed, commits,
+        refused submissions and the time from submission to commit
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'database': self.database,
+                'pending_rows': self._pending,
+                'max_pending_rows': self.max_pending,
+                'batches_committed': self.batches_committed,
+                'rows_committed': self.rows_committed,
+                'rejected': self._rejected,
+                'drain_latency_mean': self._drain_time / self._drained if self._drained else None,
+                'drain_latency_max': self._drain_max,
+                'log': None if self.log is None else self.log.stats()
+            }
+
+    def committed_rowids(self):
+        """
+        Returns and forgets the rowid ranges of the batches committed since
+        the last call, the oldest MAX_COMMITTED_RANGES of them only
+        :return: list of (first, last) rowids
+        """
+        with self._lock:
+            ranges = list(self._committed)
+            self._committed.clear()
+            return ranges
+
+    def close(self):
+        """
+        Flushes anything still queued and stops the writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """
+        Blocks for the first submission, then keeps collecting until the
+        window closes or the batch is full
+        :return: (list of submissions, bool stop requested)
+        """
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        size = len(first.rows)
+        deadline = time.monotonic() + self.window
+        while size < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                submission = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if submission is None:
+                return batch, True
+            batch.append(submission)
+            size += len(submission.rows)
+        return batch, False
+
+    def _flush(self, conn, batch):
+        rows = [row for submission in batch for row in submission.rows]
+        try:
+            with conn:
+                conn.executemany(INSERT_READING_SQL, rows)
+                # New rowids follow on from the largest, so the batch is the last len(rows) of them
+                last_rowid = conn.execute('select MAX(rowid) from readings').fetchone()[0]
+                roll_up(conn)
+                if self.log is not None:
+                    conn.execute(UPDATE_POSITION_SQL, (self.log.name, batch[-1].sequence))
+        except Exception as exc:
+            # Whatever went wrong, fail this batch and keep the writer running
+            # for the next one rather than leaving every caller waiting
+            with self._lock:
+                self._pending -= len(rows)
+            for submission in batch:
+                submission.future.set_exception(exc)
+            return
+        finished = time.monotonic()
+        with self._lock:
+            self._pending -= len(rows)
+            self.batches_committed += 1
+            self.rows_committed += len(rows)
+            self._committed.append((last_rowid - len(rows) + 1, last_rowid))
+            for submission in batch:
+                latency = finished - submission.submitted
+                self._drained += 1
+                self._drain_time += latency
+                self._drain_max = max(self._drain_max, latency)
+        for submission in batch:
+            submission.future.set_result(len(submission.rows))
+        if self.log is not None:
+            self.log.truncate(batch[-1].sequence)
+
+    def _run(self):
+        conn = self._connect() if self._connect else sqlite3.connect(self.database)
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._collect()
+                if batch:
+                    self._flush(conn, batch)
+        finally:
+            if self.log is not None:
+                self.log.close(conn)
+            conn.close()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _get_writer(app, database, pool):
+    with _writers_lock:
+        writer = _writers.get(database)
+        if writer is None:
+            log = None
+            if app.config['INGEST_LOG_DURABILITY'] != 'off':
+                log = IngestLog(database,
+                                durability=app.config['INGEST_LOG_DURABILITY'],
+                                fsync_window=app.config['INGEST_LOG_FSYNC_WINDOW'],
+                                fsync_bytes=app.config['INGEST_LOG_FSYNC_BYTES'])
+            writer = GroupCommitWriter(database,
+                                       window=app.config['GROUP_COMMIT_WINDOW'],
+                                       max_rows=app.config['GROUP_COMMIT_MAX_ROWS'],
+                                       connect=pool.connect,
+                                       max_pending=app.config['INGEST_MAX_PENDING_ROWS'],
+                                       log=log)
+            _writers[database] = writer
+        return writer
+
+
+def close_writers():
+    """
+    Flushes and stops every writer started by this process, e.g. before a
+    worker exits so that queued readings are not lost
+    """
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+def _forget_writers():
+    # The writer threads do not survive fork and their connections must not
+    # be used by the child, which starts writers of its own
+    global _writers, _writers_lock
+    _inherited.append(_writers)
+    _writers = {}
+    _writers_lock = threading.Lock()
+
+
+_inherited = []
+os.register_at_fork(after_in_child=_forget_writers)
+
+
+def committed_rowids(database):
+    """
+    Returns and forgets the rowid ranges this process's writer committed to
+    a database since the last call, e.g. for a change feed to skip
+    :param database: path of the database
+    :return: list of (first, last) rowids
+    """
+    with _writers_lock:
+        writer = _writers.get(database)
+    return [] if writer is None else writer.committed_rowids()
+
+
+def get_writer(app, device_uuid=None):
+    """
+    Returns the group commit writer for the shard holding a device (see
+    get_shard_path), starting it on first use
+    :param app: Flask app
+    :param device_uuid: the device
+    :return: GroupCommitWriter
+    """
+    return _get_writer(app, get_shard_path(app, device_uuid), get_pool(app, device_uuid))
+
+
+def get_writers(app):
+    """
+    Returns the group commit writer of every shard
+    :param app: Flask app
+    :return: list of GroupCommitWriter
+    """
+    return [_get_writer(app, pool.database, pool) for pool in get_pools(app)]
@@ -0,0 +1,320 @@
+"""
+Append-only log of the readings handed to a group commit writer, so that
+readings acknowledged before they are committed survive a crash.
+
+Every process writing to a shard appends to a log of its own next to it,
+made of segment files `database.ingest-<id>.<segment>.log`, and holds an
+exclusive flock on each segment for as long as it keeps it. Each record is
+one submission's rows under a sequence number and a CRC; the writer commits
+the sequence number of the last record it applied in the same transaction
+as the rows (ingest_log_positions table), so replaying a log never inserts
+a reading twice. Once a segment grows past SEGMENT_BYTES the log moves on
+to a new one, and a segment is deleted as soon as its last record is
+applied, so the log stays small however long the process runs. Segments
+are locked before they are renamed into place, so they are never seen
+unlocked. When a process starts, every segment no running process holds a
+lock on is replayed from after its log's applied position and deleted.
+
+The log covers crashes only: a batch SQLite refuses to commit still fails
+its submissions the way it does without a log.
+
+How long a POST waits for its record to be on disk is the durability mode:
+* request -> fsync before every acknowledgement
+* group -> wait for an fsync shared by every record appended within
+    `fsync_window` seconds, or `fsync_bytes` of them
+* async -> acknowledge once the record is written; it is fsynced within
+    `fsync_window` seconds and survives the process crashing, but not the
+    machine
+"""
+import fcntl
+import glob
+import json
+import os
+import re
+import struct
+import threading
+import uuid
+import zlib
+
+# Sequence number, payload length and CRC32 of the payload of a record
+HEADER = struct.Struct('<QII')
+
+DURABILITY_MODES = ('request', 'group', 'async')
+
+# A log moves on to a new segment file once its current one is this big
+SEGMENT_BYTES = 4194304
+
+# Segment number of a segment file, which older versions did not have
+SEGMENT_SUFFIX = re.compile(r'\.\d+\.log$')
+
+UPDATE_POSITION_SQL = '''INSERT INTO ingest_log_positions (log, sequence) VALUES (?, ?)
+                         ON CONFLICT (log) DO UPDATE SET sequence = MAX(sequence, excluded.sequence)'''
+
+
+def log_paths(database):
+    """
+    Returns every ingest log of a database
+    :param database: path of the database
+    :return: list of str
+    """
+    stem, _ = os.path.splitext(database)
+    return sorted(glob.glob(f'{glob.escape(stem)}.ingest-*.log'))
+
+
+def log_name(path):
+    """
+    Returns the name the applied position of a log segment is kept under,
+    the same for every segment of a log
+    :param path: path of the segment
+    :return: str
+    """
+    return SEGMENT_SUFFIX.sub('.log', os.path.basename(path))
+
+
+class IngestLog:
+    """
+    The log of one process for one database, each of its segment files
+    locked for as long as the log holds it
+    """
+
+    def __init__(self, database, durability='group', fsync_window=0.002, fsync_bytes=1048576):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability {durability!r}, the modes are {", ".join(DURABILITY_MODES)}')
+        stem, _ = os.path.splitext(database)
+        self._stem = f'{stem}.ingest-{uuid.uuid4().hex}'
+        self.name = os.path.basename(f'{self._stem}.log')
+        self.durability = durability
+        self.fsync_window = fsync_window
+        self.fsync_bytes = fsync_bytes
+        self.sequence = 0
+        self._segment = 0
+        self._fd, self.path = self._open_segment()
+        # Segments moved on from, as (fd, path, last sequence), until their records are applied
+        self._sealed = []
+        # Held around every fsync and close of a segment, so no fd is closed under the syncer
+        self._fsync_lock = threading.Lock()
+        self._size = 0
+        self._synced = 0
+        self._unsynced_bytes = 0
+        self._fsyncs = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._syncer = None
+        if durability != 'request':
+            self._syncer = threading.Thread(target=self._sync_forever, name=f'ingest-log-{self.name}', daemon=True)
+            self._syncer.start()
+
+    def append(self, rows):
+        """
+        Writes a record of rows to the log, without waiting for it to reach
+        the disk. Records must be appended in the order they are applied.
+        :param rows: list of (device_uuid, type, value, date_created) tuples
+        :return: sequence number of the record
+        """
+        payload = json.dumps(rows, separators=(',', ':')).encode()
+        with self._condition:
+            self.sequence += 1
+            record = HEADER.pack(self.sequence, len(payload), zlib.crc32(payload)) + payload
+            os.write(self._fd, record)
+            self._size += len(record)
+            self._unsynced_bytes += len(record)
+            if self._unsynced_bytes >= self.fsync_bytes:
+                self._condition.notify_all()
+            return self.sequence
+
+    def wait(self, sequence):
+        """
+        Blocks until a record is as durable as the log's mode promises
+        :param sequence: sequence number returned by append
+        """
+        if self.durability == 'request':
+            with self._fsync_lock:
+                with self._condition:
+                    fd = self._fd
+                os.fsync(fd)
+            with self._condition:
+                self._fsyncs += 1
+                self._synced = max(self._synced, sequence)
+        elif self.durability == 'group':
+            with self._condition:
+                self._condition.notify_all()
+                while self._synced < sequence and not self._closed:
+                    self._condition.wait()
+
+    def truncate(self, applied):
+        """
+        Moves on to a new segment once the current one grew past
+        SEGMENT_BYTES, and deletes the segments every record of which was
+        applied. Deleting is never fsynced: a segment that comes back after
+        a crash is skipped by replay as already applied.
+        :param applied: sequence number of the last record committed
+        """
+        with self._condition:
+            if self._size < SEGMENT_BYTES and not (self._sealed and self._sealed[0][2] <= applied):
+                return
+        with self._fsync_lock, self._condition:
+            if self._size >= SEGMENT_BYTES:
+                # What the syncer has not fsynced yet is in the segment left behind
+                os.fsync(self._fd)
+                self._fsyncs += 1
+                self._synced = self.sequence
+                self._unsynced_bytes = 0
+                self._condition.notify_all()
+                self._sealed.append((self._fd, self.path, self.sequence))
+                self._segment += 1
+                self._fd, self.path = self._open_segment()
+                self._size = 0
+            while self._sealed and self._sealed[0][2] <= applied:
+                fd, path, _ = self._sealed.pop(0)
+                os.unlink(path)
+                os.close(fd)
+
+    def stats(self):
+        """
+        Returns counters for the log
+        :return: dict
+        """
+        with self._condition:
+            return {
+                'path': self.path,
+                'durability': self.durability,
+                'sequence': self.sequence,
+                'synced': self._synced,
+                'bytes': self._size,
+                'segments': len(self._sealed) + 1,
+                'fsyncs': self._fsyncs
+            }
+
+    def close(self, conn=None):
+        """
+        Stops syncing and closes the log. With the connection its records
+        were applied through, the file is deleted if all of them were.
+        :param conn: optional sqlite3 connection to the database
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._syncer is not None:
+            self._syncer.join()
+        segments = self._sealed + [(self._fd, self.path, self.sequence)]
+        if conn is not None and _applied(conn, self.name) >= self.sequence:
+            for _, path, _ in segments:
+                os.unlink(path)
+            with conn:
+                conn.execute('DELETE FROM ingest_log_positions WHERE log = ?', (self.name,))
+        else:
+            os.fsync(self._fd)
+        for fd, _, _ in segments:
+            os.close(fd)
+        self._sealed = []
+
+    def _open_segment(self):
+        """
+        Creates the next segment file and locks it. It is created under a
+        name replay_logs does not look at and only renamed into place once
+        locked, so a process starting meanwhile cannot replay it as a dead
+        process's log.
+        :return: (fd, path)
+        """
+        path = f'{self._stem}.{self._segment:06d}.log'
+        temporary = f'{path}.tmp'
+        fd = os.open(temporary, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temporary, path)
+        # The file itself has to survive a crash too, not only what is written to it
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return fd, path
+
+    def _sync_forever(self):
+        while True:
+            with self._condition:
+                while self._synced == self.sequence and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    break
+                # Let more records join this fsync, up to the window or fsync_bytes
+                self._condition.wait_for(lambda: self._closed or self._unsynced_bytes >= self.fsync_bytes,
+                                         self.fsync_window)
+                target = self.sequence
+                self._unsynced_bytes = 0
+            with self._fsync_lock:
+                with self._condition:
+                    # A segment moved on from meanwhile was fsynced when it was
+                    fd = self._fd
+                os.fsync(fd)
+            with self._condition:
+                self._fsyncs += 1
+                self._synced = max(self._synced, target)
+                self._condition.notify_all()
+
+
+def read_records(path):
+    """
+    Reads the whole records of a log, stopping at a torn or corrupt tail
+    :param path: path of the log
+    :return: generator of (sequence, rows)
+    """
+    with open(path, 'rb') as log:
+        data = log.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        sequence, length, crc = HEADER.unpack_from(data, offset)
+        payload = data[offset + HEADER.size:offset + HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        yield sequence, [tuple(row) for row in json.loads(payload)]
+        offset += HEADER.size + length
+
+
+def replay_logs(conn, database, insert_sql):
+    """
+    Applies whatever was not applied yet of the logs no running process
+    holds, then deletes them
+    :param conn: sqlite3 connection to the database
+    :param database: path of the database
+    :param insert_sql: statement inserting one (device_uuid, type, value, date_created) row
+    :return: number of rows replayed
+    """
+    replayed = 0
+    for path in log_paths(database):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Its process is still running
+                continue
+            try:
+                if os.stat(path).st_ino != os.fstat(fd).st_ino:
+                    continue
+            except FileNotFoundError:
+                # Another process replayed it while we waited
+                continue
+            name = log_name(path)
+            applied = _applied(conn, name)
+            with conn:
+                for sequence, rows in read_records(path):
+                    if sequence > applied:
+                        conn.executemany(insert_sql, rows)
+                        conn.execute(UPDATE_POSITION_SQL, (name, sequence))
+                        replayed += len(rows)
+            os.unlink(path)
+            # Later segments of the log still need its position
+            if not any(log_name(other) == name for other in log_paths(database)):
+                with conn:
+                    conn.execute('DELETE FROM ingest_log_positions WHERE log = ?', (name,))
+        finally:
+            os.close(fd)
+    return replayed
+
+
+def _applied(conn, name):
+    row = conn.execute('select sequence from ingest_log_positions where log = ?', (name,)).fetchone()
+    return row[0] if row else 0
@@ -0,0 +1,70 @@
+"""
+Last value of every device, served from the device_latest table.
+
+The readings_latest trigger keeps the newest reading by date_created of
+every device and type, so a reading arriving late with an older date never
+replaces a newer one. What a device reads now is then a primary key lookup,
+and finding the devices that went silent reads one row per device and type
+instead of the readings table.
+"""
+from partitions import EVERY_READING, archived_readings_table
+
+LATEST_SELECTION = 'select type, value, date_created from device_latest where device_uuid = ? '
+SILENT_SELECTION = 'select device_uuid, MAX(date_created) from device_latest where 1=1 '
+
+
+def load_latest(conn, device_uuid, sensor_type=None):
+    """
+    Returns the newest reading of each type of a device
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param sensor_type: only this type
+    :return: dict with the device, when it last reported and the newest reading per type
+    """
+    sql = LATEST_SELECTION
+    params = [device_uuid]
+    if sensor_type:
+        sql += 'AND type = ? '
+        params.append(sensor_type)
+    readings = {row[0]: {'value': row[1], 'date_created': row[2]} for row in conn.execute(sql, params)}
+    return {
+        'device_uuid': device_uuid,
+        'last_reported': max((reading['date_created'] for reading in readings.values()), default=None),
+        'readings': readings
+    }
+
+
+def silent_devices(conn, before, sensor_type=None):
+    """
+    Returns the devices whose newest reading is older than `before`
+    :param conn: sqlite3 connection
+    :param before: epoch second
+    :param sensor_type: only look at readings of this type
+    :return: list of (device_uuid, last_reported), the longest silent first
+    """
+    sql = SILENT_SELECTION
+    params = []
+    if sensor_type:
+        sql += 'AND type = ? '
+        params.append(sensor_type)
+    sql += 'GROUP BY device_uuid HAVING MAX(date_created) < ? ORDER BY MAX(date_created), device_uuid'
+    params.append(before)
+    return [(row[0], row[1]) for row in conn.execute(sql, params)]
+
+
+def rebuild_latest(conn):
+    """
+    Recomputes device_latest from the readings table and the archives, e.g.
+    to backfill it for readings stored before the trigger existed
+    :param conn: sqlite3 connection
+    """
+    with conn, archived_readings_table(conn):
+        conn.execute('DELETE FROM device_latest')
+        conn.execute(f'''INSERT INTO device_latest (device_uuid, type, value, date_created, reading_rowid)
+                         SELECT device_uuid, type, value, date_created, rowid FROM (
+                             SELECT device_uuid, type, value, date_created, rowid, ROW_NUMBER() OVER (
+                                 PARTITION BY device_uuid, type ORDER BY date_created DESC, rowid DESC) AS newest
+                             FROM {EVERY_READING}
+                             WHERE device_uuid IS NOT NULL AND type IS NOT NULL AND value IS NOT NULL
+                                 AND date_created IS NOT NULL)
+                         WHERE newest = 1''')
@@ -0,0 +1,411 @@
+"""
+Per request instrumentation of the hot path.
+
+Each request carries a RequestTimings in a context variable, and the code
+on the hot path adds the seconds it spends to it by phase:
+
+* acquire -> checking a connection out of the pool (handle_database_connection)
+* build -> building SQL (utils.build_sql)
+* execute -> running statements, through the pool's InstrumentedConnection
+* fetch -> stepping through result rows, which are counted too
+* serialize -> encoding JSON responses (jsonify below)
+* aggregate -> whatever else the request spent, i.e. the Python work on the rows
+
+When the request ends its duration and phases go into per route latency
+histograms, rendered in the Prometheus text format by /metrics. Outside a
+request, e.g. on the ingest writer's thread, the context variable is unset
+and the instrumented calls cost one lookup.
+
+Opt-in, a sampling profiler thread snapshots the stack of every request in
+flight every PROFILER_INTERVAL seconds, and the requests that end up slower
+than SLOW_REQUEST_SECONDS keep their most common stacks for
+/stats/slow-requests/.
+"""
+import contextvars
+import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from functools import wraps
+
+from flask import request
+from flask.json import jsonify as flask_jsonify
+
+PHASES = ('acquire', 'build', 'execute', 'fetch', 'aggregate', 'serialize')
+
+# Upper bounds of the histogram buckets, seconds and rows
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Deepest stack and most stacks kept per slow request
+PROFILE_DEPTH = 40
+PROFILE_STACKS = 20
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    Seconds spent by one request in each phase, and the SQL it ran
+    """
+    __slots__ = ('started', 'phases', 'queries', 'rows', 'samples')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.rows = 0
+        self.samples = None
+
+
+def record_phase(phase, seconds):
+    """
+    Adds seconds to a phase of the current request, if any
+    :param phase: one of PHASES
+    :param seconds: float
+    """
+    timings = _current.get()
+    if timings is not None:
+        timings.phases[phase] += seconds
+
+
+def timed(phase):
+    """
+    Decorator adding the time spent in a function to a phase of the current request
+    :param phase: one of PHASES
+    :return:
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _current.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            began = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.phases[phase] += time.perf_counter() - began
+        return wrapper
+    return decorator
+
+
+jsonify = timed('serialize')(flask_jsonify)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor recording statement and fetch times, and rows fetched, on the current request
+    """
+
+    def execute(self, sql, parameters=()):
+        timings = _current.get()
+        if timings is None:
+            return super().execute(sql, parameters)
+        began = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            timings.phases['execute'] += time.perf_counter() - began
+            timings.queries += 1
+
+    def _fetch(self, fetch, *args):
+        timings = _current.get()
+        if timings is None:
+            return fetch(*args)
+        began = time.perf_counter()
+        rows = fetch(*args)
+        timings.phases['fetch'] += time.perf_counter() - began
+        timings.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchone(self):
+        timings = _current.get()
+        if timings is None:
+            return super().fetchone()
+        began = time.perf_counter()
+        row = super().fetchone()
+        timings.phases['fetch'] += time.perf_counter() - began
+        timings.rows += row is not None
+        return row
+
+    def __next__(self):
+        timings = _current.get()
+        if timings is None:
+            return super().__next__()
+        began = time.perf_counter()
+        try:
+            row = super().__next__()
+        finally:
+            timings.phases['fetch'] += time.perf_counter() - began
+        timings.rows += 1
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, including the ones behind execute, are InstrumentedCursors
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+class BucketHistogram:
+    """
+    Cumulative bucket counts, sum and count of observed values
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """
+        Returns the histogram in the Prometheus text format
+        :param name: metric name
+        :param labels: label string, e.g. 'route="/x/",method="GET"'
+        :return: list of str
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    """
+    Per route request counters and latency, phase and row histograms
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._latency = {}
+        self._phases = {}
+        self._rows = {}
+        self._queries = Counter()
+
+    def record(self, route, method, status, timings, duration):
+        """
+        Adds a finished request
+        :param route: URL rule of the request
+        :param method: HTTP method
+        :param status: response status code
+        :param timings: RequestTimings of the request
+        :param duration: seconds the request took
+        """
+        timings.phases['aggregate'] = max(0.0, duration - sum(timings.phases.values()))
+        with self._lock:
+            self._requests[route, method, status] += 1
+            self._histogram(self._latency, (route, method), LATENCY_BUCKETS).observe(duration)
+            for phase, seconds in timings.phases.items():
+                self._histogram(self._phases, (route, phase), LATENCY_BUCKETS).observe(seconds)
+            self._histogram(self._rows, (route,), ROWS_BUCKETS).observe(timings.rows)
+            self._queries[route] += timings.queries
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+        :return: str
+        """
+        with self._lock:
+            lines = ['# HELP http_requests_total Requests by route, method and status.',
+                     '# TYPE http_requests_total counter']
+            for (route, method, status), count in sorted(self._requests.items()):
+                lines.append(f'http_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} '
+                             f'{count}')
+
+            lines += ['# HELP http_request_duration_seconds Time from the start of a request to its response.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for (route, method), histogram in sorted(self._latency.items()):
+                lines += histogram.lines('http_request_duration_seconds', f'route="{_label(route)}",method="{method}"')
+
+            lines += ['# HELP http_request_phase_seconds Time a request spent in each phase of the hot path.',
+                      '# TYPE http_request_phase_seconds histogram']
+            for (route, phase), histogram in sorted(self._phases.items()):
+                lines += histogram.lines('http_request_phase_seconds', f'route="{_label(route)}",phase="{phase}"')
+
+            lines += ['# HELP http_request_sql_rows Rows fetched from SQLite by a request.',
+                      '# TYPE http_request_sql_rows histogram']
+            for (route,), histogram in sorted(self._rows.items()):
+                lines += histogram.lines('http_request_sql_rows', f'route="{_label(route)}"')
+
+            lines += ['# HELP http_request_sql_queries_total Statements run by requests.',
+                      '# TYPE http_request_sql_queries_total counter']
+            for route, count in sorted(self._queries.items()):
+                lines.append(f'http_request_sql_queries_total{{route="{_label(route)}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = BucketHistogram(buckets)
+        return histogram
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler of the requests in flight, keeping the most common
+    stacks of the last `keep` requests that took at least `threshold` seconds
+    """
+
+    def __init__(self, threshold=1.0, interval=0.005, keep=20):
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}
+        self._profiles = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._sample, name='slow-request-profiler', daemon=True)
+        self._thread.start()
+
+    def start(self, timings):
+        timings.samples = Counter()
+        with self._lock:
+            self._active[threading.get_ident()] = timings
+
+    def stop(self, timings, route, method, duration):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        if duration < self.threshold or timings.samples is None:
+            return
+        profile = {
+            'route': route,
+            'method': method,
+            'duration': duration,
+            'phases': dict(timings.phases),
+            'samples': sum(timings.samples.values()),
+            'stacks': [{'stack': stack, 'samples': count} for stack, count in timings.samples.most_common(PROFILE_STACKS)]
+        }
+        with self._lock:
+            self._profiles.append(profile)
+
+    def profiles(self):
+        """
+        Returns the profiles of the most recent slow requests, newest first
+        :return: list of dicts
+        """
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, timings in active:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                    frame = frame.f_back
+                if stack:
+                    stacks.append((thread_id, timings, ';'.join(reversed(stack))))
+            del frames
+            # Only requests still in flight, stop reads the samples once it
+            # has taken its request out
+            with self._lock:
+                for thread_id, timings, stack in stacks:
+                    if self._active.get(thread_id) is timings:
+                        timings.samples[stack] += 1
+
+
+def instrument(app):
+    """
+    Records the requests of an app in its RequestMetrics, and profiles them
+    when SLOW_REQUEST_PROFILING is on
+    :param app: Flask app
+    """
+    metrics = app.extensions['request_metrics'] = RequestMetrics()
+    profiler_lock = threading.Lock()
+
+    def get_profiler():
+        with profiler_lock:
+            profiler = app.extensions.get('slow_request_profiler')
+            if profiler is None:
+                profiler = SlowRequestProfiler(app.config['SLOW_REQUEST_SECONDS'], app.config['PROFILER_INTERVAL'])
+                app.extensions['slow_request_profiler'] = profiler
+            return profiler
+
+    @app.before_request
+    def start_timings():
+        if not app.config['METRICS_ENABLED']:
+            return
+        timings = RequestTimings()
+        _current.set(timings)
+        if app.config['SLOW_REQUEST_PROFILING']:
+            get_profiler().start(timings)
+
+    @app.after_request
+    def record_timings(response):
+        timings = _current.get()
+        if timings is None:
+            return response
+        duration = time.perf_counter() - timings.started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.record(route, request.method, response.status_code, timings, duration)
+        if timings.samples is not None:
+            get_profiler().stop(timings, route, request.method, duration)
+        _current.set(None)
+        return response
+
+    @app.teardown_request
+    def reset_timings(error=None):
+        timings = _current.get()
+        if timings is not None and timings.samples is not None:
+            # The request failed before after_request could stop profiling it
+            get_profiler().stop(timings, None, None, 0.0)
+        _current.set(None)
+
+
+def get_metrics(app):
+    """
+    Returns the RequestMetrics of an instrumented app
+    :param app: Flask app
+    :return: RequestMetrics
+    """
+    return app.extensions['request_metrics']
+
+
+def slow_request_profiles(app):
+    """
+    Returns the profiles of the app's most recent slow requests, empty unless
+    SLOW_REQUEST_PROFILING was ever on
+    :param app: Flask app
+    :return: list of dicts
+    """
+    profiler = app.extensions.get('slow_request_profiler')
+    return profiler.profiles() if profiler is not None else []
@@ -0,0 +1,418 @@
+"""
+Time partitions of the readings table: archival and retention.
+
+Readings are grouped in fixed windows of `window` seconds (a whole number
+of days) of their date_created. Once a window has gone cold its raw readings
+can be moved out of the readings table into a read-only archive file of
+their own, next to the database, which keeps one compressed block of
+columns per device and type. The aggregate and rollup tables keep counting
+archived readings, and the raw edges of metric queries read the archives of
+the windows they overlap (see rollups.range_histogram), so metrics stay
+exact. Raw listings and series merge in the readings of the archives their
+range overlaps (archived_readings), and date filtered summaries are built
+from the rollups and raw edges like metrics are.
+
+Retention drops whole windows: archive files are deleted, along with their
+rollups and any readings left in the table, the per device aggregates are
+recomputed from the day rollups that remain, and so is the latest reading
+of every device whose latest reading was dropped.
+
+Moving readings out of, or dropping them from, the readings table takes one
+DELETE per window, driven through the device index by the device_summaries
+subquery below, rather than one per device.
+"""
+import heapq
+import os
+import sqlite3
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from itertools import repeat
+
+from histogram import Histogram
+from schema import ROLLUP_GRANULARITIES, reset_rollup_position, roll_up
+from utils import MAX_INTEGER, MIN_INTEGER, SENSOR_TYPES
+
+ARCHIVE_SCHEMA = '''CREATE TABLE IF NOT EXISTS blocks (
+    device_uuid TEXT, type TEXT, first_date INTEGER, last_date INTEGER, readings_count INTEGER,
+    dates BLOB, value_bytes BLOB, rowids BLOB, PRIMARY KEY (device_uuid, type)) WITHOUT ROWID'''
+ARCHIVED_SELECTION = ('select window_start, path from archived_partitions '
+                      'where window_end > ? AND window_start <= ? ORDER BY window_start')
+BLOCKS_SELECTION = 'select device_uuid, type, dates, value_bytes, rowids from blocks where last_date >= ? AND first_date <= ? '
+# Every reading, live or archived, while archived_readings_table is open.
+# The temp table's rowid column holds the readings' original rowids.
+EVERY_READING = ('(SELECT device_uuid, type, value, date_created, rowid FROM main.readings UNION ALL '
+                 'SELECT device_uuid, type, value, date_created, rowid FROM temp.archived_readings)')
+# Every reading of every device with readings in a date range, through the
+# (device_uuid, type, date_created) index, see rollups.EVERY_DEVICE
+WINDOW_CONDITION = (f'device_uuid IN (select device_uuid from device_summaries) '
+                    f'AND type IN ({", ".join("?" * len(SENSOR_TYPES))}) AND date_created >= ? AND date_created < ?')
+
+
+def encode_deltas(numbers):
+    """
+    Compresses integers as zlib'd differences between neighbours, which
+    stay small for sorted dates and rowids
+    :param numbers: list of int
+    :return: bytes
+    """
+    return zlib.compress(array('q', [b - a for a, b in zip([0] + numbers, numbers)]).tobytes())
+
+
+def decode_deltas(blob):
+    """
+    Inverse of encode_deltas
+    :param blob: bytes
+    :return: list of int
+    """
+    deltas = array('q')
+    deltas.frombytes(zlib.decompress(blob))
+    numbers = []
+    total = 0
+    for delta in deltas:
+        total += delta
+        numbers.append(total)
+    return numbers
+
+
+def archive_path(database, window_start):
+    """
+    Returns the archive file of a window of a database
+    :param database: path of the database
+    :param window_start: first epoch second of the window
+    :return: str
+    """
+    stem, extension = os.path.splitext(database)
+    return f'{stem}.archive-{window_start}{extension}'
+
+
+def _main_directory(conn):
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return os.path.dirname(path)
+    return ''
+
+
+def _device_types(conn):
+    return conn.execute('select device_uuid, type from device_summaries ORDER BY device_uuid, type').fetchall()
+
+
+def archive_partitions(conn, database, before, window=604800):
+    """
+    Moves the readings of every whole window ending at or before `before`
+    into that window's archive file. Windows already archived are left alone,
+    so readings arriving late for them stay in the readings table.
+    :param conn: sqlite3 connection to the database
+    :param database: path of the database, archive files are named after it
+    :param before: epoch second no archived window may end after
+    :param window: window width in seconds
+    :return: list of archived window starts
+    """
+    first = conn.execute('select MIN(date_created) from readings').fetchone()[0]
+    if first is None:
+        return []
+    archived = {row[0] for row in conn.execute('select window_start from archived_partitions')}
+    device_types = _device_types(conn)
+
+    done = []
+    for window_start in range(first // window * window, before // window * window, window):
+        if window_start in archived:
+            continue
+        window_end = window_start + window
+        path = archive_path(database, window_start)
+        if os.path.exists(path):
+            # Left over from a run that stopped before recording the window
+            os.remove(path)
+
+        archive = sqlite3.connect(path)
+        archive.execute(ARCHIVE_SCHEMA)
+        count = 0
+        for device_uuid, sensor_type in device_types:
+            rows = conn.execute('select rowid, date_created, value from readings '
+                                'where device_uuid = ? AND type = ? AND date_created >= ? AND date_created < ? '
+                                'ORDER BY date_created, rowid',
+                                (device_uuid, sensor_type, window_start, window_end)).fetchall()
+            if not rows:
+                continue
+            dates = [row[1] for row in rows]
+            archive.execute('insert into blocks VALUES (?,?,?,?,?,?,?,?)', (
+                device_uuid, sensor_type, dates[0], dates[-1], len(rows), encode_deltas(dates),
+                zlib.compress(bytes(row[2] for row in rows)), encode_deltas([row[0] for row in rows])))
+            count += len(rows)
+        archive.commit()
+        archive.close()
+        if not count:
+            os.remove(path)
+            continue
+
+        with conn:
+            # The rollups keep counting archived readings, so they must hold them first
+            roll_up(conn)
+            conn.execute(f'delete from readings where {WINDOW_CONDITION}', (*SENSOR_TYPES, window_start, window_end))
+            reset_rollup_position(conn)
+            conn.execute('insert into archived_partitions VALUES (?,?,?,?)',
+                         (window_start, window_end, os.path.basename(path), count))
+        done.append(window_start)
+    return done
+
+
+def archived_blocks(conn, device_uuid, start=None, end=None, sensor_type=None):
+    """
+    Generates the archived columns of a device, only opening the archives of
+    windows that overlap [start, end]. Blocks are whole, so they can hold
+    readings outside the range.
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param start: first epoch second, or None
+    :param end: last epoch second, or None
+    :param sensor_type: only blocks of this type
+    :return: generator of (type, dates, values, rowids) with dates ascending
+    """
+    for _, block_type, dates, values, rowids in archived_device_blocks(conn, [device_uuid], start, end, sensor_type):
+        yield block_type, dates, values, rowids
+
+
+def archived_device_blocks(conn, device_uuids, start=None, end=None, sensor_type=None):
+    """
+    Like archived_blocks for several devices at once, reading each archive
+    with one query whatever the number of devices
+    :param conn: sqlite3 connection
+    :param device_uuids: list of devices, or None for every device
+    :param start: first epoch second, or None
+    :param end: last epoch second, or None
+    :param sensor_type: only blocks of this type
+    :return: generator of (device_uuid, type, dates, values, rowids) with dates ascending
+    """
+    start = start if start is not None else MIN_INTEGER
+    end = end if end is not None else MAX_INTEGER
+    partitions = conn.execute(ARCHIVED_SELECTION, (start, end)).fetchall()
+    if not partitions or device_uuids == []:
+        return
+
+    directory = _main_directory(conn)
+    sql = BLOCKS_SELECTION
+    params = [start, end]
+    if device_uuids is not None:
+        sql += f'AND device_uuid IN ({", ".join("?" * len(device_uuids))}) '
+        params.extend(device_uuids)
+    if sensor_type:
+        sql += 'AND type = ? '
+        params.append(sensor_type)
+    for _, path in partitions:
+        archive = sqlite3.connect(f'file:{os.path.join(directory, path)}?mode=ro', uri=True)
+        try:
+            for device_uuid, block_type, dates_blob, values_blob, rowids_blob in archive.execute(sql, params).fetchall():
+                yield device_uuid, block_type, decode_deltas(dates_blob), zlib.decompress(values_blob), \
+                    decode_deltas(rowids_blob)
+        finally:
+            archive.close()
+
+
+def archived_histograms(conn, device_uuids, filters):
+    """
+    Histograms of several devices' archived readings matching the filters
+    :param conn: sqlite3 connection
+    :param device_uuids: list of devices, or None for every device with archived readings
+    :param filters: QueryFilters
+    :return: dict of device_uuid to Histogram
+    """
+    histograms = {device_uuid: Histogram() for device_uuid in device_uuids or ()}
+    start = filters.start if filters.start is not None else MIN_INTEGER
+    end = filters.end if filters.end is not None else MAX_INTEGER
+    for device_uuid, _, dates, values, rowids in archived_device_blocks(conn, device_uuids, start, end,
+                                                                        filters.sensor_type):
+        histogram = histograms.setdefault(device_uuid, Histogram())
+        for index in range(bisect_left(dates, start), bisect_right(dates, end)):
+            histogram.add(values[index], 1, rowids[index])
+    return histograms
+
+
+def archived_readings(conn, device_uuid, filters, after=None):
+    """
+    Generates a device's archived readings matching the filters in
+    (date_created, rowid) order, holding one window of them at a time
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :param after: optional (date_created, rowid) to start after
+    :return: generator of (rowid, device_uuid, type, value, date_created) rows
+    """
+    start = filters.start if filters.start is not None else MIN_INTEGER
+    end = filters.end if filters.end is not None else MAX_INTEGER
+    if after is not None:
+        start = max(start, after[0])
+    if start > end:
+        return
+    partitions = conn.execute(ARCHIVED_SELECTION, (start, end)).fetchall()
+    if not partitions:
+        return
+    directory = _main_directory(conn)
+    sql = BLOCKS_SELECTION + 'AND device_uuid = ? '
+    params = [start, end, device_uuid]
+    if filters.sensor_type:
+        sql += 'AND type = ? '
+        params.append(filters.sensor_type)
+    # Windows do not overlap, so their readings come one window after the other
+    for _, path in partitions:
+        archive = sqlite3.connect(f'file:{os.path.join(directory, path)}?mode=ro', uri=True)
+        try:
+            blocks = archive.execute(sql, params).fetchall()
+        finally:
+            archive.close()
+        window = []
+        for _, block_type, dates_blob, values_blob, rowids_blob in blocks:
+            dates = decode_deltas(dates_blob)
+            values = zlib.decompress(values_blob)
+            rowids = decode_deltas(rowids_blob)
+            window.append([(rowids[index], device_uuid, block_type, values[index], dates[index])
+                           for index in range(bisect_left(dates, start), bisect_right(dates, end))
+                           if after is None or (dates[index], rowids[index]) > after])
+        yield from heapq.merge(*window, key=lambda row: (row[4], row[0]))
+
+
+def archived_date_range(conn, device_uuid, sensor_type=None):
+    """
+    First and last date of a device's archived readings
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param sensor_type: only readings of this type
+    :return: (first, last), both None without archived readings
+    """
+    first = last = None
+    partitions = conn.execute(ARCHIVED_SELECTION, (MIN_INTEGER, MAX_INTEGER)).fetchall()
+    if not partitions:
+        return first, last
+    directory = _main_directory(conn)
+    sql = 'select MIN(first_date), MAX(last_date) from blocks where device_uuid = ? '
+    params = [device_uuid]
+    if sensor_type:
+        sql += 'AND type = ? '
+        params.append(sensor_type)
+    for _, path in partitions:
+        archive = sqlite3.connect(f'file:{os.path.join(directory, path)}?mode=ro', uri=True)
+        try:
+            window_first, window_last = archive.execute(sql, params).fetchone()
+        finally:
+            archive.close()
+        if window_first is not None:
+            first = window_first if first is None else min(first, window_first)
+            last = window_last if last is None else max(last, window_last)
+    return first, last
+
+
+def archived_fleet_histogram(conn, filters):
+    """
+    Histogram of every device's archived readings matching the filters
+    :param conn: sqlite3 connection
+    :param filters: QueryFilters
+    :return: Histogram
+    """
+    histogram = Histogram()
+    start = filters.start if filters.start is not None else MIN_INTEGER
+    end = filters.end if filters.end is not None else MAX_INTEGER
+    for _, _, dates, values, rowids in archived_device_blocks(conn, None, start, end, filters.sensor_type):
+        for index in range(bisect_left(dates, start), bisect_right(dates, end)):
+            histogram.add(values[index], 1, rowids[index])
+    return histogram
+
+
+@contextmanager
+def archived_readings_table(conn):
+    """
+    Copies every archived reading into the temp table archived_readings for
+    as long as the block runs, so that rebuilds can recompute from
+    EVERY_READING in SQL rather than from the readings table alone
+    :param conn: sqlite3 connection
+    :return: name of the temp table
+    """
+    conn.execute('DROP TABLE IF EXISTS temp.archived_readings')
+    conn.execute('CREATE TEMP TABLE archived_readings (device_uuid TEXT, type TEXT, value INTEGER, '
+                 'date_created INTEGER, rowid INTEGER)')
+    try:
+        for device_uuid, block_type, dates, values, rowids in archived_device_blocks(conn, None):
+            conn.executemany('INSERT INTO temp.archived_readings VALUES (?,?,?,?,?)',
+                             zip(repeat(device_uuid), repeat(block_type), values, dates, rowids))
+        yield 'temp.archived_readings'
+    finally:
+        conn.execute('DROP TABLE temp.archived_readings')
+
+
+def drop_partitions(conn, database, before, window=604800):
+    """
+    Drops every reading of the whole windows ending at or before `before`:
+    their archive files, rollups and anything still in the readings table.
+    The per device aggregates are then recomputed from the remaining day
+    rollups, and the latest reading of every device and type whose latest
+    reading was dropped from what remains.
+    :param conn: sqlite3 connection to the database
+    :param database: path of the database the archive files are named after
+    :param before: epoch second no dropped window may end after
+    :param window: window width in seconds
+    :return: epoch second everything before which was dropped
+    """
+    cutoff = before // window * window
+    directory = os.path.dirname(database)
+    with conn:
+        # The aggregates are recomputed from the rollups below
+        roll_up(conn)
+        conn.execute(f'delete from readings where {WINDOW_CONDITION}', (*SENSOR_TYPES, MIN_INTEGER, cutoff))
+        reset_rollup_position(conn)
+        for table in ('readings_rollups', 'readings_rollup_histograms'):
+            conn.execute(f'delete from {table} where device_uuid IN (select device_uuid from device_summaries) '
+                         f'AND type IN ({", ".join("?" * len(SENSOR_TYPES))}) '
+                         f'AND granularity IN ({", ".join("?" * len(ROLLUP_GRANULARITIES))}) AND bucket < ?',
+                         (*SENSOR_TYPES, *ROLLUP_GRANULARITIES, cutoff))
+        paths = [row[0] for row in conn.execute('select path from archived_partitions where window_end <= ?',
+                                                (cutoff,))]
+        conn.execute('delete from archived_partitions where window_end <= ?', (cutoff,))
+        _refresh_latest(conn, cutoff)
+
+        day = ROLLUP_GRANULARITIES[0]
+        conn.execute('DELETE FROM device_summaries')
+        conn.execute('DELETE FROM device_histograms')
+        conn.execute('''INSERT INTO device_summaries (device_uuid, type, readings_count, value_sum, value_max, value_min)
+                        SELECT device_uuid, type, SUM(readings_count), SUM(value_sum), MAX(value_max),
+                            MIN(value_min) FROM readings_rollups WHERE granularity = ?
+                        GROUP BY device_uuid, type''', (day,))
+        conn.execute('''INSERT INTO device_histograms (device_uuid, type, value, readings_count)
+                        SELECT device_uuid, type, value, SUM(readings_count) FROM readings_rollup_histograms
+                        WHERE granularity = ? GROUP BY device_uuid, type, value''', (day,))
+
+    # Only once the database no longer points at them
+    for path in paths:
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            os.remove(path)
+    return cutoff
+
+
+def _refresh_latest(conn, cutoff):
+    """
+    Replaces the device_latest rows of readings dated before `cutoff`, which
+    were just dropped, with the newest reading left in the readings table
+    or the archives, if any
+    """
+    stale = conn.execute('select device_uuid, type from device_latest where date_created < ?', (cutoff,)).fetchall()
+    conn.execute('delete from device_latest where date_created < ?', (cutoff,))
+    newest = {}
+    for device_uuid, sensor_type in stale:
+        row = conn.execute('select value, date_created, rowid from readings where device_uuid = ? AND type = ? '
+                           'ORDER BY date_created DESC, rowid DESC LIMIT 1', (device_uuid, sensor_type)).fetchone()
+        if row is not None:
+            newest[(device_uuid, sensor_type)] = row
+    stale = set(stale)
+    devices = sorted({device_uuid for device_uuid, _ in stale})
+    # In chunks small enough to bind
+    for offset in range(0, len(devices), 500):
+        for device_uuid, sensor_type, dates, values, rowids in archived_device_blocks(conn,
+                                                                                      devices[offset:offset + 500]):
+            if (device_uuid, sensor_type) not in stale or not dates:
+                continue
+            # Blocks are in (date_created, rowid) order
+            row = (values[-1], dates[-1], rowids[-1])
+            current = newest.get((device_uuid, sensor_type))
+            if current is None or (row[1], row[2]) > (current[1], current[2]):
+                newest[(device_uuid, sensor_type)] = row
+    conn.executemany('insert into device_latest (device_uuid, type, value, date_created, reading_rowid) '
+                     'VALUES (?,?,?,?,?)', [(*key, *row) for key, row in newest.items()])
@@ -0,0 +1,165 @@
+"""
+Raw reading listings that do not hold a device's whole history in memory.
+
+Readings are listed in (date_created, rowid) order, which the
+readings_device_date index hands back directly. A page ends with a cursor
+naming its last reading, and the next page starts right after it with a
+range scan instead of an OFFSET, so every page costs the same however deep
+the client has paged. Streamed listings are written out from the SQLite
+cursor a chunk at a time as the response is sent. Readings moved out to
+archives are merged in at their place in that order, a window at a time
+(see partitions.archived_readings).
+"""
+import base64
+import binascii
+import heapq
+import json
+from itertools import islice
+
+from flask import abort
+
+from partitions import archived_readings
+from utils import build_sql
+
+READINGS_SELECTION = 'select rowid, device_uuid, type, value, date_created from readings where device_uuid = ? '
+READING_FIELDS = ('device_uuid', 'type', 'value', 'date_created')
+
+# Rows fetched from SQLite per chunk of a streamed response
+STREAM_CHUNK_ROWS = 500
+
+
+def encode_cursor(date_created, rowid):
+    """
+    Returns the opaque token of the position right after a reading
+    :param date_created: date of the reading
+    :param rowid: rowid of the reading
+    :return: str
+    """
+    return base64.urlsafe_b64encode(f'{date_created}:{rowid}'.encode()).decode()
+
+
+def decode_cursor(token):
+    """
+    Returns the position an opaque cursor token points at
+    Raises ValueError if the token was not made by encode_cursor
+    :param token: str
+    :return: (int, int)
+    """
+    try:
+        date_created, rowid = base64.urlsafe_b64decode(token.encode()).decode().split(':')
+        return int(date_created), int(rowid)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f'Invalid cursor {token!r}') from None
+
+
+def parse_cursor(request):
+    """
+    Returns the position of the cursor query parameter of a GET request
+    Aborts with a 400 if it is not a valid cursor
+    :param request: Flask request
+    :return: Union[(int, int), None]
+    """
+    token = request.values.get('cursor', None)
+    if not token:
+        return None
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400, "'cursor' must be a cursor returned by a previous page")
+
+
+def build_listing_sql(device_uuid, filters, after=None, limit=None):
+    """
+    Builds the query listing a device's readings in (date_created, rowid) order
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :param after: optional (date_created, rowid) to start after
+    :param limit: optional number of readings
+    :return: (str, list)
+    """
+    sql, params = build_sql(READINGS_SELECTION, filters, [device_uuid])
+    if after is not None:
+        sql += 'AND (date_created, rowid) > (?, ?) '
+        params.extend(after)
+    sql += 'ORDER BY date_created, rowid'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
+
+
+def merged_readings(conn, device_uuid, filters, after=None, limit=None):
+    """
+    Generates a device's readings, archived ones included, in (date_created, rowid) order
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :param after: optional (date_created, rowid) to start after
+    :param limit: optional number of readings
+    :return: generator of (rowid, device_uuid, type, value, date_created) rows
+    """
+    sql, params = build_listing_sql(device_uuid, filters, after, limit)
+    merged = heapq.merge(conn.execute(sql, params), archived_readings(conn, device_uuid, filters, after),
+                         key=lambda row: (row[4], row[0]))
+    return islice(merged, limit)
+
+
+def reading_payload(row):
+    """
+    Formats a (rowid, device_uuid, type, value, date_created) row for the API
+    :param row: row of READINGS_SELECTION
+    :return: dict
+    """
+    return dict(zip(READING_FIELDS, row[1:]))
+
+
+def query_page(conn, device_uuid, filters, limit, after=None):
+    """
+    Returns one page of a device's readings
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :param limit: most readings on the page
+    :param after: optional (date_created, rowid) the page starts after
+    :return: (list of dicts, cursor of the next page or None on the last page)
+    """
+    # One reading more than asked for tells whether there is a next page
+    rows = list(merged_readings(conn, device_uuid, filters, after, limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][4], rows[-1][0])
+    return [reading_payload(row) for row in rows], next_cursor
+
+
+def stream_readings(pool, device_uuid, filters, after=None, limit=None, ndjson=False):
+    """
+    Generates a device's readings as a JSON array, or one JSON object per
+    line, a chunk at a time. The generator borrows its own pooled connection
+    since it runs after the view has returned.
+    :param pool: ConnectionPool
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :param after: optional (date_created, rowid) to start after
+    :param limit: optional number of readings
+    :param ndjson: write newline delimited JSON instead of an array
+    :return: generator of str
+    """
+    separator = '\n' if ndjson else ','
+    with pool.connection() as conn:
+        readings = merged_readings(conn, device_uuid, filters, after, limit)
+        if not ndjson:
+            yield '['
+        first = True
+        while True:
+            rows = list(islice(readings, STREAM_CHUNK_ROWS))
+            if not rows:
+                break
+            chunk = separator.join(json.dumps(reading_payload(row)) for row in rows)
+            if ndjson:
+                yield chunk + '\n'
+            else:
+                yield chunk if first else ',' + chunk
+            first = False
+        if not ndjson:
+            yield ']'
@@ -0,0 +1,220 @@
+"""
+Read-only snapshots of the shards for the heavy fleet wide reads.
+
+A replica of `database.db` is `database.replica.db`, a copy taken with
+SQLite's online backup API a few pages at a time and moved into place with
+an atomic rename, so readers only ever see whole snapshots. Pools of replicas open them
+immutable, without any locking, and reopen a connection once the file
+under it has been replaced. With READ_REPLICAS the summaries and batch
+query endpoints read from them: they no longer hold read transactions on
+the primary that keep its WAL from being checkpointed or compete with the
+group commit writer for its pages, at the cost of lagging it by up to
+REPLICA_REFRESH_SECONDS, or longer for big shards (REPLICA_REFRESH_DUTY).
+
+Replicas are refreshed by a process of their own, `flask refresh-replicas
+--every N` or the one serve.py starts.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from db import ConnectionPool, get_pool, get_pools, get_shard_path, get_shard_paths
+
+
+def replica_path(database):
+    """
+    Returns the replica file of a database
+    :param database: path of the database
+    :return: str
+    """
+    stem, extension = os.path.splitext(database)
+    return f'{stem}.replica{extension}'
+
+
+class _Restarted(Exception):
+    pass
+
+
+def refresh_replica(database, replica, pages=1024, sleep=0.005, restarts=3):
+    """
+    Replaces a replica with a fresh snapshot of its database.
+
+    The copy goes `pages` pages at a time with `sleep` seconds between steps,
+    so it neither hogs the disk nor holds a read transaction on the database
+    for longer than a step, which would keep its WAL from being checkpointed.
+    A commit landing between two steps makes SQLite start the copy over;
+    after `restarts` of those, the rest is copied in one step so that a
+    steady stream of inserts cannot starve the replica.
+    :param database: path of the database
+    :param replica: path of the replica
+    :param pages: pages copied per step, -1 for the whole database in one step
+    :param sleep: seconds between steps
+    :param restarts: restarts allowed before finishing in one step
+    :return: whether the copy had to finish in one step
+    """
+    temporary = f'{replica}.{os.getpid()}.tmp'
+    source = sqlite3.connect(database)
+    target = sqlite3.connect(temporary)
+    copied = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if copied['remaining'] is not None and remaining >= copied['remaining']:
+            copied['restarts'] += 1
+            if copied['restarts'] > restarts:
+                raise _Restarted()
+        copied['remaining'] = remaining
+        # backup's own sleep only applies to retrying a busy step
+        time.sleep(sleep)
+
+    one_step = pages < 0
+    try:
+        if not one_step:
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _Restarted:
+                one_step = True
+        if one_step:
+            source.backup(target)
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.replace(temporary, replica)
+    return one_step and pages >= 0
+
+
+def refresh_replicas(app, versions=None):
+    """
+    Refreshes the replica of every shard. With `versions`, a dict kept
+    between calls, shards nothing was committed to since their last refresh
+    are skipped.
+    :param app: Flask app
+    :param versions: optional dict of database path to (connection, data_version)
+    :return: number of replicas refreshed
+    """
+    refreshed = 0
+    for database in get_shard_paths(app):
+        replica = replica_path(database)
+        if versions is not None:
+            if database not in versions:
+                versions[database] = (sqlite3.connect(database), None)
+            conn, seen = versions[database]
+            # Only moves when another connection commits to the database
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == seen and os.path.exists(replica):
+                continue
+        if refresh_replica(database, replica,
+                           pages=app.config['REPLICA_BACKUP_PAGES'],
+                           sleep=app.config['REPLICA_BACKUP_SLEEP'],
+                           restarts=app.config['REPLICA_BACKUP_RESTARTS']):
+            app.logger.warning('Refreshing %s kept restarting, finished it in one step', replica)
+        if versions is not None:
+            versions[database] = (conn, data_version)
+        refreshed += 1
+    return refreshed
+
+
+def run_refresher(app, every, stop=None):
+    """
+    Refreshes the replicas every `every` seconds until `stop` is set. The
+    wait is stretched so that copying takes at most REPLICA_REFRESH_DUTY of
+    the refresher's time, which makes the interval grow with the size of
+    the shards.
+    :param app: Flask app
+    :param every: shortest number of seconds between refreshes
+    :param stop: optional threading.Event
+    """
+    stop = stop or threading.Event()
+    versions = {}
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            try:
+                refresh_replicas(app, versions)
+            except sqlite3.Error as exc:
+                app.logger.error('Failed to refresh the replicas: %s', exc)
+            elapsed = time.monotonic() - started
+            stop.wait(max(every - elapsed, elapsed * (1 / app.config['REPLICA_REFRESH_DUTY'] - 1)))
+    finally:
+        for conn, _ in versions.values():
+            conn.close()
+
+
+_replica_pools = {}
+_replica_pools_lock = threading.Lock()
+
+
+def _get_replica_pool(app, database):
+    replica = replica_path(database)
+    with _replica_pools_lock:
+        pool = _replica_pools.get(replica)
+        if pool is None:
+            pool = ConnectionPool(replica,
+                                  size=app.config['DATABASE_POOL_SIZE'],
+                                  timeout=app.config['DATABASE_POOL_TIMEOUT'],
+                                  cache_size_kib=app.config['DATABASE_CACHE_SIZE_KIB'],
+                                  mmap_size=app.config['DATABASE_MMAP_SIZE'],
+                                  cached_statements=app.config['DATABASE_CACHED_STATEMENTS'],
+                                  read_only=True)
+            _replica_pools[replica] = pool
+        return pool
+
+
+def get_read_pool(app, device_uuid=None):
+    """
+    Returns the pool heavy reads about a device should use: its shard's
+    replica with READ_REPLICAS once there is one, the shard itself otherwise
+    :param app: Flask app
+    :param device_uuid: the device
+    :return: ConnectionPool
+    """
+    database = get_shard_path(app, device_uuid)
+    if app.config['READ_REPLICAS'] and os.path.exists(replica_path(database)):
+        return _get_replica_pool(app, database)
+    return get_pool(app, device_uuid)
+
+
+def replica_generation(app):
+    """
+    Identifies the replicas get_read_pools currently serves, changing every
+    time one of them is refreshed
+    :param app: Flask app
+    :return: tuple, or None without READ_REPLICAS
+    """
+    if not app.config['READ_REPLICAS']:
+        return None
+    generation = []
+    for database in get_shard_paths(app):
+        try:
+            stat = os.stat(replica_path(database))
+        except FileNotFoundError:
+            generation.append(None)
+        else:
+            # Every refresh renames a new file into place
+            generation.append((stat.st_ino, stat.st_mtime_ns))
+    return tuple(generation)
+
+
+def get_read_pools(app):
+    """
+    Returns get_read_pool of every shard
+    :param app: Flask app
+    :return: list of ConnectionPool
+    """
+    if not app.config['READ_REPLICAS']:
+        return get_pools(app)
+    return [_get_replica_pool(app, database) if os.path.exists(replica_path(database)) else pool
+            for database, pool in zip(get_shard_paths(app), get_pools(app))]
+
+
+def _forget_replica_pools():
+    # Same as db._forget_pools
+    global _replica_pools, _replica_pools_lock
+    _inherited.append(_replica_pools)
+    _replica_pools = {}
+    _replica_pools_lock = threading.Lock()
+
+
+_inherited = []
+os.register_at_fork(after_in_child=_forget_replica_pools)
@@ -0,0 +1,226 @@
+"""
+Range queries answered from the minute/hour/day rollup tables.
+
+A [start, end] range is split into whole rollup buckets, as coarse as
+possible, plus raw readings only where the range edges do not line up with
+a minute. A year for one device is then a few hundred day, hour and minute
+buckets and at most two minutes of raw readings, and because buckets keep
+exact counts, sums and histograms the answers are the same as a scan over
+every raw reading. Raw edges falling in archived windows are read from the
+archives as well (see partitions.py).
+"""
+from histogram import Histogram
+from partitions import archived_fleet_histogram, archived_histograms, archived_readings_table
+from schema import ROLLUP_GRANULARITIES, add_to_rollups, roll_up
+from utils import QueryFilters, build_sql
+
+ROLLUP_TOTALS_SELECTION = ('select device_uuid, SUM(readings_count), SUM(value_sum), MAX(value_max), MIN(value_min) '
+                           'from readings_rollups where granularity = ? ')
+ROLLUP_HISTOGRAM_SELECTION = ('select device_uuid, value, SUM(readings_count), MIN(first_rowid) '
+                              'from readings_rollup_histograms where granularity = ? ')
+RAW_TOTALS_SELECTION = 'select device_uuid, COUNT(*), SUM(value), MAX(value), MIN(value) from readings where 1=1 '
+RAW_HISTOGRAM_SELECTION = 'select device_uuid, value, COUNT(*), MIN(rowid) from readings where 1=1 '
+# Every device with readings, as a subquery SQLite walks the device indexes
+# with, so fleet wide queries need no list of devices bound from Python
+EVERY_DEVICE = 'AND device_uuid IN (select device_uuid from device_summaries) '
+FLEET_ROLLUP_HISTOGRAM_SELECTION = ('select value, SUM(readings_count), MIN(first_rowid) '
+                                    'from readings_rollup_histograms where granularity = ? ' + EVERY_DEVICE)
+FLEET_RAW_HISTOGRAM_SELECTION = 'select value, COUNT(*), MIN(rowid) from readings where 1=1 ' + EVERY_DEVICE
+
+# Most devices bound in one IN (...) list
+DEVICES_PER_QUERY = 500
+
+
+def plan_range(start, end, granularities=ROLLUP_GRANULARITIES):
+    """
+    Splits the inclusive range [start, end] into rollup buckets and raw edges.
+    None on either side means the range is unbounded on that side.
+    :param start: first epoch second, or None
+    :param end: last epoch second, or None
+    :param granularities: bucket widths to use, coarsest first
+    :return: list of (granularity, start, end) segments, each covering the
+        inclusive range [start, end]; granularity None means raw readings,
+        otherwise every bucket of that width starting in the range
+    """
+    if start is not None and end is not None and start > end:
+        return []
+    if not granularities:
+        return [(None, start, end)]
+
+    granularity = granularities[0]
+    # First and one past the last whole bucket inside the range
+    first = None if start is None else -(-start // granularity) * granularity
+    last = None if end is None else (end + 1) // granularity * granularity
+    if first is not None and last is not None and first >= last:
+        return plan_range(start, end, granularities[1:])
+
+    segments = []
+    if first is not None:
+        segments.extend(plan_range(start, first - 1, granularities[1:]))
+    segments.append((granularity, first, None if last is None else last - 1))
+    if last is not None:
+        segments.extend(plan_range(last, end, granularities[1:]))
+    return segments
+
+
+def range_histogram(conn, device_uuid, filters):
+    """
+    Histogram of a device's readings matching the filters, from rollup
+    buckets wherever the range covers them whole
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :return: Histogram
+    """
+    return range_histograms(conn, [device_uuid], filters)[device_uuid]
+
+
+def range_histograms(conn, device_uuids, filters):
+    """
+    Histograms of several devices' readings matching the filters. Every
+    segment of the range is one query grouped by device, per
+    DEVICES_PER_QUERY devices, so the number of queries does not grow with
+    the number of devices.
+    :param conn: sqlite3 connection
+    :param device_uuids: list of devices, or None for every device with matching readings
+    :param filters: QueryFilters
+    :return: dict of device_uuid to Histogram
+    """
+    histograms = {device_uuid: Histogram() for device_uuid in device_uuids or ()}
+    for devices in _device_batches(device_uuids):
+        for granularity, start, end in plan_range(filters.start, filters.end):
+            segment = QueryFilters(start, end, filters.sensor_type)
+            selection = RAW_HISTOGRAM_SELECTION if granularity is None else ROLLUP_HISTOGRAM_SELECTION
+            sql, params = _select_devices(selection, granularity, segment, devices)
+            sql += 'GROUP BY device_uuid, value'
+            for device_uuid, value, count, first_seen in conn.execute(sql, params):
+                histograms.setdefault(device_uuid, Histogram()).add(value, count, first_seen)
+            if granularity is None:
+                for device_uuid, archived in archived_histograms(conn, devices, segment).items():
+                    histograms.setdefault(device_uuid, Histogram()).merge(archived)
+    return histograms
+
+
+def fleet_histogram(conn, filters):
+    """
+    Histogram of the readings of every device matching the filters, e.g.
+    for percentiles across the whole fleet. Like range_histograms, but each
+    segment is one query grouped by value only.
+    :param conn: sqlite3 connection
+    :param filters: QueryFilters
+    :return: Histogram
+    """
+    fleet = Histogram()
+    for granularity, start, end in plan_range(filters.start, filters.end):
+        segment = QueryFilters(start, end, filters.sensor_type)
+        if granularity is None:
+            sql, params = build_sql(FLEET_RAW_HISTOGRAM_SELECTION, segment)
+        else:
+            sql, params = build_sql(FLEET_ROLLUP_HISTOGRAM_SELECTION, segment, [granularity], date_column='bucket')
+        sql += 'GROUP BY value'
+        for value, count, first_seen in conn.execute(sql, params):
+            fleet.add(value, count, first_seen)
+        if granularity is None:
+            fleet.merge(archived_fleet_histogram(conn, segment))
+    return fleet
+
+
+def range_totals(conn, device_uuid, filters):
+    """
+    Count, sum, max and min of a device's readings matching the filters,
+    from rollup buckets wherever the range covers them whole
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :return: (count, sum, max, min) where max and min are None without readings
+    """
+    return range_totals_by_device(conn, [device_uuid], filters)[device_uuid]
+
+
+def range_totals_by_device(conn, device_uuids, filters):
+    """
+    Like range_totals for several devices, with one query grouped by device
+    per segment of the range and DEVICES_PER_QUERY devices
+    :param conn: sqlite3 connection
+    :param device_uuids: list of devices, or None for every device with matching readings
+    :param filters: QueryFilters
+    :return: dict of device_uuid to (count, sum, max, min)
+    """
+    totals = {device_uuid: (0, 0, None, None) for device_uuid in device_uuids or ()}
+
+    def add(device_uuid, count, total, maximum, minimum):
+        if not count:
+            return
+        previous = totals.get(device_uuid, (0, 0, None, None))
+        totals[device_uuid] = (previous[0] + count, previous[1] + total,
+                               maximum if previous[2] is None else max(previous[2], maximum),
+                               minimum if previous[3] is None else min(previous[3], minimum))
+
+    for devices in _device_batches(device_uuids):
+        for granularity, start, end in plan_range(filters.start, filters.end):
+            segment = QueryFilters(start, end, filters.sensor_type)
+            selection = RAW_TOTALS_SELECTION if granularity is None else ROLLUP_TOTALS_SELECTION
+            sql, params = _select_devices(selection, granularity, segment, devices)
+            sql += 'GROUP BY device_uuid'
+            for row in conn.execute(sql, params):
+                add(*row)
+            if granularity is None:
+                for device_uuid, archived in archived_histograms(conn, devices, segment).items():
+                    add(device_uuid, archived.count, archived.total, archived.max, archived.min)
+    return totals
+
+
+def in_devices(selection, devices):
+    """
+    Extends a selection ending in a WHERE clause with a device_uuid IN (...) condition
+    :param selection: SQL up to and including its WHERE conditions
+    :param devices: list of devices, bound as parameters after the selection's own
+    :return: str
+    """
+    return selection + f'AND device_uuid IN ({", ".join("?" * len(devices))}) '
+
+
+def device_chunks(device_uuids):
+    """
+    Splits devices into lists of at most DEVICES_PER_QUERY
+    :param device_uuids: list of devices
+    :return: generator of lists
+    """
+    for offset in range(0, len(device_uuids), DEVICES_PER_QUERY):
+        yield device_uuids[offset:offset + DEVICES_PER_QUERY]
+
+
+def _device_batches(device_uuids):
+    # None stands for every device, in a single batch
+    if device_uuids is None:
+        return [None]
+    return device_chunks(list(device_uuids))
+
+
+def _select_devices(selection, granularity, segment, devices):
+    """
+    Completes a raw (granularity None) or rollup selection with a segment
+    and a batch of devices, None meaning every device
+    :return: (str, list)
+    """
+    if devices is None:
+        selection += EVERY_DEVICE
+        devices = []
+    else:
+        selection = in_devices(selection, devices)
+    if granularity is None:
+        return build_sql(selection, segment, devices)
+    return build_sql(selection, segment, [granularity, *devices], date_column='bucket')
+
+
+def rebuild_rollups(conn):
+    """
+    Recomputes the rollup tables from the readings table and the archives
+    :param conn: sqlite3 connection
+    """
+    with conn, archived_readings_table(conn) as archived:
+        conn.execute('DELETE FROM readings_rollups')
+        conn.execute('DELETE FROM readings_rollup_histograms')
+        conn.execute('UPDATE rollup_position SET last_rowid = 0')
+        roll_up(conn)
+        add_to_rollups(conn, archived)
@@ -0,0 +1,190 @@
+"""
+Schema for the readings database.
+
+Every statement is idempotent, so `migrate` can be run against a brand new
+file or an existing database from an older version of the app and brings
+either one up to date.
+"""
+
+# Widths in seconds of the minute, hour and day rollup buckets, coarsest first
+ROLLUP_GRANULARITIES = (86400, 3600, 60)
+
+
+def _rollup_statements():
+    """
+    Builds the statements adding the readings of a source table past a
+    rowid to their minute, hour and day rollup buckets, one grouped upsert
+    per table and granularity. Buckets are aligned with floor division so
+    that dates before the epoch land in the right bucket too.
+    """
+    statements = []
+    for granularity in ROLLUP_GRANULARITIES:
+        bucket = f'date_created - (((date_created % {granularity}) + {granularity}) % {granularity})'
+        statements.append(f'''
+            INSERT INTO {{schema}}.readings_rollups
+                (device_uuid, type, granularity, bucket, readings_count, value_sum, value_max, value_min)
+            SELECT device_uuid, type, {granularity}, {bucket}, COUNT(*), SUM(value), MAX(value), MIN(value)
+                FROM {{source}}
+            WHERE rowid > ? AND device_uuid IS NOT NULL AND type IS NOT NULL AND value IS NOT NULL
+                AND date_created IS NOT NULL
+            GROUP BY device_uuid, type, {bucket}
+            ON CONFLICT (device_uuid, type, granularity, bucket) DO UPDATE SET
+                readings_count = readings_count + excluded.readings_count,
+                value_sum = value_sum + excluded.value_sum,
+                value_max = MAX(value_max, excluded.value_max),
+                value_min = MIN(value_min, excluded.value_min)''')
+        statements.append(f'''
+            INSERT INTO {{schema}}.readings_rollup_histograms
+                (device_uuid, type, granularity, bucket, value, readings_count, first_rowid)
+            SELECT device_uuid, type, {granularity}, {bucket}, value, COUNT(*), MIN(rowid)
+                FROM {{source}}
+            WHERE rowid > ? AND device_uuid IS NOT NULL AND type IS NOT NULL AND value IS NOT NULL
+                AND date_created IS NOT NULL
+            GROUP BY device_uuid, type, {bucket}, value
+            ON CONFLICT (device_uuid, type, granularity, bucket, value) DO UPDATE SET
+                readings_count = readings_count + excluded.readings_count,
+                first_rowid = MIN(first_rowid, excluded.first_rowid)''')
+    return statements
+
+
+ROLLUP_STATEMENTS = _rollup_statements()
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)',
+    # Covers every per-device query: equality on device_uuid and type, a range
+    # on date_created, and value read straight out of the index
+    'CREATE INDEX IF NOT EXISTS readings_device_type_date ON readings (device_uuid, type, date_created, value)',
+    # Readings of a device in (date_created, rowid) order whatever their
+    # type, so each page of a keyset paginated listing is a range scan
+    'CREATE INDEX IF NOT EXISTS readings_device_date ON readings (device_uuid, date_created)',
+    # Running totals and a per value histogram for every device and type,
+    # kept up to date by a trigger so every insert path maintains them
+    '''CREATE TABLE IF NOT EXISTS device_summaries (
+        device_uuid TEXT, type TEXT, readings_count INTEGER, value_sum INTEGER, value_max INTEGER,
+        value_min INTEGER, PRIMARY KEY (device_uuid, type)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS device_histograms (
+        device_uuid TEXT, type TEXT, value INTEGER, readings_count INTEGER,
+        PRIMARY KEY (device_uuid, type, value)) WITHOUT ROWID''',
+    '''CREATE TRIGGER IF NOT EXISTS readings_summarize AFTER INSERT ON readings
+        WHEN NEW.device_uuid IS NOT NULL AND NEW.type IS NOT NULL AND NEW.value IS NOT NULL
+        BEGIN
+            INSERT INTO device_summaries (device_uuid, type, readings_count, value_sum, value_max, value_min)
+                VALUES (NEW.device_uuid, NEW.type, 1, NEW.value, NEW.value, NEW.value)
+                ON CONFLICT (device_uuid, type) DO UPDATE SET
+                    readings_count = readings_count + 1,
+                    value_sum = value_sum + excluded.value_sum,
+                    value_max = MAX(value_max, excluded.value_max),
+                    value_min = MIN(value_min, excluded.value_min);
+            INSERT INTO device_histograms (device_uuid, type, value, readings_count)
+                VALUES (NEW.device_uuid, NEW.type, NEW.value, 1)
+                ON CONFLICT (device_uuid, type, value) DO UPDATE SET readings_count = readings_count + 1;
+        END''',
+    # The same totals and histograms per device, type and minute, hour or day
+    # bucket, so a wide date range can be answered from a few whole buckets
+    '''CREATE TABLE IF NOT EXISTS readings_rollups (
+        device_uuid TEXT, type TEXT, granularity INTEGER, bucket INTEGER, readings_count INTEGER,
+        value_sum INTEGER, value_max INTEGER, value_min INTEGER,
+        PRIMARY KEY (device_uuid, type, granularity, bucket)) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS readings_rollup_histograms (
+        device_uuid TEXT, type TEXT, granularity INTEGER, bucket INTEGER, value INTEGER, readings_count INTEGER,
+        first_rowid INTEGER, PRIMARY KEY (device_uuid, type, granularity, bucket, value)) WITHOUT ROWID''',
+    # Rowid of the last reading added to the rollups. Unlike the aggregates
+    # above they are not kept by a trigger, which cost six upserts per row,
+    # but by roll_up once per batch of inserts
+    '''CREATE TABLE IF NOT EXISTS rollup_position (last_rowid INTEGER)''',
+    # The trigger of older versions kept the rollups current up to the last reading
+    '''INSERT INTO rollup_position (last_rowid) SELECT COALESCE(MAX(rowid), 0) FROM readings
+        WHERE NOT EXISTS (SELECT 1 FROM rollup_position)''',
+    'DROP TRIGGER IF EXISTS readings_rollup',
+    # Newest reading of every device and type by date_created, whatever
+    # order readings arrive in (ties go to the one inserted last)
+    '''CREATE TABLE IF NOT EXISTS device_latest (
+        device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER, reading_rowid INTEGER,
+        PRIMARY KEY (device_uuid, type)) WITHOUT ROWID''',
+    '''CREATE TRIGGER IF NOT EXISTS readings_latest AFTER INSERT ON readings
+        WHEN NEW.device_uuid IS NOT NULL AND NEW.type IS NOT NULL AND NEW.value IS NOT NULL
+            AND NEW.date_created IS NOT NULL
+        BEGIN
+            INSERT INTO device_latest (device_uuid, type, value, date_created, reading_rowid)
+                VALUES (NEW.device_uuid, NEW.type, NEW.value, NEW.date_created, NEW.rowid)
+                ON CONFLICT (device_uuid, type) DO UPDATE SET
+                    value = excluded.value,
+                    date_created = excluded.date_created,
+                    reading_rowid = excluded.reading_rowid
+                WHERE excluded.date_created >= date_created;
+        END''',
+    # Sequence number of the last record of each ingest log committed to
+    # readings, so replaying a log skips what was applied (see ingest_log.py)
+    '''CREATE TABLE IF NOT EXISTS ingest_log_positions (log TEXT PRIMARY KEY, sequence INTEGER)''',
+    # Time windows whose readings were moved out to a compressed archive file
+    '''CREATE TABLE IF NOT EXISTS archived_partitions (
+        window_start INTEGER PRIMARY KEY, window_end INTEGER, path TEXT, readings_count INTEGER)''',
+]
+
+# Tables keyed by device, which move along with it between shards
+DEVICE_TABLES = ['readings', 'device_summaries', 'device_histograms', 'readings_rollups', 'readings_rollup_histograms',
+                 'device_latest']
+TABLES = DEVICE_TABLES + ['archived_partitions', 'ingest_log_positions', 'rollup_position']
+
+
+def migrate(conn):
+    """
+    Creates whatever part of the schema the database is missing
+    :param conn: sqlite3 connection
+    """
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def drop_schema(conn):
+    """
+    Drops every table (and with them their indexes and triggers)
+    :param conn: sqlite3 connection
+    """
+    for table in TABLES:
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+    conn.commit()
+
+
+def roll_up(conn, schema='main'):
+    """
+    Adds the readings inserted since the last call to the rollup tables,
+    with one grouped upsert per table and granularity, and moves the rollup
+    position past them. Meant to run in the transaction that inserted them,
+    as the group commit writer does for each batch; readings written any
+    other way are only counted in the rollups once this runs.
+    :param conn: sqlite3 connection
+    :param schema: name the database is attached under
+    """
+    position = conn.execute(f'SELECT last_rowid FROM {schema}.rollup_position').fetchone()[0]
+    # NOT INDEXED keeps SQLite on the rowid range rather than scanning a whole covering index
+    add_to_rollups(conn, f'{schema}.readings NOT INDEXED', position, schema)
+    reset_rollup_position(conn, schema)
+
+
+def add_to_rollups(conn, source, after=0, schema='main'):
+    """
+    Adds the readings of any table shaped like readings to the rollup
+    tables, leaving the rollup position alone
+    :param conn: sqlite3 connection
+    :param source: table to read the readings from
+    :param after: only add the readings with a rowid past this one
+    :param schema: name the database holding the rollups is attached under
+    """
+    for statement in ROLLUP_STATEMENTS:
+        conn.execute(statement.format(schema=schema, source=source), (after,))
+
+
+def reset_rollup_position(conn, schema='main'):
+    """
+    Moves the rollup position to the last reading. Every DELETE from
+    readings has to be followed by this, in the same transaction and with
+    what is left rolled up, since SQLite hands the rowids of deleted newest
+    readings out again and roll_up would take them for rolled up already.
+    :param conn: sqlite3 connection
+    :param schema: name the database is attached under
+    """
+    conn.execute(f'UPDATE {schema}.rollup_position '
+                 f'SET last_rowid = (SELECT COALESCE(MAX(rowid), 0) FROM {schema}.readings)')
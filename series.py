@@ -0,0 +1,127 @@
+"""
+Downsampled time series of a device's readings.
+
+The requested range is cut into fixed width buckets and every bucket is
+reduced to its count, sum, max and min by a GROUP BY in SQLite, so the
+response holds one entry per non empty bucket however many readings the
+range covers. When the bucket width and its origin line up with the minute,
+hour or day rollups, whole rollup buckets are grouped instead of raw
+readings (see rollups.plan_range). Raw segments add in the archived readings
+they overlap, which the rollups already count.
+"""
+from partitions import archived_date_range, archived_readings
+from rollups import plan_range
+from schema import ROLLUP_GRANULARITIES
+from utils import QueryFilters, build_sql
+
+RAW_SERIES_SELECTION = ('select (date_created - ?) / ?, COUNT(*), SUM(value), MAX(value), MIN(value) '
+                        'from readings where device_uuid = ? ')
+ROLLUP_SERIES_SELECTION = ('select (bucket - ?) / ?, SUM(readings_count), SUM(value_sum), MAX(value_max), '
+                           'MIN(value_min) from readings_rollups where device_uuid = ? AND granularity = ? ')
+DATE_RANGE_SELECTION = 'select MIN(date_created), MAX(date_created) from readings where device_uuid = ? '
+
+
+def series_layout(start, end, bucket=None, points=None):
+    """
+    Works out where the buckets of a series start and how wide they are.
+    A fixed `bucket` width gives buckets aligned on multiples of the width,
+    so the same timestamps come back whatever the range. `points` gives at
+    most that many buckets starting at `start`, rounded up to a whole number
+    of minutes, hours or days once they are that wide so rollups can serve
+    them.
+    :param start: first epoch second of the range
+    :param end: last epoch second of the range
+    :param bucket: bucket width in seconds
+    :param points: maximum number of buckets
+    :return: (origin, width) where bucket i covers [origin + i * width, origin + (i + 1) * width)
+    """
+    if bucket is not None:
+        return start // bucket * bucket, bucket
+
+    width = max(1, -(-(end - start + 1) // points))
+    for granularity in ROLLUP_GRANULARITIES:
+        if width >= granularity:
+            width = -(-width // granularity) * granularity
+            break
+    return start, width
+
+
+def date_range(conn, device_uuid, filters):
+    """
+    Fills in a missing start or end with the first or last matching reading
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters
+    :return: (start, end), both None when nothing matches
+    """
+    if filters.start is not None and filters.end is not None:
+        return filters.start, filters.end
+    sql, params = build_sql(DATE_RANGE_SELECTION, filters, [device_uuid])
+    first, last = conn.execute(sql, params).fetchone()
+    archived_first, archived_last = archived_date_range(conn, device_uuid, filters.sensor_type)
+    if archived_first is not None:
+        first = archived_first if first is None else min(first, archived_first)
+        last = archived_last if last is None else max(last, archived_last)
+    if first is None:
+        return None, None
+    return (first if filters.start is None else filters.start), (last if filters.end is None else filters.end)
+
+
+def query_series(conn, device_uuid, filters, origin, width):
+    """
+    Count, sum, max and min of a device's readings matching the filters in
+    every bucket that has any
+    :param conn: sqlite3 connection
+    :param device_uuid: the device
+    :param filters: QueryFilters with both start and end set
+    :param origin: epoch second the first bucket starts at, no later than filters.start
+    :param width: bucket width in seconds
+    :return: list of (bucket start, count, sum, max, min) ordered by bucket
+    """
+    # Rollup buckets can only stand in for raw readings if none of them
+    # straddles the edge between two series buckets
+    granularities = tuple(g for g in ROLLUP_GRANULARITIES if width % g == 0 and origin % g == 0)
+    buckets = {}
+    for granularity, start, end in plan_range(filters.start, filters.end, granularities):
+        segment = QueryFilters(start, end, filters.sensor_type)
+        if granularity is None:
+            sql, params = build_sql(RAW_SERIES_SELECTION, segment, [origin, width, device_uuid])
+        else:
+            sql, params = build_sql(ROLLUP_SERIES_SELECTION, segment, [origin, width, device_uuid, granularity],
+                                    date_column='bucket')
+        sql += 'GROUP BY 1'
+        rows = conn.execute(sql, params).fetchall()
+        if granularity is None:
+            rows += [((date_created - origin) // width, 1, value, value, value)
+                     for _, _, _, value, date_created in archived_readings(conn, device_uuid, segment)]
+        for slot, count, total, maximum, minimum in rows:
+            if slot not in buckets:
+                buckets[slot] = [count, total, maximum, minimum]
+                continue
+            merged = buckets[slot]
+            merged[0] += count
+            merged[1] += total
+            merged[2] = max(merged[2], maximum)
+            merged[3] = min(merged[3], minimum)
+    return [(origin + slot * width, *buckets[slot]) for slot in sorted(buckets)]
+
+
+def series_payload(origin, width, rows):
+    """
+    Formats a series for the API
+    :param origin: epoch second the first bucket starts at
+    :param width: bucket width in seconds
+    :param rows: (bucket start, count, sum, max, min) rows
+    :return: dict
+    """
+    return {
+        'bucket': width,
+        'origin': origin,
+        'series': [{
+            'start': start,
+            'count': count,
+            'max': maximum,
+            'min': minimum,
+            'mean': total / count
+        } for start, count, total, maximum, minimum in rows]
+    }
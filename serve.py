@@ -0,0 +1,248 @@
+"""
+Pre-fork multi-process server, the production way to run the app.
+
+    python serve.py --bind 0.0.0.0:5000 --workers 4 --threads 8
+
+The master process binds the listening socket and forks `--workers`
+workers that all accept on it. It never imports the app itself: each
+worker imports it after the fork, so no SQLite connection, writer thread
+or lock is ever inherited (the pools and writers also forget anything
+inherited at fork, see db.py and ingest.py, for servers that preload the
+app). Each worker serves requests on a pool of `--threads` threads.
+
+Signals to the master:
+* SIGHUP -> graceful reload: a new set of workers is started, importing
+    the app afresh, and the old ones are then stopped gracefully
+* SIGTERM, SIGINT -> graceful stop
+
+A worker told to stop finishes the requests it has accepted, flushes its
+ingest writers and exits, or is killed after `--graceful-timeout` seconds.
+Workers that die unexpectedly are replaced. With READ_REPLICAS set in the
+app config the master also runs a process refreshing the replicas every
+REPLICA_REFRESH_SECONDS (see replicas.py).
+"""
+import argparse
+import importlib
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+
+def import_app(path):
+    """
+    Imports the app named by 'module:attribute'
+    :param path: str
+    :return: Flask app
+    """
+    module, _, attribute = path.partition(':')
+    return getattr(importlib.import_module(module), attribute or 'app')
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server on an inherited listening socket, handling requests on a
+    fixed pool of threads
+    """
+    multithread = True
+
+    def __init__(self, app, fd, threads):
+        super().__init__('127.0.0.1', 0, app, fd=fd)
+        # Workers race to accept on the shared socket, the ones that lose go
+        # back to waiting instead of blocking in accept
+        self.socket.setblocking(False)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def run_worker(listener, app_path, threads):
+    """
+    Serves requests until SIGTERM, then drains and exits. Runs in a forked child.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # Ctrl-C reaches the whole process group, the master decides what happens
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    app = import_app(app_path)
+    server = PooledWSGIServer(app, listener.fileno(), threads)
+    serving = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1}, daemon=True)
+    serving.start()
+    while not stop.wait(1.0):
+        pass
+
+    server.shutdown()
+    server.executor.shutdown(wait=True)
+    # Readings acknowledged with a 202 must still reach the database
+    from ingest import close_writers
+    close_writers()
+
+
+def run_refresher(app_path):
+    """
+    Refreshes the replicas until SIGTERM. Runs in a forked child.
+    """
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    from replicas import run_refresher as refresh
+    app = import_app(app_path)
+    refresh(app, app.config['REPLICA_REFRESH_SECONDS'], stop)
+
+
+class Master:
+    """
+    Keeps `workers` workers (and the replica refresher) running on one listening socket
+    """
+
+    def __init__(self, app_path, host, port, workers, threads, graceful_timeout=30.0, replicas=False):
+        self.app_path = app_path
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.replicas = replicas
+        self.listener = socket.create_server((host, port), backlog=2048, reuse_port=False)
+        self.listener.set_inheritable(True)
+        self._current = set()
+        self._stopping = {}
+        self._refresher = None
+        self._reload = False
+        self._stop = False
+
+    def spawn(self, target, *args):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                target(*args)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            finally:
+                # Skip the master's atexit handlers and buffers
+                os._exit(status)
+        return pid
+
+    def spawn_worker(self):
+        self._current.add(self.spawn(run_worker, self.listener, self.app_path, self.threads))
+
+    def stop_workers(self, pids):
+        deadline = time.monotonic() + self.graceful_timeout
+        for pid in pids:
+            self._signal(pid, signal.SIGTERM)
+            self._stopping[pid] = deadline
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, '_reload', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, '_stop', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, '_stop', True))
+
+        for _ in range(self.workers):
+            self.spawn_worker()
+        if self.replicas:
+            self._refresher = self.spawn(run_refresher, self.app_path)
+        print(f'Serving {self.app_path} on {self.listener.getsockname()} with {self.workers} workers of '
+              f'{self.threads} threads (master {os.getpid()})', file=sys.stderr)
+
+        while not self._stop:
+            if self._reload:
+                self._reload = False
+                old = self._current
+                self._current = set()
+                for _ in range(self.workers):
+                    self.spawn_worker()
+                self.stop_workers(old)
+            self.reap()
+            time.sleep(0.2)
+
+        self.stop_workers(self._current)
+        self._current = set()
+        if self._refresher is not None:
+            self.stop_workers([self._refresher])
+            self._refresher = None
+        while self._stopping:
+            self.reap()
+            time.sleep(0.1)
+        self.listener.close()
+
+    def reap(self):
+        """
+        Collects exited children, replacing workers and the refresher that
+        exited without being told to, and kills the ones that overstayed
+        their graceful timeout
+        """
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if self._stopping.pop(pid, None) is not None:
+                continue
+            if pid in self._current:
+                self._current.discard(pid)
+                if not self._stop:
+                    self.spawn_worker()
+            elif pid == self._refresher and not self._stop:
+                self._refresher = self.spawn(run_refresher, self.app_path)
+
+        now = time.monotonic()
+        for pid, deadline in list(self._stopping.items()):
+            if now > deadline:
+                self._signal(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='app:app', help='module:attribute of the WSGI app')
+    parser.add_argument('--bind', default='127.0.0.1:5000', help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='request threads per worker')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='seconds a stopping worker gets to finish its requests')
+    parser.add_argument('--replicas', action='store_true',
+                        help='also run the replica refresher; on by default when the app sets READ_REPLICAS')
+    args = parser.parse_args()
+
+    host, _, port = args.bind.rpartition(':')
+    replicas = args.replicas
+    if not replicas:
+        # Only read the setting in a child, the master must not import the app
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if import_app(args.app).config['READ_REPLICAS'] else 1)
+        replicas = os.waitpid(pid, 0)[1] == 0
+
+    Master(args.app, host or '127.0.0.1', int(port), args.workers, args.threads, args.graceful_timeout,
+           replicas).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Hash partitioning of devices across several SQLite files.
+
+Every reading of a device lives in one shard, picked from a CRC32 of its
+uuid, so per device queries and inserts only ever touch one file and
+writes to different shards never wait on the same lock. With a single
+shard the database is the configured file itself; with more, shard i of
+`database.db` is `database-i.db`.
+"""
+import os
+import sqlite3
+import zlib
+
+from schema import DEVICE_TABLES, migrate, reset_rollup_position, roll_up
+
+
+def shard_paths(database, shards):
+    """
+    Returns the files a database is split into
+    :param database: path of the unsharded database
+    :param shards: number of shards
+    :return: list of str
+    """
+    if shards == 1:
+        return [database]
+    stem, extension = os.path.splitext(database)
+    return [f'{stem}-{index}{extension}' for index in range(shards)]
+
+
+def shard_index(device_uuid, shards):
+    """
+    Returns the shard holding a device's readings. CRC32 rather than hash()
+    so every process agrees on it.
+    :param device_uuid: the device
+    :param shards: number of shards
+    :return: int
+    """
+    return zlib.crc32(device_uuid.encode()) % shards
+
+
+def reshard(old_paths, new_paths):
+    """
+    Moves every device from the shard it has among old_paths to the one it
+    belongs to among new_paths, along with its aggregate and rollup rows.
+    Readings are copied in rowid order so first seen ties are kept. Each
+    device moves in one transaction, but a transaction over an attached
+    database in WAL mode is not atomic across the two files, so a crash can
+    leave a device copied and not yet deleted from its old shard. Whatever
+    the new shard already holds of a device is therefore deleted before it
+    is copied, and an interrupted run can be started again. Shards with archived partitions are refused, since their archive
+    files hold every device of the shard.
+    :param old_paths: shard files the readings are in
+    :param new_paths: shard files the readings should be in
+    :return: number of devices moved
+    """
+    for path in new_paths:
+        conn = sqlite3.connect(path)
+        migrate(conn)
+        conn.close()
+
+    moved = 0
+    for old_path in old_paths:
+        if not os.path.exists(old_path):
+            continue
+        conn = sqlite3.connect(old_path, isolation_level=None)
+        migrate(conn)
+        if conn.execute('select COUNT(*) from archived_partitions').fetchone()[0]:
+            conn.close()
+            raise ValueError(f'{old_path} has archived partitions, drop them before resharding')
+        targets = {}
+        for (device_uuid,) in conn.execute('select DISTINCT device_uuid from readings').fetchall():
+            new_path = new_paths[shard_index(device_uuid or '', len(new_paths))]
+            if os.path.abspath(new_path) != os.path.abspath(old_path):
+                targets.setdefault(new_path, []).append(device_uuid)
+
+        for new_path, devices in targets.items():
+            conn.execute('ATTACH DATABASE ? AS target', (new_path,))
+            try:
+                for device_uuid in devices:
+                    conn.execute('BEGIN')
+                    try:
+                        # A copy an interrupted run committed to the target only is replaced
+                        roll_up(conn, schema='target')
+                        for table in DEVICE_TABLES:
+                            conn.execute(f'DELETE FROM target.{table} WHERE device_uuid IS ?', (device_uuid,))
+                        reset_rollup_position(conn, schema='target')
+                        # The readings trigger of the target fills its aggregates, and
+                        # roll_up its rollups from the rows just copied
+                        conn.execute('''INSERT INTO target.readings (device_uuid, type, value, date_created)
+                                        SELECT device_uuid, type, value, date_created FROM main.readings
+                                        WHERE device_uuid IS ? ORDER BY rowid''', (device_uuid,))
+                        roll_up(conn, schema='target')
+                        # Whatever else is waiting in the source is rolled up before its rowids can be reused
+                        roll_up(conn)
+                        for table in DEVICE_TABLES:
+                            conn.execute(f'DELETE FROM main.{table} WHERE device_uuid IS ?', (device_uuid,))
+                        reset_rollup_position(conn)
+                    except sqlite3.Error:
+                        conn.execute('ROLLBACK')
+                        raise
+                    conn.execute('COMMIT')
+                    moved += 1
+            finally:
+                conn.execute('DETACH DATABASE target')
+        conn.close()
+    return moved
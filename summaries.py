@@ -0,0 +1,148 @@
+"""
+Per device summaries served from the device_summaries and
+device_histograms tables, which the readings_summarize trigger keeps up to
+date on every insert. Answering from them costs O(devices) no matter how
+many readings are stored.
+
+Summaries with a date filter cannot use those tables and are put together
+from the rollup buckets the range covers whole and the raw readings at its
+edges, archived ones included, like the metrics are (see rollups.py).
+Either way a limit/offset page of the devices with the most readings is
+ranked first, so only the histograms of that page are built.
+"""
+from db import scatter
+from histogram import Histogram
+from partitions import EVERY_READING, archived_readings_table
+from rollups import range_histograms, range_totals_by_device
+
+
+def summary_payload(device_uuid, histogram):
+    """
+    Formats the summary of one device's readings
+    :param device_uuid: the device
+    :param histogram: Histogram of its readings
+    :return: dict
+    """
+    quartiles = [int(q) for q in histogram.quantiles()] if histogram.count >= 2 else [None] * 3
+    return {
+        'device_uuid': device_uuid,
+        'number_of_readings': histogram.count,
+        'max_reading_value': histogram.max,
+        'median_reading_value': int(histogram.median()),
+        'mean_reading_value': histogram.total // histogram.count,
+        'quartile_1_value': quartiles[0],
+        'quartile_3_value': quartiles[2]
+    }
+
+
+def load_summaries(conn, sensor_type=None, limit=None, offset=0):
+    """
+    Returns the summary of every device from the aggregate tables
+    :param conn: sqlite3 connection
+    :param sensor_type: only count readings of this type
+    :param limit: only summarize this many devices, the ones with the most readings
+    :param offset: skip this many devices with the most readings first
+    :return: list of dicts ordered by number of readings, most first
+    """
+    where = 'where type = ? ' if sensor_type else 'where 1=1 '
+    type_params = [sensor_type] if sensor_type else []
+
+    sql = 'select device_uuid, value, SUM(readings_count) from device_histograms ' + where
+    params = list(type_params)
+    if limit is not None or offset:
+        sql += (f'AND device_uuid IN (select device_uuid from device_summaries {where}'
+                f'GROUP BY device_uuid ORDER BY SUM(readings_count) DESC, device_uuid LIMIT ? OFFSET ?) ')
+        params += type_params + [-1 if limit is None else limit, offset]
+    sql += 'GROUP BY device_uuid, value ORDER BY device_uuid'
+
+    return rank_summaries(summaries_from_rows(conn.execute(sql, params)))
+
+
+def query_summaries(conn, filters, limit=None, offset=0):
+    """
+    Returns the summary of every device from the readings matching the filters
+    :param conn: sqlite3 connection
+    :param filters: QueryFilters
+    :param limit: only summarize this many devices, the ones with the most readings
+    :param offset: skip this many devices with the most readings first
+    :return: list of dicts ordered by number of readings, most first
+    """
+    devices = None
+    if limit is not None or offset:
+        # Rank the devices by their counts and only build histograms for the page
+        counts = {device_uuid: totals[0] for device_uuid, totals in range_totals_by_device(conn, None, filters).items()}
+        ranked = sorted(counts, key=lambda device_uuid: (-counts[device_uuid], device_uuid))
+        devices = ranked[offset:None if limit is None else offset + limit]
+    histograms = range_histograms(conn, devices, filters)
+    return rank_summaries([summary_payload(device_uuid, histogram) for device_uuid, histogram in histograms.items()
+                           if histogram.count])
+
+
+def gather_summaries(pools, summarize, limit=None, offset=0):
+    """
+    Summarizes every shard in parallel and merges their rankings. Devices
+    never span shards, so the page is the offset + limit top devices of
+    each shard, ranked together and sliced.
+    :param pools: ConnectionPool of every shard
+    :param summarize: callable taking (conn, limit, offset), e.g. load_summaries with its filters bound
+    :param limit: only summarize this many devices, the ones with the most readings
+    :param offset: skip this many devices with the most readings first
+    :return: list of dicts ordered by number of readings, most first
+    """
+    if len(pools) == 1:
+        return scatter(pools, lambda conn: summarize(conn, limit, offset))[0]
+    shard_limit = None if limit is None else offset + limit
+    merged = rank_summaries([summary for summaries in scatter(pools, lambda conn: summarize(conn, shard_limit, 0))
+                             for summary in summaries])
+    return merged[offset:None if limit is None else offset + limit]
+
+
+def rank_summaries(summaries):
+    """
+    Orders summaries by number of readings, most first, then by device
+    :param summaries: list of dicts
+    :return: list of dicts
+    """
+    return sorted(summaries, key=lambda summary: (-summary['number_of_readings'], summary['device_uuid']))
+
+
+def summaries_from_rows(rows):
+    """
+    Builds summaries from (device_uuid, value, count) rows ordered by device
+    :param rows: iterable of rows
+    :return: list of dicts
+    """
+    payload = []
+    device_uuid = None
+    histogram = None
+    for row in rows:
+        if row[0] != device_uuid:
+            if histogram is not None:
+                payload.append(summary_payload(device_uuid, histogram))
+            device_uuid = row[0]
+            histogram = Histogram()
+        histogram.add(row[1], row[2])
+    if histogram is not None:
+        payload.append(summary_payload(device_uuid, histogram))
+    return payload
+
+
+def rebuild_summaries(conn):
+    """
+    Recomputes the aggregate tables from the readings table and the
+    archives, e.g. to backfill them for readings stored before the trigger
+    existed
+    :param conn: sqlite3 connection
+    """
+    with conn, archived_readings_table(conn):
+        conn.execute('DELETE FROM device_summaries')
+        conn.execute('DELETE FROM device_histograms')
+        conn.execute(f'''INSERT INTO device_summaries
+                             (device_uuid, type, readings_count, value_sum, value_max, value_min)
+                         SELECT device_uuid, type, COUNT(*), SUM(value), MAX(value), MIN(value) FROM {EVERY_READING}
+                         WHERE device_uuid IS NOT NULL AND type IS NOT NULL AND value IS NOT NULL
+                         GROUP BY device_uuid, type''')
+        conn.execute(f'''INSERT INTO device_histograms (device_uuid, type, value, readings_count)
+                         SELECT device_uuid, type, value, COUNT(*) FROM {EVERY_READING}
+                         WHERE device_uuid IS NOT NULL AND type IS NOT NULL AND value IS NOT NULL
+                         GROUP BY device_uuid, type, value''')
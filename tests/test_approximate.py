@@ -0,0 +1,138 @@
+import random
+import sqlite3
+import statistics
+import unittest
+
+from app import app
+from approximate import approximate_fleet_histogram, approximate_histograms, approximate_summaries, plan_approximation
+from cache import get_cache
+from histogram import Histogram
+from partitions import archive_partitions
+from rollups import fleet_histogram, range_histograms
+from schema import drop_schema, migrate, roll_up
+from summaries import query_summaries
+from utils import QueryFilters
+
+
+class PlanApproximationTestCases(unittest.TestCase):
+
+    def test_picks_the_coarsest_granularity_with_enough_buckets(self):
+        self.assertEqual(plan_approximation(0, 999, 10, (100, 10)), (100, 0, 900, []))
+        self.assertEqual(plan_approximation(5, 998, 10, (100, 10)), (10, 0, 990, [0, 990]))
+        # Too narrow for any granularity, the finest is used
+        self.assertEqual(plan_approximation(15, 24, 10, (100, 10)), (10, 10, 20, [10, 20]))
+        self.assertEqual(plan_approximation(-150, 1049, 10, (100, 10)), (100, -200, 1000, [-200, 1000]))
+
+    def test_unbounded_ranges_use_the_coarsest_granularity(self):
+        self.assertEqual(plan_approximation(None, None, 10, (100, 10)), (100, None, None, []))
+        self.assertEqual(plan_approximation(150, None, 10, (100, 10)), (100, 100, None, [100]))
+        self.assertEqual(plan_approximation(None, 99, 10, (100, 10)), (100, None, 0, []))
+
+
+class ApproximateTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(4)
+        self.rows = [(rng.choice('abcd'), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+                      rng.randint(0, 20 * 86400)) for _ in range(3000)]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              self.rows)
+        roll_up(self.conn)
+        self.conn.commit()
+        app.config['TESTING'] = True
+        get_cache(app).clear()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_error_bound_holds(self):
+        rng = random.Random(5)
+        devices = ['a', 'b', 'c', 'd', 'missing']
+        for _ in range(50):
+            start = rng.randint(-86400, 20 * 86400)
+            filters = QueryFilters(start, start + rng.randint(0, 10 * 86400), rng.choice([None, 'humidity']))
+            exact = range_histograms(self.conn, devices, filters)
+
+            for device_uuid, (histogram, edge_readings) in approximate_histograms(self.conn, devices, filters,
+                                                                                  8).items():
+                # Every reading in the range is counted, plus at most the edge buckets' readings outside it
+                extra = [count - expected for count, expected in zip(histogram.counts, exact[device_uuid].counts)]
+                self.assertTrue(all(count >= 0 for count in extra))
+                self.assertLessEqual(sum(extra), edge_readings)
+
+    def test_aligned_ranges_are_exact(self):
+        filters = QueryFilters(86400, 5 * 86400 - 1, None)
+        exact = range_histograms(self.conn, ['a'], filters)['a']
+
+        histogram, edge_readings = approximate_histograms(self.conn, ['a'], filters)['a']
+
+        self.assertEqual(edge_readings, 0)
+        self.assertEqual(histogram.counts, exact.counts)
+
+    def test_summaries(self):
+        filters = QueryFilters(100000, 1500000, 'temperature')
+        exact = {summary['device_uuid']: summary for summary in query_summaries(self.conn, filters)}
+
+        summaries = approximate_summaries(self.conn, filters, min_buckets=8)
+
+        self.assertEqual(sorted(summary['device_uuid'] for summary in summaries), sorted(exact))
+        for summary in summaries:
+            excess = summary['number_of_readings'] - exact[summary['device_uuid']]['number_of_readings']
+            self.assertTrue(0 <= excess <= summary['error']['readings'])
+        self.assertEqual(approximate_summaries(self.conn, filters, limit=2, offset=1, min_buckets=8), summaries[1:3])
+
+    def test_fleet_histograms_merge_every_device(self):
+        archive_partitions(self.conn, 'test_database.db', 5 * 86400, window=86400)
+        rng = random.Random(6)
+        for _ in range(20):
+            start = rng.randint(-86400, 20 * 86400)
+            filters = QueryFilters(start, start + rng.randint(0, 10 * 86400), rng.choice([None, 'humidity']))
+            exact, approximate, edge_readings = Histogram(), Histogram(), 0
+            for histogram in range_histograms(self.conn, list('abcd'), filters).values():
+                exact.merge(histogram)
+            for histogram, edges in approximate_histograms(self.conn, list('abcd'), filters, 8).values():
+                approximate.merge(histogram)
+                edge_readings += edges
+
+            self.assertEqual(fleet_histogram(self.conn, filters).counts, exact.counts)
+            fleet, fleet_edge_readings = approximate_fleet_histogram(self.conn, filters, 8)
+            self.assertEqual((fleet.counts, fleet_edge_readings), (approximate.counts, edge_readings))
+
+    def test_fleet_quantiles(self):
+        values = [row[2] for row in self.rows if row[1] == 'humidity']
+
+        request = app.test_client().get('/devices/readings/quantiles/?type=humidity&q=0.5,0.99')
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json, {
+            'number_of_readings': len(values),
+            'quantiles': {'0.5': int(statistics.median(values)),
+                          '0.99': int(statistics.quantiles(values, n=100)[98])}
+        })
+
+        request = app.test_client().get('/devices/readings/quantiles/?start=1000&end=1500000&approx=true')
+        exact = [row[2] for row in self.rows if 1000 <= row[3] <= 1500000]
+        self.assertEqual(request.status_code, 200)
+        excess = request.json['number_of_readings'] - len(exact)
+        self.assertTrue(0 <= excess <= request.json['error']['readings'])
+        self.assertEqual(request.json['error']['rank'], request.json['error']['readings'] /
+                         request.json['number_of_readings'])
+
+        self.assertEqual(app.test_client().get('/devices/readings/quantiles/?q=1.5').status_code, 400)
+        self.assertEqual(app.test_client().get('/devices/readings/quantiles/?q=half').status_code, 400)
+
+    def test_metric_endpoints(self):
+        client = app.test_client()
+        exact = client.get('/devices/a/readings/median/?start=86400&end=863999')
+        approximate = client.get('/devices/a/readings/median/?start=86400&end=863999&approx=true')
+
+        self.assertNotIn('error', exact.json)
+        self.assertEqual(approximate.json['error'], {'readings': 0, 'rank': 0.0})
+        self.assertEqual(approximate.json['value'], exact.json['value'])
+
+        stats = client.get('/devices/a/readings/stats/?start=1000&end=1500000&approx=true').json
+        self.assertGreater(stats['error']['readings'], 0)
+        self.assertEqual(client.get('/devices/a/readings/max/?approx=maybe').status_code, 400)
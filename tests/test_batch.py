@@ -0,0 +1,113 @@
+import glob
+import json
+import os
+import random
+import sqlite3
+import unittest
+from unittest import mock
+
+import rollups
+from app import app
+from cache import get_cache
+from histogram import histogram_metrics, query_histogram
+from partitions import archive_partitions
+from rollups import range_histograms, range_totals_by_device
+from schema import drop_schema, migrate, roll_up
+from utils import QueryFilters
+
+DAY = 86400
+DEVICES = [f'device-{i}' for i in range(12)]
+
+
+class BatchQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        for path in glob.glob('test_database.archive-*.db'):
+            os.remove(path)
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(8)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (rng.choice(DEVICES[:-1]), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+             rng.randint(0, 6 * DAY))
+            for _ in range(4000)
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+
+        app.config['TESTING'] = True
+        get_cache(app).clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def filters(self):
+        rng = random.Random(9)
+        ranges = [(None, None), (DAY + 7, None)]
+        ranges += [sorted((rng.randint(-DAY, 7 * DAY), rng.randint(-DAY, 7 * DAY))) for _ in range(15)]
+        return [QueryFilters(start, end, rng.choice([None, 'temperature', 'humidity'])) for start, end in ranges]
+
+    def test_grouped_queries_match_a_scan_per_device(self):
+        expected = {filters: {device: query_histogram(self.conn, device, filters) for device in DEVICES}
+                    for filters in self.filters()}
+
+        # Archiving and small chunks must not change any answer
+        archive_partitions(self.conn, 'test_database.db', 2 * DAY, window=DAY)
+        with mock.patch.object(rollups, 'DEVICES_PER_QUERY', 5):
+            for filters, scans in expected.items():
+                histograms = range_histograms(self.conn, DEVICES, filters)
+                totals = range_totals_by_device(self.conn, DEVICES, filters)
+                for device, scan in scans.items():
+                    self.assertEqual(histograms[device].counts, scan.counts)
+                    self.assertEqual(totals[device], (scan.count, scan.total, scan.max, scan.min))
+
+    def test_query_count_does_not_grow_with_devices(self):
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        filters = QueryFilters(DAY + 7, 4 * DAY - 3, None)
+
+        range_histograms(self.conn, DEVICES[:2], filters)
+        few = len(statements)
+        del statements[:]
+        range_histograms(self.conn, DEVICES, filters)
+
+        self.assertEqual(len(statements), few)
+
+    def test_route(self):
+        body = {'devices': ['device-0', 'device-11', 'device-0'], 'metrics': ['count', 'mean', 'median'],
+                'type': 'temperature', 'start': DAY, 'end': 3 * DAY}
+        request = self.client.post('/devices/readings/query/', data=json.dumps(body))
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(list(request.json), ['device-0', 'device-11'])
+        expected = histogram_metrics(query_histogram(self.conn, 'device-0', QueryFilters(DAY, 3 * DAY, 'temperature')),
+                                     ['count', 'mean', 'median'])
+        self.assertEqual(request.json['device-0'], expected)
+        self.assertEqual(request.json['device-11'], {'count': 0, 'mean': None, 'median': None})
+
+    def test_route_totals_metrics_match_single_device_endpoints(self):
+        request = self.client.post('/devices/readings/query/', data=json.dumps(
+            {'devices': DEVICES[:3], 'metrics': ['max', 'min']}))
+
+        for device in DEVICES[:3]:
+            self.assertEqual(request.json[device]['max'],
+                             self.client.get(f'/devices/{device}/readings/max/').json['value'])
+            self.assertEqual(request.json[device]['min'],
+                             self.client.get(f'/devices/{device}/readings/min/').json['value'])
+
+    def test_route_invalid_bodies(self):
+        for body in ({}, {'devices': []}, {'devices': 'device-0'}, {'devices': ['a'], 'metrics': ['p99']},
+                     {'devices': ['a'], 'start': 'yesterday'}, {'devices': ['a'], 'type': 'flavor'}, [1]):
+            request = self.client.post('/devices/readings/query/', data=json.dumps(body))
+            self.assertEqual(request.status_code, 400, body)
+
+        self.assertEqual(self.client.post('/devices/readings/query/', data='not json').status_code, 400)
+
+        app.config['BATCH_QUERY_MAX_DEVICES'] = 2
+        try:
+            request = self.client.post('/devices/readings/query/', data=json.dumps({'devices': DEVICES[:3]}))
+        finally:
+            app.config['BATCH_QUERY_MAX_DEVICES'] = 5000
+        self.assertEqual(request.status_code, 400)
@@ -0,0 +1,83 @@
+import sqlite3
+import time
+import unittest
+
+from cache import ENTRY_OVERHEAD, ChangeFeed, ResponseCache
+from schema import drop_schema, migrate
+from utils import QueryFilters
+
+
+class ResponseCacheTestCases(unittest.TestCase):
+
+    def put(self, cache, key, device_uuid='a', filters=QueryFilters(None, None, None), body=b'x' * 100):
+        cache.put(key, cache.version(device_uuid), body, 'application/json', 'etag', device_uuid, filters)
+
+    def test_evicts_least_recently_used_by_size(self):
+        cache = ResponseCache(max_bytes=3 * (100 + ENTRY_OVERHEAD))
+        for key in ('one', 'two', 'three'):
+            self.put(cache, key)
+        cache.get('one')
+        self.put(cache, 'four')
+
+        self.assertIsNone(cache.get('two'))
+        self.assertIsNotNone(cache.get('one'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertLessEqual(cache.stats()['bytes'], cache.max_bytes)
+
+    def test_entries_expire(self):
+        cache = ResponseCache(ttl=0.01)
+        self.put(cache, 'one')
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('one'))
+
+    def test_only_covering_inserts_invalidate(self):
+        cache = ResponseCache()
+        self.put(cache, 'range', filters=QueryFilters(10, 20, 'humidity'))
+        self.put(cache, 'summary', device_uuid=None, filters=QueryFilters(None, 20, None))
+
+        cache.invalidate([('a', 'humidity', 1, 30), ('a', 'temperature', 1, 15), ('b', 'humidity', 1, 15)])
+        self.assertIsNotNone(cache.get('range'))
+        self.assertIsNone(cache.get('summary'))
+
+        cache.invalidate([('a', 'humidity', 1, 10)])
+        self.assertIsNone(cache.get('range'))
+
+    def test_results_computed_across_an_insert_are_not_stored(self):
+        cache = ResponseCache()
+        version = cache.version('a')
+        cache.invalidate([('a', 'humidity', 1, 10)])
+        cache.put('stale', version, b'{}', 'application/json', 'etag', 'a', QueryFilters(None, None, None))
+
+        self.assertIsNone(cache.get('stale'))
+
+    def test_change_feed_sees_other_connections_commits(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_schema(conn)
+        migrate(conn)
+        feed = ChangeFeed('test_database.db')
+        self.assertEqual(feed.changes(), [])
+
+        # Given another process inserts a reading
+        with conn:
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         ('a', 'humidity', 5, 10))
+        self.assertEqual(feed.changes(), [('a', 'humidity', 10, 10)])
+        self.assertEqual(feed.changes(), [])
+
+        # Many readings come back as the range of their dates per device and type, leaving out skipped rowids
+        with conn:
+            conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                             [('a', 'humidity', 5, 30), ('a', 'humidity', 5, 20), ('b', 'humidity', 5, 99),
+                              ('a', 'humidity', 5, 40)])
+        self.assertEqual(sorted(feed.changes(skip=[(4, 4)])), [('a', 'humidity', 20, 40)])
+        with conn:
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         ('b', 'humidity', 5, 7))
+        self.assertEqual(feed.changes(skip=[(6, 6)]), [])
+
+        # A rebuilt table cannot be followed row by row
+        drop_schema(conn)
+        migrate(conn)
+        self.assertIsNone(feed.changes())
+        conn.close()
@@ -0,0 +1,128 @@
+import glob
+import os
+import random
+import shutil
+import sqlite3
+import unittest
+from unittest import mock
+
+from app import app
+from cache import get_cache
+from columnar import ColumnStore, column_directory, np
+from partitions import archive_partitions
+from rollups import range_histogram, range_totals
+from schema import drop_schema, migrate, roll_up
+from utils import QueryFilters
+
+DAY = 86400
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class ColumnarParityTestCases(unittest.TestCase):
+
+    def setUp(self):
+        for path in glob.glob('test_database.archive-*.db'):
+            os.remove(path)
+        shutil.rmtree(column_directory('test_database.db'), ignore_errors=True)
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        self.rng = random.Random(5)
+        self.insert(3000)
+        self.store = ColumnStore(column_directory('test_database.db'))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def insert(self, count):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (self.rng.choice(['a', 'b']), self.rng.choice(['temperature', 'humidity']), self.rng.randint(0, 100),
+             self.rng.randint(-DAY, 6 * DAY))
+            for _ in range(count)
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+
+    def assert_parity(self):
+        rng = random.Random(6)
+        ranges = [(None, None), (None, 2 * DAY), (DAY + 7, None)]
+        ranges += [sorted((rng.randint(-2 * DAY, 7 * DAY), rng.randint(-2 * DAY, 7 * DAY))) for _ in range(40)]
+        for start, end in ranges:
+            for sensor_type in (None, 'temperature', 'humidity', 'flavor'):
+                filters = QueryFilters(start, end, sensor_type)
+                expected = range_histogram(self.conn, 'a', filters)
+                histogram = self.store.histogram(self.conn, 'a', filters)
+
+                self.assertEqual(histogram.counts, expected.counts)
+                self.assertEqual(histogram.total, expected.total)
+                if expected.count:
+                    self.assertEqual(histogram.mode(), expected.mode())
+                    self.assertEqual(histogram.median(), expected.median())
+                self.assertEqual(self.store.totals(self.conn, 'a', filters), range_totals(self.conn, 'a', filters))
+
+    def test_matches_sql_engine(self):
+        self.assert_parity()
+
+    def test_columns_follow_inserts_and_archival(self):
+        self.assert_parity()
+        self.insert(200)
+        self.assert_parity()
+        archive_partitions(self.conn, 'test_database.db', 3 * DAY, window=DAY)
+        self.assert_parity()
+
+    def test_inserts_are_merged_without_a_rebuild(self):
+        self.store.columns(self.conn, 'a')
+        self.insert(200)
+
+        with mock.patch.object(ColumnStore, '_build', side_effect=AssertionError('rebuilt')):
+            self.assert_parity()
+            # As another process would find them
+            reopened = ColumnStore(column_directory('test_database.db'))
+            self.assertEqual(reopened.columns(self.conn, 'a').version, self.store.columns(self.conn, 'a').version)
+
+    def test_inserts_racing_a_build_cause_no_second_build(self):
+        # As the app's pools open it, so readers do not hold off writers
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        version = ColumnStore.version
+
+        def version_then_insert(store, conn, device_uuid):
+            # Given another process commits readings right after the version is read
+            current = version(store, conn, device_uuid)
+            other = sqlite3.connect('test_database.db')
+            with other:
+                other.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('a','humidity',1,0)")
+                roll_up(other)
+            other.close()
+            return current
+
+        with mock.patch.object(ColumnStore, 'version', version_then_insert):
+            self.store.columns(self.conn, 'a')
+
+        build = ColumnStore._build
+        with mock.patch.object(ColumnStore, '_build', autospec=True, side_effect=build) as builds:
+            self.assert_parity()
+        self.assertEqual(builds.call_count, 0)
+
+    def test_columns_are_reused_from_disk(self):
+        self.store.columns(self.conn, 'a')
+        reopened = ColumnStore(column_directory('test_database.db'))
+
+        columns = reopened.columns(self.conn, 'a')
+
+        self.assertIsInstance(columns.dates, np.memmap)
+        self.assertTrue(np.all(np.diff(columns.dates) >= 0))
+
+    def test_endpoints_match_across_engines(self):
+        app.config['TESTING'] = True
+        client = app.test_client()
+        urls = ['/devices/a/readings/stats/', '/devices/a/readings/max/?start={}'.format(DAY),
+                '/devices/a/readings/quartiles/?type=humidity&end={}'.format(3 * DAY + 5)]
+        get_cache(app).clear()
+        expected = [client.get(url).json for url in urls]
+
+        app.config['ANALYTIC_ENGINE'] = 'columnar'
+        try:
+            get_cache(app).clear()
+            self.assertEqual([client.get(url).json for url in urls], expected)
+        finally:
+            app.config['ANALYTIC_ENGINE'] = 'sql'
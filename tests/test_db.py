@@ -0,0 +1,65 @@
+import threading
+import unittest
+
+from db import ConnectionPool, PoolTimeout
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool('test_database.db', size=1, timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connections_are_configured(self):
+        with self.pool.connection() as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            # NORMAL
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(conn.execute('PRAGMA cache_size').fetchone()[0], -16384)
+
+    def test_connections_are_reused(self):
+        with self.pool.connection() as conn:
+            first = conn
+        with self.pool.connection() as conn:
+            second = conn
+
+        self.assertIs(first, second)
+        stats = self.pool.stats()
+        self.assertEqual(stats['open'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_waits_are_counted(self):
+        conn = self.pool.acquire()
+        self.assertEqual(self.pool.stats()['in_use'], 1)
+
+        # Given the only connection is checked out, a second caller has to wait for it
+        releaser = threading.Timer(0.05, self.pool.release, args=(conn,))
+        releaser.start()
+        with self.pool.connection():
+            pass
+        releaser.join()
+
+        stats = self.pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['wait_time'], 0)
+
+    def test_exhausted_pool_times_out(self):
+        conn = self.pool.acquire()
+
+        with self.assertRaises(PoolTimeout):
+            self.pool.acquire(timeout=0.01)
+        self.pool.release(conn)
+
+    def test_uncommitted_work_is_rolled_back_on_release(self):
+        with self.pool.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS pool_scratch (x INTEGER)')
+            conn.execute('insert into pool_scratch VALUES (1)')
+            self.assertTrue(conn.in_transaction)
+
+        with self.pool.connection() as conn:
+            self.assertFalse(conn.in_transaction)
+            self.assertEqual(conn.execute('select count(*) from pool_scratch').fetchone()[0], 0)
+            conn.execute('DROP TABLE pool_scratch')
@@ -0,0 +1,47 @@
+import struct
+import unittest
+
+from frames import FRAME_MAGIC, HEADER, RECORD, FrameError, decode_frame, encode_frame
+
+
+class FramesTestCases(unittest.TestCase):
+
+    def test_round_trip_with_and_without_header(self):
+        readings = [(1000, 'temperature', 0), (1001, 'humidity', 100), (-5, 'temperature', 42)]
+
+        for header in (True, False):
+            body = encode_frame(readings, header=header)
+            self.assertEqual(len(body), RECORD.size * 3 + (HEADER.size if header else 0))
+
+            rows, errors = decode_frame('device', body)
+
+            self.assertEqual(errors, [])
+            self.assertEqual(rows, [('device', t, v, d) for d, t, v in readings])
+
+    def test_empty_frame(self):
+        self.assertEqual(decode_frame('device', b''), ([], []))
+        self.assertEqual(decode_frame('device', encode_frame([])), ([], []))
+
+    def test_bad_records_are_reported_by_index(self):
+        body = b''.join([RECORD.pack(1, 0, 10), RECORD.pack(2, 7, 10), RECORD.pack(3, 1, 101), RECORD.pack(4, 9, 200)])
+
+        rows, errors = decode_frame('device', body)
+
+        self.assertEqual(rows, [('device', 'temperature', 10, 1)])
+        self.assertEqual([e['index'] for e in errors], [1, 2, 3])
+        self.assertEqual(len(errors[2]['errors']), 2)
+
+    def test_malformed_frames(self):
+        records = encode_frame([(1, 'temperature', 1), (2, 'humidity', 2)], header=False)
+
+        with self.assertRaises(FrameError):
+            decode_frame('device', records[:-1])
+        with self.assertRaises(FrameError):
+            decode_frame('device', b'XXXX' + encode_frame([(1, 'temperature', 1)])[4:])
+        with self.assertRaises(FrameError):
+            decode_frame('device', HEADER.pack(FRAME_MAGIC, 1, RECORD.size, 3) + records)
+        with self.assertRaises(FrameError):
+            decode_frame('device', struct.pack('<4sHHI', FRAME_MAGIC, 2, RECORD.size, 2) + records)
+        # Too short for a header, yet as long as one modulo the record size
+        with self.assertRaises(FrameError):
+            decode_frame('device', b'\x00' * (HEADER.size % RECORD.size))
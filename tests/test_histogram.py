@@ -0,0 +1,95 @@
+import random
+import sqlite3
+import statistics
+import unittest
+
+from histogram import METRICS, Histogram, histogram_metrics, query_histogram
+from schema import drop_schema, migrate
+from utils import QueryFilters
+
+
+def histogram_of(values):
+    histogram = Histogram()
+    for value in values:
+        histogram.add(value)
+    return histogram
+
+
+class HistogramTestCases(unittest.TestCase):
+
+    def test_matches_statistics_module(self):
+        rng = random.Random(0)
+        for size in list(range(2, 12)) + [101, 1000]:
+            values = [rng.randint(0, 100) for _ in range(size)]
+            histogram = histogram_of(values)
+
+            self.assertEqual(histogram.count, len(values))
+            self.assertEqual(histogram.max, max(values))
+            self.assertEqual(histogram.median(), statistics.median(values))
+            self.assertEqual(histogram.quantiles(), statistics.quantiles(values))
+            self.assertEqual(histogram.min, min(values))
+            for n in (4, 10, 100):
+                for cut, expected in zip([histogram.quantile(i / n) for i in range(1, n)],
+                                         statistics.quantiles(values, n=n)):
+                    self.assertAlmostEqual(cut, expected)
+
+    def test_mode_ties_go_to_first_seen(self):
+        histogram = Histogram()
+        for position, value in enumerate([7, 3, 3, 7, 1]):
+            histogram.add(value, first_seen=position)
+
+        self.assertEqual(histogram.mode(), statistics.mode([7, 3, 3, 7, 1]))
+        self.assertEqual(histogram_of([7, 3, 3, 7]).mode(), 3)
+
+    def test_merge(self):
+        merged = histogram_of([1, 2])
+        merged.merge(histogram_of([2, 90]))
+
+        self.assertEqual(merged.counts, histogram_of([1, 2, 2, 90]).counts)
+        self.assertEqual(merged.total, 95)
+
+    def test_not_enough_data(self):
+        with self.assertRaises(statistics.StatisticsError):
+            Histogram().median()
+        with self.assertRaises(statistics.StatisticsError):
+            histogram_of([5]).quantiles()
+        self.assertIsNone(Histogram().max)
+
+
+    def test_metrics(self):
+        self.assertEqual(histogram_metrics(histogram_of([0, 0, 10, 50])), {
+            'count': 4, 'max': 50, 'min': 0, 'mean': 15, 'median': 5, 'mode': 0, 'q1': 0, 'q3': 40
+        })
+        self.assertEqual(histogram_metrics(Histogram()), {**dict.fromkeys(METRICS), 'count': 0})
+        with self.assertRaises(ValueError):
+            histogram_metrics(Histogram(), ['p99'])
+
+class QueryHistogramTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_matches_statistics_over_raw_rows(self):
+        rng = random.Random(1)
+        rows = [('device', rng.choice(['temperature', 'humidity']), rng.randint(0, 20), rng.randint(0, 1000))
+                for _ in range(500)]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+
+        for filters in (QueryFilters(None, None, None), QueryFilters(100, 600, 'humidity'), QueryFilters(900, None, None)):
+            histogram = query_histogram(self.conn, 'device', filters)
+            values = [
+                row[2] for row in rows
+                if (filters.sensor_type is None or row[1] == filters.sensor_type)
+                and (filters.start is None or row[3] >= filters.start)
+                and (filters.end is None or row[3] <= filters.end)
+            ]
+
+            self.assertEqual(histogram.count, len(values))
+            self.assertEqual(histogram.median(), statistics.median(values))
+            self.assertEqual(histogram.mode(), statistics.mode(values))
+            self.assertEqual(histogram.quantiles(), statistics.quantiles(values))
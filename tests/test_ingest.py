@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+import unittest
+
+from ingest import GroupCommitWriter, IngestQueueFull
+from rollups import range_totals
+from schema import drop_schema, migrate
+from utils import QueryFilters
+
+
+class GroupCommitWriterTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_schema(conn)
+        migrate(conn)
+        conn.close()
+
+    def count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        count = conn.execute('select count(*) from readings').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_concurrent_submissions_share_a_commit(self):
+        # Given a writer with a window wide enough to catch every request
+        writer = GroupCommitWriter('test_database.db', window=0.5, max_rows=100)
+        barrier = threading.Barrier(10)
+
+        def post(i):
+            barrier.wait()
+            writer.write([('device_{}'.format(i), 'temperature', i, 1000 + i)])
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        # Then every row is stored with far fewer commits than requests
+        self.assertEqual(self.count_readings(), 10)
+        self.assertEqual(writer.rows_committed, 10)
+        self.assertLess(writer.batches_committed, 10)
+
+    def test_batch_is_committed_once_full(self):
+        writer = GroupCommitWriter('test_database.db', window=60, max_rows=3)
+
+        inserted = writer.write([('device', 'humidity', v, 1000) for v in range(3)], timeout=5)
+        writer.close()
+
+        self.assertEqual(inserted, 3)
+        self.assertEqual(writer.batches_committed, 1)
+
+    def test_errors_are_raised_to_every_waiter(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE readings')
+        conn.close()
+        writer = GroupCommitWriter('test_database.db', window=0)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            writer.write([('device', 'humidity', 1, 1000)], timeout=5)
+        writer.close()
+
+    def test_writer_survives_errors_outside_sqlite(self):
+        writer = GroupCommitWriter('test_database.db', window=0)
+
+        # Given a row SQLite cannot bind, the batch fails but the writer keeps going
+        with self.assertRaises(OverflowError):
+            writer.write([('device', 'humidity', 1, 10 ** 30)], timeout=5)
+        self.assertEqual(writer.write([('device', 'humidity', 1, 1000)], timeout=5), 1)
+        writer.close()
+
+    def test_submissions_past_max_pending_are_refused(self):
+        writer = GroupCommitWriter('test_database.db', window=60, max_rows=1000, max_pending=3)
+
+        future = writer.submit([('device', 'humidity', v, 1000) for v in range(2)])
+        with self.assertRaises(IngestQueueFull):
+            writer.submit([('device', 'humidity', v, 1000) for v in range(2)])
+        writer.submit([('device', 'humidity', 5, 1000)])
+        self.assertEqual(writer.stats()['pending_rows'], 3)
+        writer.close()
+
+        stats = writer.stats()
+        self.assertEqual(future.result(), 2)
+        self.assertEqual((stats['pending_rows'], stats['rows_committed'], stats['rejected']), (0, 3, 1))
+        self.assertGreater(stats['drain_latency_max'], 0)
+
+    def test_batches_are_rolled_up(self):
+        writer = GroupCommitWriter('test_database.db', window=0)
+
+        writer.write([('device', 'humidity', v, 1000 + v) for v in range(3)], timeout=5)
+        writer.write([('device', 'humidity', 9, 90000)], timeout=5)
+        writer.close()
+
+        conn = sqlite3.connect('test_database.db')
+        try:
+            # A whole day, answered from the day bucket alone
+            self.assertEqual(range_totals(conn, 'device', QueryFilters(0, 86399, None)), (3, 3, 2, 0))
+            self.assertEqual(conn.execute('select last_rowid from rollup_position').fetchone()[0], 4)
+        finally:
+            conn.close()
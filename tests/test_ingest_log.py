@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import unittest
+from unittest import mock
+
+from app import app
+from ingest import INSERT_READING_SQL, GroupCommitWriter, close_writers, get_writer
+import ingest_log
+from ingest_log import UPDATE_POSITION_SQL, IngestLog, log_paths, read_records, replay_logs
+from schema import drop_schema, migrate
+
+
+class IngestLogTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        for path in log_paths('test_database.db'):
+            os.remove(path)
+
+    def tearDown(self):
+        self.conn.close()
+        for path in log_paths('test_database.db'):
+            os.remove(path)
+
+    def readings(self):
+        return self.conn.execute('select device_uuid, type, value, date_created from readings '
+                                 'ORDER BY date_created').fetchall()
+
+    def test_writer_applies_and_removes_its_log(self):
+        for durability in ('request', 'group', 'async'):
+            log = IngestLog('test_database.db', durability=durability)
+            writer = GroupCommitWriter('test_database.db', window=0.01, log=log)
+
+            self.assertEqual(writer.write([('a', 'temperature', 1, 10), ('a', 'humidity', 2, 11)], timeout=5), 2)
+            writer.write([('b', 'temperature', 3, 12)], timeout=5)
+            self.assertEqual(list(read_records(log.path)), [
+                (1, [('a', 'temperature', 1, 10), ('a', 'humidity', 2, 11)]), (2, [('b', 'temperature', 3, 12)])])
+            self.assertEqual(writer.stats()['log']['sequence'], 2)
+            writer.close()
+
+            self.assertEqual(log_paths('test_database.db'), [])
+            self.assertEqual(self.conn.execute('select COUNT(*) from ingest_log_positions').fetchone()[0], 0)
+        self.assertEqual(len(self.readings()), 9)
+
+    def test_replay_skips_what_was_applied(self):
+        log = IngestLog('test_database.db', durability='request')
+        first = log.append([('a', 'temperature', 1, 10)])
+        log.append([('a', 'temperature', 2, 20), ('b', 'humidity', 3, 30)])
+        # Given the process died after committing its first record only
+        with self.conn:
+            self.conn.execute(INSERT_READING_SQL, ('a', 'temperature', 1, 10))
+            self.conn.execute(UPDATE_POSITION_SQL, (log.name, first))
+        log.close()
+
+        self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 2)
+        self.assertEqual(self.readings(), [('a', 'temperature', 1, 10), ('a', 'temperature', 2, 20),
+                                           ('b', 'humidity', 3, 30)])
+        self.assertEqual(log_paths('test_database.db'), [])
+        self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 0)
+
+    def test_applied_segments_are_deleted_under_sustained_ingest(self):
+        with mock.patch.object(ingest_log, 'SEGMENT_BYTES', 1):
+            log = IngestLog('test_database.db', durability='group')
+            writer = GroupCommitWriter('test_database.db', window=0.01, log=log)
+            for value in range(20):
+                writer.write([('a', 'temperature', value, value)], timeout=5)
+
+            # Every segment but the current one and the one it just left was applied and deleted
+            self.assertLessEqual(len(log_paths('test_database.db')), 2)
+            self.assertLessEqual(writer.stats()['log']['segments'], 2)
+            writer.close()
+
+        self.assertEqual(log_paths('test_database.db'), [])
+        self.assertEqual(len(self.readings()), 20)
+
+    def test_replay_continues_across_segments(self):
+        with mock.patch.object(ingest_log, 'SEGMENT_BYTES', 1):
+            log = IngestLog('test_database.db', durability='request')
+            first = log.append([('a', 'temperature', 1, 10)])
+            log.truncate(0)
+            log.append([('a', 'temperature', 2, 20)])
+            log.truncate(0)
+            log.append([('b', 'humidity', 3, 30)])
+        # Given the process died after committing its first record only
+        with self.conn:
+            self.conn.execute(INSERT_READING_SQL, ('a', 'temperature', 1, 10))
+            self.conn.execute(UPDATE_POSITION_SQL, (log.name, first))
+        log.close()
+        self.assertEqual(len(log_paths('test_database.db')), 3)
+
+        self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 2)
+        self.assertEqual(self.readings(), [('a', 'temperature', 1, 10), ('a', 'temperature', 2, 20),
+                                           ('b', 'humidity', 3, 30)])
+        self.assertEqual(log_paths('test_database.db'), [])
+        self.assertEqual(self.conn.execute('select COUNT(*) from ingest_log_positions').fetchone()[0], 0)
+
+    def test_segments_are_locked_before_they_are_named(self):
+        log = IngestLog('test_database.db', durability='request')
+        renamed = []
+
+        def rename(source, destination):
+            # Replay must not get the segment the moment it has its name
+            self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 0)
+            os.replace(source, destination)
+            renamed.append(destination)
+            self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 0)
+            self.assertTrue(os.path.exists(destination))
+
+        with mock.patch.object(ingest_log, 'SEGMENT_BYTES', 1), mock.patch('ingest_log.os.rename', rename):
+            log.append([('a', 'temperature', 1, 10)])
+            log.truncate(0)
+        self.assertEqual(renamed, [log.path])
+        log.close()
+
+    def test_torn_tail_is_ignored(self):
+        log = IngestLog('test_database.db', durability='request')
+        log.append([('a', 'temperature', 1, 10)])
+        path = log.path
+        log.close()
+        with open(path, 'rb') as log_file:
+            record = log_file.read()
+        with open(path, 'ab') as torn:
+            torn.write(record[:len(record) - 3])
+
+        self.assertEqual(list(read_records(path)), [(1, [('a', 'temperature', 1, 10)])])
+        self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 1)
+
+    def test_logs_of_running_processes_are_left_alone(self):
+        log = IngestLog('test_database.db', durability='group')
+        log.wait(log.append([('a', 'temperature', 1, 10)]))
+
+        self.assertEqual(replay_logs(self.conn, 'test_database.db', INSERT_READING_SQL), 0)
+        self.assertEqual(log_paths('test_database.db'), [log.path])
+        log.close()
+
+    def test_async_posts_are_logged(self):
+        app.config['TESTING'] = True
+        app.config['INGEST_ASYNC'] = True
+        app.config['INGEST_LOG_DURABILITY'] = 'group'
+        close_writers()
+        try:
+            request = app.test_client().post('/devices/logged/readings/',
+                                             json={'type': 'temperature', 'value': 40, 'date_created': 100})
+            self.assertEqual(request.status_code, 202)
+            self.assertEqual(get_writer(app, 'logged').stats()['log']['synced'], 1)
+        finally:
+            close_writers()
+            app.config['INGEST_ASYNC'] = False
+            app.config['INGEST_LOG_DURABILITY'] = 'off'
+
+        self.assertEqual(self.readings(), [('logged', 'temperature', 40, 100)])
+        self.assertEqual(log_paths('test_database.db'), [])
@@ -0,0 +1,53 @@
+import random
+import sqlite3
+import unittest
+
+from latest import load_latest, rebuild_latest, silent_devices
+from schema import drop_schema, migrate
+
+
+class LatestTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def insert(self, rows):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        self.conn.commit()
+
+    def test_late_readings_do_not_replace_newer_ones(self):
+        self.insert([('a', 'temperature', 10, 100), ('a', 'temperature', 20, 300), ('a', 'temperature', 30, 200),
+                     ('a', 'humidity', 40, 150), ('a', 'humidity', 50, 150)])
+
+        self.assertEqual(load_latest(self.conn, 'a'), {
+            'device_uuid': 'a',
+            'last_reported': 300,
+            'readings': {'temperature': {'value': 20, 'date_created': 300},
+                         'humidity': {'value': 50, 'date_created': 150}}
+        })
+        self.assertEqual(load_latest(self.conn, 'a', 'humidity')['last_reported'], 150)
+        self.assertEqual(load_latest(self.conn, 'b'), {'device_uuid': 'b', 'last_reported': None, 'readings': {}})
+
+    def test_rebuild_matches_trigger(self):
+        rng = random.Random(2)
+        self.insert([(rng.choice('abc'), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+                      rng.randint(0, 50)) for _ in range(500)])
+        maintained = self.conn.execute('select * from device_latest ORDER BY device_uuid, type').fetchall()
+
+        rebuild_latest(self.conn)
+
+        self.assertEqual(self.conn.execute('select * from device_latest ORDER BY device_uuid, type').fetchall(),
+                         maintained)
+
+    def test_silent_devices(self):
+        self.insert([('a', 'temperature', 1, 100), ('a', 'humidity', 1, 500), ('b', 'temperature', 1, 200),
+                     ('c', 'humidity', 1, 50)])
+
+        self.assertEqual(silent_devices(self.conn, 300), [('c', 50), ('b', 200)])
+        self.assertEqual(silent_devices(self.conn, 300, 'temperature'), [('a', 100), ('b', 200)])
+        self.assertEqual(silent_devices(self.conn, 50), [])
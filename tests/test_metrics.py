@@ -0,0 +1,80 @@
+import sqlite3
+import time
+import unittest
+
+from app import app
+from cache import get_cache
+from metrics import BucketHistogram
+from schema import drop_schema, migrate
+
+
+class BucketHistogramTestCases(unittest.TestCase):
+
+    def test_lines_are_cumulative(self):
+        histogram = BucketHistogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.lines('rows', 'route="/x/"'), [
+            'rows_bucket{route="/x/",le="1"} 2',
+            'rows_bucket{route="/x/",le="10"} 3',
+            'rows_bucket{route="/x/",le="+Inf"} 4',
+            'rows_sum{route="/x/"} 56.5',
+            'rows_count{route="/x/"} 4',
+        ])
+
+
+class MetricsRoutesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_schema(conn)
+        migrate(conn)
+        now = int(time.time())
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('metrics_device', 'temperature', value, now + value) for value in range(10)])
+        conn.commit()
+        conn.close()
+
+        app.config['TESTING'] = True
+        get_cache(app).clear()
+        self.client = app.test_client()
+
+    def metric_lines(self, prefix):
+        request = self.client.get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.mimetype.startswith('text/plain'))
+        return [line for line in request.get_data(as_text=True).splitlines() if line.startswith(prefix)]
+
+    def test_phases_and_rows_are_recorded_per_route(self):
+        route = 'route="/devices/<string:device_uuid>/readings/"'
+        before = self.metric_lines('http_request_sql_rows_sum{' + route)
+
+        self.assertEqual(self.client.get('/devices/metrics_device/readings/').status_code, 200)
+
+        rows = self.metric_lines('http_request_sql_rows_sum{' + route)
+        fetched = float(rows[0].split()[-1]) - (float(before[0].split()[-1]) if before else 0)
+        self.assertEqual(fetched, 10)
+        self.assertTrue(self.metric_lines(f'http_requests_total{{{route},method="GET",status="200"}}'))
+        for phase in ('acquire', 'build', 'execute', 'fetch', 'aggregate', 'serialize'):
+            self.assertTrue(self.metric_lines(f'http_request_phase_seconds_count{{{route},phase="{phase}"}}'))
+        self.assertTrue(self.metric_lines(f'http_request_duration_seconds_bucket{{{route},method="GET",le="+Inf"}}'))
+
+    def test_unmatched_routes_share_a_label(self):
+        self.client.get('/no/such/route/')
+
+        self.assertTrue(self.metric_lines('http_requests_total{route="unmatched",method="GET",status="404"}'))
+
+    def test_slow_requests_are_profiled_when_enabled(self):
+        app.config['SLOW_REQUEST_PROFILING'] = True
+        try:
+            app.extensions.pop('slow_request_profiler', None)
+            app.config['SLOW_REQUEST_SECONDS'] = 0.0
+            self.client.get('/devices/metrics_device/readings/median/')
+        finally:
+            app.config['SLOW_REQUEST_PROFILING'] = False
+            app.config['SLOW_REQUEST_SECONDS'] = 1.0
+
+        profiles = self.client.get('/stats/slow-requests/').json
+        self.assertEqual(profiles[0]['route'], '/devices/<string:device_uuid>/readings/median/')
+        self.assertIn('execute', profiles[0]['phases'])
@@ -0,0 +1,153 @@
+import glob
+import os
+import random
+import sqlite3
+import unittest
+
+from latest import load_latest, rebuild_latest
+from partitions import archive_partitions, decode_deltas, drop_partitions, encode_deltas
+from readings import decode_cursor, merged_readings, query_page
+from rollups import range_histogram, range_totals, rebuild_rollups
+from schema import drop_schema, migrate, roll_up
+from series import date_range, query_series
+from summaries import load_summaries, query_summaries, rebuild_summaries
+from utils import QueryFilters
+
+DAY = 86400
+
+
+class PartitionTestCases(unittest.TestCase):
+
+    def setUp(self):
+        for path in glob.glob('test_database.archive-*.db'):
+            os.remove(path)
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(3)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (rng.choice(['a', 'b']), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+             rng.randint(0, 10 * DAY))
+            for _ in range(3000)
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def ranges(self):
+        rng = random.Random(4)
+        ranges = [(None, None), (None, 3 * DAY + 17), (DAY - 5, None)]
+        ranges += [sorted((rng.randint(-DAY, 11 * DAY), rng.randint(-DAY, 11 * DAY))) for _ in range(30)]
+        return [QueryFilters(start, end, rng.choice([None, 'temperature', 'humidity'])) for start, end in ranges]
+
+    def metrics(self):
+        results = []
+        for filters in self.ranges():
+            histogram = range_histogram(self.conn, 'a', filters)
+            results.append((histogram.counts, histogram.mode() if histogram.count else None,
+                            range_totals(self.conn, 'a', filters)))
+        return results
+
+    def test_deltas_round_trip(self):
+        numbers = [5, 5, 9, -3, 2 ** 40]
+
+        self.assertEqual(decode_deltas(encode_deltas(numbers)), numbers)
+
+    def test_archived_readings_still_answer_metrics(self):
+        expected = self.metrics()
+
+        windows = archive_partitions(self.conn, 'test_database.db', 6 * DAY + 100, window=2 * DAY)
+
+        self.assertEqual(windows, [0, 2 * DAY, 4 * DAY])
+        self.assertEqual(len(glob.glob('test_database.archive-*.db')), 3)
+        self.assertEqual(self.conn.execute('select MIN(date_created) from readings').fetchone()[0] // DAY, 6)
+        self.assertEqual(self.metrics(), expected)
+        # Running it again leaves archived windows alone
+        self.assertEqual(archive_partitions(self.conn, 'test_database.db', 6 * DAY + 100, window=2 * DAY), [])
+
+    def test_dropped_windows_are_gone(self):
+        expected = query_summaries(self.conn, QueryFilters(4 * DAY, None, None))
+        archive_partitions(self.conn, 'test_database.db', 3 * DAY, window=2 * DAY)
+
+        cutoff = drop_partitions(self.conn, 'test_database.db', 5 * DAY, window=2 * DAY)
+
+        self.assertEqual(cutoff, 4 * DAY)
+        self.assertEqual(glob.glob('test_database.archive-*.db'), [])
+        self.assertEqual(range_totals(self.conn, 'a', QueryFilters(None, cutoff - 1, None)), (0, 0, None, None))
+        self.assertEqual(load_summaries(self.conn), expected)
+
+    def readings(self, device_uuid, filters=QueryFilters(None, None, None)):
+        return [row[1:] for row in merged_readings(self.conn, device_uuid, filters)]
+
+    def test_archived_readings_still_listed(self):
+        filters = QueryFilters(DAY + 5, 7 * DAY, 'humidity')
+        expected = [self.readings('a'), self.readings('a', filters), query_summaries(self.conn, filters),
+                    query_summaries(self.conn, filters, limit=1, offset=1),
+                    query_series(self.conn, 'a', QueryFilters(0, 10 * DAY, None), 0, 1000),
+                    date_range(self.conn, 'a', QueryFilters(None, None, None))]
+
+        archive_partitions(self.conn, 'test_database.db', 6 * DAY, window=2 * DAY)
+
+        self.assertEqual([self.readings('a'), self.readings('a', filters), query_summaries(self.conn, filters),
+                          query_summaries(self.conn, filters, limit=1, offset=1),
+                          query_series(self.conn, 'a', QueryFilters(0, 10 * DAY, None), 0, 1000),
+                          date_range(self.conn, 'a', QueryFilters(None, None, None))], expected)
+        self.assertEqual(query_summaries(self.conn, QueryFilters(0, None, None)), load_summaries(self.conn))
+
+        # Pages cross from the archives into the readings table without losing or repeating any
+        listed = []
+        page, cursor = query_page(self.conn, 'a', QueryFilters(None, None, None), 400)
+        while True:
+            listed += [tuple(reading.values()) for reading in page]
+            if cursor is None:
+                break
+            page, cursor = query_page(self.conn, 'a', QueryFilters(None, None, None), 400, decode_cursor(cursor))
+        self.assertEqual(listed, expected[0])
+
+    def test_dropping_refreshes_the_latest_readings(self):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('old', 'humidity', 7, DAY), ('old', 'humidity', 8, 3 * DAY),
+                               ('older', 'humidity', 9, DAY)])
+        roll_up(self.conn)
+        self.conn.commit()
+        archive_partitions(self.conn, 'test_database.db', 4 * DAY, window=2 * DAY)
+
+        drop_partitions(self.conn, 'test_database.db', 2 * DAY, window=2 * DAY)
+
+        self.assertEqual(load_latest(self.conn, 'old')['readings'],
+                         {'humidity': {'value': 8, 'date_created': 3 * DAY}})
+        self.assertEqual(load_latest(self.conn, 'older')['readings'], {})
+        self.assertEqual(self.conn.execute('select COUNT(*) from readings where date_created < ?',
+                                           (2 * DAY,)).fetchone()[0], 0)
+
+    def test_rowids_freed_by_archiving_are_rolled_up(self):
+        # Given the newest readings are the oldest by date, archiving frees the highest rowids
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('c', 'humidity', value, DAY) for value in range(5)])
+        roll_up(self.conn)
+        self.conn.commit()
+        archive_partitions(self.conn, 'test_database.db', 2 * DAY, window=2 * DAY)
+
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('c', 'humidity', value, 9 * DAY) for value in range(2)])
+        roll_up(self.conn)
+        self.conn.commit()
+
+        self.assertEqual(range_totals(self.conn, 'c', QueryFilters(None, None, None))[0], 7)
+        self.assertEqual(load_summaries(self.conn)[-1]['number_of_readings'], 7)
+
+    def test_rebuilds_count_archived_readings(self):
+        expected = [self.metrics(), load_summaries(self.conn), load_latest(self.conn, 'a'),
+                    self.conn.execute('select * from device_latest ORDER BY device_uuid, type').fetchall()]
+        # Leaving the last days in the readings table
+        archive_partitions(self.conn, 'test_database.db', 6 * DAY, window=2 * DAY)
+
+        rebuild_summaries(self.conn)
+        rebuild_latest(self.conn)
+        rebuild_rollups(self.conn)
+
+        self.assertEqual([self.metrics(), load_summaries(self.conn), load_latest(self.conn, 'a'),
+                          self.conn.execute('select * from device_latest ORDER BY device_uuid, type').fetchall()],
+                         expected)
@@ -0,0 +1,70 @@
+import json
+import random
+import sqlite3
+import unittest
+
+from db import ConnectionPool
+from readings import build_listing_sql, decode_cursor, encode_cursor, query_page, stream_readings
+from schema import drop_schema, migrate
+from utils import QueryFilters
+
+
+class ReadingListingTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(0)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (rng.choice(['a', 'b']), rng.choice(['temperature', 'humidity']), rng.randint(0, 100), rng.randint(0, 50))
+            for _ in range(500)
+        ])
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def all_readings(self, filters):
+        sql, params = build_listing_sql('a', filters)
+        return [dict(zip(('device_uuid', 'type', 'value', 'date_created'), row[1:]))
+                for row in self.conn.execute(sql, params)]
+
+    def test_cursor_round_trips(self):
+        self.assertEqual(decode_cursor(encode_cursor(-5, 12)), (-5, 12))
+        for token in ('', 'not a cursor', encode_cursor('x', 1)):
+            with self.assertRaises(ValueError):
+                decode_cursor(token)
+
+    def test_pages_list_every_reading_once_in_date_order(self):
+        for filters in (QueryFilters(None, None, None), QueryFilters(10, 40, 'humidity')):
+            readings = []
+            after = None
+            while True:
+                page, next_cursor = query_page(self.conn, 'a', filters, 7, after)
+                readings.extend(page)
+                if next_cursor is None:
+                    break
+                after = decode_cursor(next_cursor)
+
+            self.assertEqual(readings, self.all_readings(filters))
+            self.assertEqual([r['date_created'] for r in readings], sorted(r['date_created'] for r in readings))
+
+    def test_pages_do_not_sort_the_whole_device(self):
+        for filters in (QueryFilters(None, None, None), QueryFilters(10, None, 'humidity')):
+            sql, params = build_listing_sql('a', filters, after=(3, 4), limit=10)
+            plan = ' '.join(row[-1] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_streams_match_the_listing(self):
+        pool = ConnectionPool('test_database.db', size=1)
+        filters = QueryFilters(None, 30, None)
+        expected = self.all_readings(filters)
+
+        self.assertEqual(json.loads(''.join(stream_readings(pool, 'a', filters))), expected)
+        lines = ''.join(stream_readings(pool, 'a', filters, ndjson=True)).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+        self.assertEqual(json.loads(''.join(stream_readings(pool, 'c', filters))), [])
+        self.assertEqual(pool.stats()['in_use'], 0)
+        pool.close()
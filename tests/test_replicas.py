@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import threading
+import unittest
+
+from app import app
+from cache import get_cache
+from db import ConnectionPool, get_pools
+from replicas import get_read_pools, refresh_replica, refresh_replicas, replica_path
+from schema import drop_schema, migrate
+
+
+class ReplicaTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        self.insert([('a', 'temperature', 10, 1), ('b', 'temperature', 20, 2)])
+        self.replica = replica_path('test_database.db')
+        app.config['TESTING'] = True
+        get_cache(app).clear()
+
+    def tearDown(self):
+        self.conn.close()
+        app.config['READ_REPLICAS'] = False
+        if os.path.exists(self.replica):
+            os.remove(self.replica)
+
+    def insert(self, rows):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        self.conn.commit()
+
+    def count(self, pool):
+        with pool.connection() as conn:
+            return conn.execute('select COUNT(*) from readings').fetchone()[0]
+
+    def test_replica_path(self):
+        self.assertEqual(replica_path('database.db'), 'database.replica.db')
+        self.assertEqual(replica_path('data/database-1.db'), 'data/database-1.replica.db')
+
+    def test_pool_reads_the_latest_snapshot(self):
+        refresh_replica('test_database.db', self.replica)
+        pool = ConnectionPool(self.replica, size=1, read_only=True)
+        try:
+            self.assertEqual(self.count(pool), 2)
+            with self.assertRaises(sqlite3.OperationalError):
+                with pool.connection() as conn:
+                    conn.execute('DELETE FROM readings')
+
+            # Given a reading the replica does not have yet, it only shows up after a refresh
+            self.insert([('c', 'temperature', 30, 3)])
+            self.assertEqual(self.count(pool), 2)
+            refresh_replica('test_database.db', self.replica)
+            self.assertEqual(self.count(pool), 3)
+            self.assertEqual(pool.stats()['open'], 1)
+        finally:
+            pool.close()
+
+    def test_copy_restarted_by_inserts_finishes_in_one_step(self):
+        # As the app's pools open it
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.insert([('a', 'temperature', 1, date) for date in range(3, 5000)])
+        self.assertFalse(refresh_replica('test_database.db', self.replica, pages=8, sleep=0))
+
+        stop = threading.Event()
+
+        def keep_inserting():
+            conn = sqlite3.connect('test_database.db')
+            while not stop.is_set():
+                with conn:
+                    conn.execute("insert into readings (device_uuid,type,value,date_created) VALUES ('b','humidity',1,0)")
+                stop.wait(0.002)
+            conn.close()
+
+        inserter = threading.Thread(target=keep_inserting)
+        inserter.start()
+        try:
+            self.assertTrue(refresh_replica('test_database.db', self.replica, pages=1, sleep=0.01, restarts=1))
+        finally:
+            stop.set()
+            inserter.join()
+        replica = sqlite3.connect(self.replica)
+        self.assertEqual(replica.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+        replica.close()
+
+    def test_unchanged_shards_are_skipped(self):
+        versions = {}
+        try:
+            self.assertEqual(refresh_replicas(app, versions), 1)
+            self.assertEqual(refresh_replicas(app, versions), 0)
+            self.insert([('c', 'temperature', 30, 3)])
+            self.assertEqual(refresh_replicas(app, versions), 1)
+        finally:
+            for conn, _ in versions.values():
+                conn.close()
+
+    def test_read_pools_fall_back_to_the_primary(self):
+        self.assertEqual(get_read_pools(app), get_pools(app))
+
+        app.config['READ_REPLICAS'] = True
+        # Not refreshed yet
+        self.assertEqual(get_read_pools(app), get_pools(app))
+
+        refresh_replicas(app)
+        pools = get_read_pools(app)
+        self.assertEqual([pool.database for pool in pools], [self.replica])
+        self.assertTrue(pools[0].read_only)
+
+    def test_summaries_read_the_replica(self):
+        app.config['READ_REPLICAS'] = True
+        refresh_replicas(app)
+        self.insert([('c', 'temperature', 30, 3)])
+
+        request = app.test_client().get('/devices/summaries/')
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(sorted(x['device_uuid'] for x in request.json), ['a', 'b'])
+
+    def test_cached_answers_last_no_longer_than_the_replica(self):
+        app.config['READ_REPLICAS'] = True
+        refresh_replicas(app)
+        client = app.test_client()
+        self.assertEqual(len(client.get('/devices/summaries/').json), 2)
+        self.insert([('c', 'temperature', 30, 3)])
+
+        refresh_replicas(app)
+
+        self.assertEqual(sorted(x['device_uuid'] for x in client.get('/devices/summaries/').json), ['a', 'b', 'c'])
@@ -0,0 +1,117 @@
+import random
+import sqlite3
+import unittest
+
+from histogram import query_histogram
+from rollups import plan_range, range_histogram, range_totals, rebuild_rollups
+from schema import drop_schema, migrate, roll_up
+from utils import QueryFilters
+
+
+class PlanRangeTestCases(unittest.TestCase):
+
+    def covered(self, segments, low, high):
+        seconds = []
+        for granularity, start, end in segments:
+            start = low if start is None else start
+            end = high if end is None else end
+            if granularity is None:
+                seconds.extend(range(start, end + 1))
+            else:
+                for bucket in range(start - start % granularity, end + 1, granularity):
+                    self.assertGreaterEqual(bucket, start)
+                    seconds.extend(range(bucket, bucket + granularity))
+        return seconds
+
+    def test_segments_cover_the_range_exactly_once(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            start = rng.randint(-500, 500)
+            end = start + rng.randint(-5, 700)
+            seconds = self.covered(plan_range(start, end, (100, 10)), start, end)
+
+            self.assertEqual(sorted(seconds), list(range(start, end + 1)))
+
+    def test_unbounded_ranges_only_have_one_raw_edge(self):
+        self.assertEqual(plan_range(None, 125, (100, 10)), [(100, None, 99), (10, 100, 119), (None, 120, 125)])
+        self.assertEqual(plan_range(5, None, (100, 10)), [(None, 5, 9), (10, 10, 99), (100, 100, None)])
+        self.assertEqual(plan_range(None, None, (100, 10)), [(100, None, None)])
+
+    def test_a_year_is_a_few_hundred_buckets(self):
+        segments = plan_range(1000017, 1000017 + 365 * 86400)
+
+        self.assertEqual(len(segments), 7)
+        self.assertEqual([g for g, _, _ in segments], [None, 60, 3600, 86400, 3600, 60, None])
+
+
+class RollupQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(1)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (rng.choice(['a', 'b']), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+             rng.randint(-86400, 3 * 86400))
+            for _ in range(3000)
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def assert_matches_raw_readings(self):
+        rng = random.Random(2)
+        ranges = [(None, None), (None, 100000), (-3000, None)]
+        ranges += [sorted((rng.randint(-90000, 270000), rng.randint(-90000, 270000))) for _ in range(30)]
+        for start, end in ranges:
+            filters = QueryFilters(start, end, rng.choice([None, 'temperature', 'humidity']))
+            raw = query_histogram(self.conn, 'a', filters)
+            rolled = range_histogram(self.conn, 'a', filters)
+
+            self.assertEqual(rolled.counts, raw.counts)
+            if raw.count:
+                self.assertEqual(rolled.mode(), raw.mode())
+            self.assertEqual(range_totals(self.conn, 'a', filters), (raw.count, raw.total, raw.max, raw.min))
+
+    def test_rollups_match_raw_readings(self):
+        self.assert_matches_raw_readings()
+
+    def test_rebuild_matches_roll_up(self):
+        before = self.conn.execute('select * from readings_rollup_histograms').fetchall()
+
+        rebuild_rollups(self.conn)
+
+        self.assertEqual(self.conn.execute('select * from readings_rollup_histograms').fetchall(), before)
+        self.assert_matches_raw_readings()
+
+    def test_roll_up_only_adds_new_readings(self):
+        rng = random.Random(3)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            ('a', rng.choice(['temperature', 'humidity']), rng.randint(0, 100), rng.randint(-86400, 3 * 86400))
+            for _ in range(500)
+        ])
+        roll_up(self.conn)
+        # Nothing new to add
+        roll_up(self.conn)
+        self.conn.commit()
+        rolled = self.conn.execute('select * from readings_rollup_histograms').fetchall()
+
+        rebuild_rollups(self.conn)
+
+        self.assertEqual(self.conn.execute('select * from readings_rollup_histograms').fetchall(), rolled)
+        self.assert_matches_raw_readings()
+
+    def test_migrate_replaces_the_trigger(self):
+        # Given a database whose rollups an older version kept with a trigger
+        self.conn.execute('DROP TABLE rollup_position')
+        self.conn.execute('CREATE TRIGGER readings_rollup AFTER INSERT ON readings BEGIN SELECT 1; END')
+        self.conn.commit()
+
+        migrate(self.conn)
+
+        self.assertEqual(self.conn.execute("select COUNT(*) from sqlite_master where type = 'trigger' "
+                                           "AND name = 'readings_rollup'").fetchone()[0], 0)
+        self.assertEqual(self.conn.execute('select last_rowid from rollup_position').fetchall(), [(3000,)])
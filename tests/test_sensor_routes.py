@@ -6,6 +6,10 @@ import unittest
 import statistics
 
 from app import app
+from cache import get_cache, sync_cache
+from frames import FRAME_MIMETYPE, RECORD, encode_frame
+from ingest import get_writer
+from schema import drop_schema, migrate, roll_up
 
 
 class SensorRoutesTestCases(unittest.TestCase):
@@ -13,9 +17,8 @@ class SensorRoutesTestCases(unittest.TestCase):
     def setUp(self):
         # Setup the SQLite DB
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute(
-            'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        drop_schema(conn)
+        migrate(conn)
 
         self.device_uuid = 'test_device'
 
@@ -37,9 +40,12 @@ class SensorRoutesTestCases(unittest.TestCase):
                     ('other_uuid', 'temperature', 22, int(self.setup_time)))
         cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
                     ('other_uuid', 'temperature', 30, int(self.setup_time)))
+        roll_up(conn)
         conn.commit()
 
         app.config['TESTING'] = True
+        # The readings above were written behind the cache's back
+        get_cache(app).clear()
 
         self.client = app.test_client
 
@@ -260,3 +266,311 @@ class SensorRoutesTestCases(unittest.TestCase):
         # We should have four (no new one)
         self.assertEqual(len(rows), 4)
 
+
+    def test_device_readings_bulk_post(self):
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+        json.dumps([
+            {'type': 'temperature', 'value': 10, 'date_created': int(self.setup_time) + 10},
+            {'type': 'flavor', 'value': 10},
+            {'type': 'humidity', 'value': 40}
+        ]))
+
+        # Then the good readings are stored and the bad one is reported by index
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(request.json['inserted'], 2)
+        self.assertEqual(request.json['errors'], [
+            {'index': 1, 'errors': ["The only allowed sensor types are 'temperature' and 'humidity'"]}
+        ])
+
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        self.assertEqual(len(request.json), 6)
+
+    def test_device_readings_bulk_post_ndjson(self):
+        body = '\n'.join(json.dumps({'type': 'temperature', 'value': v}) for v in (1, 2, 3))
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body,
+                                     content_type='application/x-ndjson')
+
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(request.json, {'inserted': 3, 'errors': []})
+
+    def test_device_readings_bulk_post_ndjson_malformed_line(self):
+        body = '\n'.join([json.dumps({'type': 'temperature', 'value': 1}), '{"type": ', json.dumps({'value': 2})])
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body,
+                                     content_type='application/x-ndjson')
+
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(request.json['inserted'], 1)
+        self.assertEqual([error['index'] for error in request.json['errors']], [1, 2])
+        self.assertIn('not valid JSON', request.json['errors'][0]['errors'][0])
+
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data='{"type": ')
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_bulk_post_frame(self):
+        body = encode_frame([(int(self.setup_time) + 10, 'temperature', 10), (int(self.setup_time) + 20, 'humidity', 40)])
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body,
+                                     content_type=FRAME_MIMETYPE)
+
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(request.json, {'inserted': 2, 'errors': []})
+
+        request = self.client().get('/devices/{}/readings/?type=humidity'.format(self.device_uuid))
+        self.assertEqual(sorted(r['value'] for r in request.json), [40, 73])
+
+    def test_device_readings_bulk_post_frame_errors(self):
+        body = encode_frame([(int(self.setup_time), 'temperature', 10)], header=False) + RECORD.pack(1, 5, 10)
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body,
+                                     content_type=FRAME_MIMETYPE)
+
+        self.assertEqual(request.status_code, 207)
+        self.assertEqual(request.json['inserted'], 1)
+        self.assertEqual([e['index'] for e in request.json['errors']], [1])
+
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body[:-3],
+                                     content_type=FRAME_MIMETYPE)
+        self.assertEqual(request.status_code, 400)
+
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=b'\x00\x00',
+                                     content_type=FRAME_MIMETYPE)
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_bulk_post_all_invalid(self):
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+        json.dumps([{'type': 'temperature', 'value': 200}, 'not a reading']))
+
+        self.assertEqual(request.status_code, 400)
+        self.assertEqual(request.json['inserted'], 0)
+        self.assertEqual([e['index'] for e in request.json['errors']], [0, 1])
+
+    def test_device_readings_latest(self):
+        request = self.client().get('/devices/{}/readings/latest/'.format(self.device_uuid))
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json['last_reported'], int(self.setup_time + 50))
+        self.assertEqual(request.json['readings']['temperature'], {'value': 100, 'date_created': int(self.setup_time)})
+
+        # A late reading is stored but is not the latest one
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+            {'type': 'temperature', 'value': 5, 'date_created': int(self.setup_time) - 1000}))
+        request = self.client().get('/devices/{}/readings/latest/?type=temperature'.format(self.device_uuid))
+        self.assertEqual(request.json['readings'], {'temperature': {'value': 100, 'date_created': int(self.setup_time)}})
+
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+            {'type': 'temperature', 'value': 7, 'date_created': int(self.setup_time) + 10}))
+        request = self.client().get('/devices/{}/readings/latest/?type=temperature'.format(self.device_uuid))
+        self.assertEqual(request.json['readings']['temperature']['value'], 7)
+
+    def test_silent_devices(self):
+        self.client().post('/devices/old_device/readings/', data=json.dumps(
+            {'type': 'humidity', 'value': 5, 'date_created': int(self.setup_time) - 1000}))
+        request = self.client().get('/devices/silent/?seconds=100')
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual([d['device_uuid'] for d in request.json], ['old_device'])
+        self.assertGreaterEqual(request.json[0]['silent_for'], 1000)
+
+        request = self.client().get('/devices/silent/?seconds=100&type=temperature')
+        self.assertEqual(request.json, [])
+
+        self.assertEqual(self.client().get('/devices/silent/').status_code, 400)
+
+    def test_device_readings_get_is_not_injectable(self):
+        request = self.client().get('/devices/{}/readings/'.format('x" OR "1"="1'))
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json, [])
+
+    def test_device_readings_get_invalid_start(self):
+        request = self.client().get('/devices/{}/readings/max/?start=yesterday'.format(self.device_uuid))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_summary_results_match_raw_readings(self):
+        # The unfiltered summary comes from the aggregate tables, a date filter forces the raw readings
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+        json.dumps({'type': 'humidity', 'value': 12}))
+
+        from_store = self.client().get('/devices/summaries/').json
+        from_readings = self.client().get('/devices/summaries/?start=1').json
+
+        self.assertEqual(sorted(from_store, key=lambda x: x['device_uuid']),
+                         sorted(from_readings, key=lambda x: x['device_uuid']))
+        self.assertEqual(len(from_store), 2)
+        self.assertIn(5, [summary['number_of_readings'] for summary in from_store])
+
+    def test_invalid_date_post(self):
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+        json.dumps({
+            'type': 'temperature',
+            'value': 50,
+            'date_created': 'yesterday'
+        }))
+
+        self.assertEqual(request.status_code, 400)
+        self.assertIn("The date_created field must be an integer epoch time", str(request.data))
+
+        # Too big for SQLite to store
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid),
+                                     data=json.dumps({'type': 'temperature', 'value': 50, 'date_created': 10 ** 30}))
+        self.assertEqual(request.status_code, 400)
+        request = self.client().get('/devices/{}/readings/max/?start={}'.format(self.device_uuid, 10 ** 30))
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_series(self):
+        request = self.client().get(f'/devices/{self.device_uuid}/readings/series/?type=temperature&points=2'
+                                    f'&start={int(self.setup_time) - 100}&end={int(self.setup_time) - 1}')
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json['bucket'], 50)
+        self.assertEqual([(b['count'], b['min'], b['max'], b['mean']) for b in request.json['series']],
+                         [(1, 22, 22, 22), (1, 50, 50, 50)])
+
+    def test_device_readings_series_without_range(self):
+        request = self.client().get(f'/devices/{self.device_uuid}/readings/series/?bucket=1000000000')
+
+        self.assertEqual(len(request.json['series']), 1)
+        self.assertEqual(request.json['series'][0]['count'], 4)
+
+    def test_device_readings_series_needs_bucket_or_points(self):
+        for query in ('', '?bucket=60&points=10', '?bucket=0', '?points=many', '?points=1000000', '?bucket=1&start=0'):
+            request = self.client().get(f'/devices/{self.device_uuid}/readings/series/{query}')
+
+            self.assertEqual(request.status_code, 400, query)
+
+    def test_device_readings_get_pages(self):
+        request = self.client().get('/devices/{}/readings/?limit=3'.format(self.device_uuid))
+
+        self.assertEqual([r['value'] for r in request.json], [22, 50, 100])
+        cursor = request.headers['X-Next-Cursor']
+
+        request = self.client().get('/devices/{}/readings/?limit=3&cursor={}'.format(self.device_uuid, cursor))
+
+        self.assertEqual([r['value'] for r in request.json], [73])
+        self.assertNotIn('X-Next-Cursor', request.headers)
+
+    def test_device_readings_get_invalid_cursor(self):
+        request = self.client().get('/devices/{}/readings/?limit=3&cursor=nope'.format(self.device_uuid))
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_get_streamed(self):
+        request = self.client().get('/devices/{}/readings/?stream=ndjson&type=temperature'.format(self.device_uuid))
+
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['value'] for line in request.data.splitlines()], [22, 50, 100])
+
+        request = self.client().get('/devices/{}/readings/?stream=json'.format(self.device_uuid))
+
+        self.assertEqual(len(request.json), 4)
+
+    def test_device_readings_stats(self):
+        request = self.client().get('/devices/{}/readings/stats/'.format(self.device_uuid))
+
+        self.assertEqual(request.json, {
+            'count': 4, 'max': 100, 'min': 22, 'mean': 61, 'median': 61, 'mode': 22, 'q1': 29, 'q3': 93
+        })
+
+        request = self.client().get('/devices/{}/readings/stats/?metrics=max,q3&type=humidity'.format(self.device_uuid))
+
+        self.assertEqual(request.json, {'max': 73, 'q3': None})
+
+    def test_device_readings_stats_unknown_metric(self):
+        request = self.client().get('/devices/{}/readings/stats/?metrics=max,p99'.format(self.device_uuid))
+
+        self.assertEqual(request.status_code, 400)
+        self.assertIn('p99', str(request.data))
+
+    def test_summary_results_top_devices(self):
+        request = self.client().get('/devices/summaries/?limit=1')
+
+        self.assertEqual([x['device_uuid'] for x in request.json], [self.device_uuid])
+
+        request = self.client().get('/devices/summaries/?limit=1&offset=1&start=1')
+
+        self.assertEqual([x['device_uuid'] for x in request.json], ['other_uuid'])
+
+        request = self.client().get('/devices/summaries/?offset=-1')
+
+        self.assertEqual(request.status_code, 400)
+
+    def test_metrics_are_cached_until_a_reading_lands_in_range(self):
+        url = '/devices/{}/readings/min/?end={}'.format(self.device_uuid, int(self.setup_time))
+        before = get_cache(app).stats()
+        first = self.client().get(url)
+        self.client().get(url)
+
+        stats = get_cache(app).stats()
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (1, 1))
+
+        # A reading after the range leaves the cached answer alone
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+            {'type': 'temperature', 'value': 1, 'date_created': int(self.setup_time) + 1000}))
+        request = self.client().get(url, headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(request.status_code, 304)
+        self.assertEqual(request.data, b'')
+
+        # One inside it drops it
+        self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+            {'type': 'temperature', 'value': 1, 'date_created': int(self.setup_time) - 1000}))
+        request = self.client().get(url, headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json['value'], 1)
+        self.assertEqual(get_cache(app).stats()['invalidations'] - before['invalidations'], 1)
+
+    def test_cache_sees_readings_committed_by_other_processes(self):
+        url = '/devices/{}/readings/min/'.format(self.device_uuid)
+        first = self.client().get(url)
+
+        # Given another worker inserts a reading, which this process's cache never hears of
+        conn = sqlite3.connect('test_database.db')
+        with conn:
+            conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         (self.device_uuid, 'temperature', 0, int(self.setup_time)))
+            roll_up(conn)
+        conn.close()
+        # As the background thread does every RESPONSE_CACHE_SYNC_SECONDS
+        sync_cache(app, get_cache(app))
+        request = self.client().get(url, headers={'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.json['value'], 0)
+
+    def test_summaries_are_invalidated_by_any_device(self):
+        self.client().get('/devices/summaries/')
+        self.client().post('/devices/{}/readings/'.format('new_uuid'), data=json.dumps(
+            {'type': 'humidity', 'value': 5}))
+
+        request = self.client().get('/devices/summaries/')
+
+        self.assertIn('new_uuid', [summary['device_uuid'] for summary in request.json])
+
+    def test_device_readings_post_async(self):
+        app.config['INGEST_ASYNC'] = True
+        try:
+            request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps([
+                {'type': 'temperature', 'value': 10}, {'type': 'humidity', 'value': 11}
+            ]))
+        finally:
+            app.config['INGEST_ASYNC'] = False
+
+        self.assertEqual(request.status_code, 202)
+        self.assertEqual(request.json, {'accepted': 2, 'errors': []})
+        # Any later synchronous write is committed after the queued ones
+        get_writer(app, self.device_uuid).write([(self.device_uuid, 'humidity', 1, 1)])
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid))
+        self.assertEqual(len(request.json), 7)
+
+    def test_device_readings_post_queue_full(self):
+        writer = get_writer(app, self.device_uuid)
+        writer.max_pending, max_pending = 0, writer.max_pending
+        try:
+            request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+                {'type': 'temperature', 'value': 10}))
+        finally:
+            writer.max_pending = max_pending
+
+        self.assertEqual(request.status_code, 503)
+        self.assertEqual(request.headers['Retry-After'], '1')
+        self.assertEqual(self.client().get('/stats/ingest/').json[0]['pending_rows'], 0)
@@ -0,0 +1,74 @@
+import random
+import sqlite3
+import unittest
+
+from series import query_series, series_layout
+from schema import drop_schema, migrate, roll_up
+from utils import QueryFilters
+
+
+class SeriesLayoutTestCases(unittest.TestCase):
+
+    def test_fixed_buckets_are_aligned_on_their_width(self):
+        self.assertEqual(series_layout(125, 1000, bucket=60), (120, 60))
+        self.assertEqual(series_layout(-5, 1000, bucket=60), (-60, 60))
+
+    def test_points_never_give_more_buckets(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            start = rng.randint(-10 ** 6, 10 ** 6)
+            end = start + rng.randint(0, 10 ** 7)
+            points = rng.randint(1, 2000)
+            origin, width = series_layout(start, end, points=points)
+
+            self.assertEqual(origin, start)
+            self.assertLessEqual((end - origin) // width + 1, points)
+
+    def test_wide_points_are_rounded_to_rollup_buckets(self):
+        self.assertEqual(series_layout(0, 30 * 86400 - 1, points=100), (0, 28800))
+        self.assertEqual(series_layout(0, 999, points=100), (0, 10))
+
+
+class SeriesQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        rng = random.Random(1)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (rng.choice(['a', 'b']), rng.choice(['temperature', 'humidity']), rng.randint(0, 100),
+             rng.randint(-86400, 3 * 86400))
+            for _ in range(3000)
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def raw_series(self, filters, origin, width):
+        buckets = {}
+        for value, date_created in self.conn.execute(
+                'select value, date_created from readings where device_uuid = ? AND date_created BETWEEN ? AND ? '
+                'AND (? IS NULL OR type = ?)',
+                ('a', filters.start, filters.end, filters.sensor_type, filters.sensor_type)):
+            buckets.setdefault(origin + (date_created - origin) // width * width, []).append(value)
+        return [(start, len(values), sum(values), max(values), min(values))
+                for start, values in sorted(buckets.items())]
+
+    def test_series_match_raw_readings(self):
+        rng = random.Random(2)
+        layouts = [dict(bucket=60), dict(bucket=3600), dict(bucket=7200), dict(bucket=86400), dict(bucket=97),
+                   dict(points=1), dict(points=50), dict(points=500)]
+        for _ in range(40):
+            start, end = sorted((rng.randint(-90000, 270000), rng.randint(-90000, 270000)))
+            if rng.random() < 0.3:
+                # Ranges on whole hours are served from the rollups
+                start -= start % 3600
+                end -= end % 3600
+            filters = QueryFilters(start, end, rng.choice([None, 'temperature', 'humidity']))
+            origin, width = series_layout(start, end, **rng.choice(layouts))
+
+            self.assertEqual(query_series(self.conn, 'a', filters, origin, width),
+                             self.raw_series(filters, origin, width))
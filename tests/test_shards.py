@@ -0,0 +1,118 @@
+import json
+import sqlite3
+import unittest
+
+from app import app
+from cache import get_cache
+from db import get_shard_paths
+from schema import drop_schema, migrate, roll_up
+from shards import reshard, shard_index, shard_paths
+from summaries import load_summaries
+
+DEVICES = ['device-{}'.format(i) for i in range(12)]
+
+
+def readings_in(path):
+    conn = sqlite3.connect(path)
+    rows = conn.execute('select device_uuid, type, value, date_created from readings ORDER BY rowid').fetchall()
+    conn.close()
+    return rows
+
+
+class ShardTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = shard_paths('test_database.db', 3)
+        for path in ['test_database.db'] + self.paths:
+            conn = sqlite3.connect(path)
+            drop_schema(conn)
+            migrate(conn)
+            conn.close()
+
+    def tearDown(self):
+        app.config['DATABASE_SHARDS'] = 1
+
+    def test_shard_paths(self):
+        self.assertEqual(shard_paths('database.db', 1), ['database.db'])
+        self.assertEqual(shard_paths('database.db', 2), ['database-0.db', 'database-1.db'])
+
+    def test_devices_spread_over_every_shard(self):
+        shards = [shard_index(device_uuid, 3) for device_uuid in DEVICES]
+
+        self.assertEqual(shards, [shard_index(device_uuid, 3) for device_uuid in DEVICES])
+        self.assertEqual(set(shards), {0, 1, 2})
+
+    def test_reshard_moves_devices_with_their_aggregates(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            (device_uuid, 'temperature', (i * 7 + j) % 101, 1000 + j) for i, device_uuid in enumerate(DEVICES)
+            for j in range(5)
+        ])
+        conn.commit()
+        expected = load_summaries(conn)
+        conn.close()
+
+        self.assertEqual(reshard(['test_database.db'], self.paths), len(DEVICES))
+
+        self.assertEqual(readings_in('test_database.db'), [])
+        summaries = []
+        for index, path in enumerate(self.paths):
+            self.assertTrue(all(shard_index(row[0], 3) == index for row in readings_in(path)))
+            conn = sqlite3.connect(path)
+            summaries.extend(load_summaries(conn))
+            conn.close()
+        self.assertEqual(sorted(summaries, key=lambda x: x['device_uuid']),
+                         sorted(expected, key=lambda x: x['device_uuid']))
+
+        # And back into one file
+        self.assertEqual(reshard(self.paths, ['test_database.db']), len(DEVICES))
+        conn = sqlite3.connect('test_database.db')
+        self.assertEqual(load_summaries(conn), expected)
+        conn.close()
+
+    def test_reshard_after_a_copy_committed_to_the_target_only(self):
+        rows = [(device_uuid, 'temperature', i + j, 1000 + j) for i, device_uuid in enumerate(DEVICES)
+                for j in range(5)]
+        conn = sqlite3.connect('test_database.db')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', rows)
+        conn.commit()
+        expected = load_summaries(conn)
+        conn.close()
+        # Given a crash left the first device copied but still in the old shard
+        target = sqlite3.connect(self.paths[shard_index(DEVICES[0], 3)])
+        target.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                           [row for row in rows if row[0] == DEVICES[0]])
+        roll_up(target)
+        target.commit()
+        target.close()
+
+        self.assertEqual(reshard(['test_database.db'], self.paths), len(DEVICES))
+
+        self.assertEqual(sorted(row for path in self.paths for row in readings_in(path)), sorted(rows))
+        summaries = []
+        for path in self.paths:
+            conn = sqlite3.connect(path)
+            summaries.extend(load_summaries(conn))
+            conn.close()
+        self.assertEqual(sorted(summaries, key=lambda x: x['device_uuid']),
+                         sorted(expected, key=lambda x: x['device_uuid']))
+
+    def test_requests_are_routed_to_the_device_shard(self):
+        app.config['TESTING'] = True
+        app.config['DATABASE_SHARDS'] = 3
+        get_cache(app).clear()
+        client = app.test_client()
+        self.assertEqual(get_shard_paths(app), self.paths)
+
+        for i, device_uuid in enumerate(DEVICES):
+            client.post('/devices/{}/readings/'.format(device_uuid), data=json.dumps(
+                [{'type': 'humidity', 'value': v, 'date_created': 1000 + v} for v in range(i + 1)]))
+
+        for index, path in enumerate(self.paths):
+            self.assertTrue(readings_in(path))
+            self.assertTrue(all(shard_index(row[0], 3) == index for row in readings_in(path)))
+        self.assertEqual(client.get('/devices/device-4/readings/max/').json['value'], 4)
+        summaries = client.get('/devices/summaries/?limit=3&offset=1').json
+        self.assertEqual([x['device_uuid'] for x in summaries], ['device-10', 'device-9', 'device-8'])
+        self.assertEqual(client.get('/devices/summaries/?start=1').json, client.get('/devices/summaries/').json)
+        self.assertEqual(len(client.get('/stats/pool/').json), 3)
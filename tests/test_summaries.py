@@ -0,0 +1,77 @@
+import sqlite3
+import unittest
+
+from app import app
+from schema import drop_schema, migrate, roll_up
+from summaries import load_summaries, query_summaries, rebuild_summaries
+from utils import QueryFilters
+
+
+class SummaryStoreTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        drop_schema(self.conn)
+        migrate(self.conn)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            ('a', 'temperature', 10, 1), ('a', 'temperature', 20, 2), ('a', 'humidity', 90, 3),
+            ('b', 'humidity', 40, 4),
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+        app.config['TESTING'] = True
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_trigger_maintains_aggregates(self):
+        rows = self.conn.execute('select * from device_summaries ORDER BY device_uuid, type').fetchall()
+
+        self.assertEqual(rows, [('a', 'humidity', 1, 90, 90, 90), ('a', 'temperature', 2, 30, 20, 10),
+                                ('b', 'humidity', 1, 40, 40, 40)])
+        self.assertEqual(load_summaries(self.conn, 'temperature'), [{
+            'device_uuid': 'a',
+            'number_of_readings': 2,
+            'max_reading_value': 20,
+            'median_reading_value': 15,
+            'mean_reading_value': 15,
+            'quartile_1_value': 7,
+            'quartile_3_value': 22
+        }])
+
+    def test_rebuild_backfills_aggregates(self):
+        expected = load_summaries(self.conn)
+        self.conn.execute('DELETE FROM device_summaries')
+        self.conn.execute('DELETE FROM device_histograms')
+        self.conn.commit()
+        self.assertEqual(load_summaries(self.conn), [])
+
+        rebuild_summaries(self.conn)
+
+        self.assertEqual(load_summaries(self.conn), expected)
+
+    def test_rebuild_command(self):
+        self.conn.execute('DELETE FROM device_histograms')
+        self.conn.commit()
+
+        result = app.test_cli_runner().invoke(args=['rebuild-summaries'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual([x['device_uuid'] for x in load_summaries(self.conn)], ['a', 'b'])
+
+    def test_summaries_are_ranked_and_paged(self):
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)', [
+            ('c', 'humidity', 5, 5), ('c', 'humidity', 6, 6), ('c', 'humidity', 7, 7), ('c', 'humidity', 8, 8),
+        ])
+        roll_up(self.conn)
+        self.conn.commit()
+        everything = QueryFilters(0, None, None)
+
+        self.assertEqual([x['device_uuid'] for x in load_summaries(self.conn)], ['c', 'a', 'b'])
+        self.assertEqual(load_summaries(self.conn), query_summaries(self.conn, everything))
+        for limit, offset in ((1, 0), (2, 1), (None, 2), (5, 3)):
+            page = load_summaries(self.conn, limit=limit, offset=offset)
+
+            self.assertEqual(page, load_summaries(self.conn)[offset:None if limit is None else offset + limit])
+            self.assertEqual(page, query_summaries(self.conn, everything, limit, offset))
+        self.assertEqual([x['device_uuid'] for x in load_summaries(self.conn, 'humidity', limit=2)], ['c', 'a'])
@@ -0,0 +1,33 @@
+import sqlite3
+import unittest
+
+from schema import migrate
+from utils import QueryFilters, build_sql
+
+
+class QueryBuilderTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect('test_database.db')
+        self.conn.execute('DROP TABLE IF EXISTS readings')
+        migrate(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_statement_does_not_depend_on_values(self):
+        selection = 'select value from readings where device_uuid = ? '
+        first_sql, first_params = build_sql(selection, QueryFilters(10, 20, 'humidity'), ['a'])
+        second_sql, second_params = build_sql(selection, QueryFilters(30, 40, 'temperature'), ['b'])
+
+        self.assertEqual(first_sql, second_sql)
+        self.assertEqual(first_params, ['a', 'humidity', 10, 20])
+        self.assertEqual(second_params, ['b', 'temperature', 30, 40])
+
+    def test_range_queries_use_the_covering_index(self):
+        for filters in (QueryFilters(10, 20, 'humidity'), QueryFilters(10, None, None), QueryFilters(None, None, None)):
+            sql, params = build_sql('select value from readings where device_uuid = ? ', filters, ['a'])
+            plan = ' '.join(row[-1] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+
+            self.assertIn('USING COVERING INDEX readings_device_type_date', plan)
+            self.assertNotIn('SCAN', plan)
@@ -1,6 +1,20 @@
-import sqlite3
+import time
+from collections import namedtuple
 from functools import wraps
 
+from flask import abort
+
+from db import get_pool
+from metrics import record_phase, timed
+
+SENSOR_TYPES = ('temperature', 'humidity')
+
+# SQLite INTEGER range, anything outside it cannot be stored
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+QueryFilters = namedtuple('QueryFilters', ['start', 'end', 'sensor_type'])
+
 
 def validate_type_field(string):
     """
@@ -10,7 +24,7 @@ def validate_type_field(string):
     :return: (bool, str)
     """
     if isinstance(string, str):
-        if string.lower() in ('temperature', 'humidity'):
+        if string.lower() in SENSOR_TYPES:
             return True, string.lower()
     return False, "The only allowed sensor types are 'temperature' and 'humidity'"
 
@@ -28,27 +42,139 @@ def validate_value_field(number):
     return False, "The only allowed values are integers between 0 and 100 inclusive"
 
 
-def build_sql_from_get(request, selection):
-    # from IPython import embed
-    # embed()
+def validate_date_field(number):
+    """
+    Returns True and input if it is an integer epoch time SQLite can store
+    False and error otherwise
+    :param number: number to be validated
+    :return: (bool, Union[str, int])
+    """
+    if isinstance(number, int) and not isinstance(number, bool) and MIN_INTEGER <= number <= MAX_INTEGER:
+        return True, number
+    return False, "The date_created field must be an integer epoch time that fits in 64 bits"
+
+
+def validate_reading(device_uuid, reading):
+    """
+    Returns True and a row ready for insertion if the posted reading is valid
+    False and the list of errors otherwise
+    :param device_uuid: the device the reading belongs to
+    :param reading: dict of posted fields
+    :return: (bool, Union[list, tuple])
+    """
+    if not isinstance(reading, dict):
+        return False, ["Each reading must be a JSON object"]
+
+    validations = {
+        'sensor_type': validate_type_field(reading.get('type')),
+        'value': validate_value_field(reading.get('value')),
+        'date_created': validate_date_field(reading.get('date_created', int(time.time())))
+    }
+    errors = [x[1] for x in validations.values() if not x[0]]
+    if errors:
+        return False, errors
+
+    return True, (device_uuid, validations['sensor_type'][1], validations['value'][1], validations['date_created'][1])
+
+
+def parse_query_filters(request):
+    """
+    Returns the type and start/end filters of a GET request
+    Aborts with a 400 if start or end is not an integer epoch
+    :param request: Flask request
+    :return: QueryFilters
+    """
     get_data = request.values
-    start = get_data.get('start', None)
-    end = get_data.get('end', None)
-    sensor_type = get_data.get('type', None)
-    # Execute the query
+    bounds = {}
+    for name in ('start', 'end'):
+        bound = get_data.get(name, None)
+        if bound:
+            try:
+                bound = int(bound)
+            except ValueError:
+                abort(400, f"'{name}' must be an integer epoch time")
+            if not MIN_INTEGER <= bound <= MAX_INTEGER:
+                abort(400, f"'{name}' must fit in 64 bits")
+        else:
+            bound = None
+        bounds[name] = bound
+    return QueryFilters(bounds['start'], bounds['end'], get_data.get('type', None) or None)
+
+
+def parse_int_parameter(request, name, minimum=1):
+    """
+    Returns an optional integer query parameter of a GET request
+    Aborts with a 400 if it is not an integer or lower than the minimum
+    :param request: Flask request
+    :param name: name of the parameter
+    :param minimum: lowest value allowed
+    :return: Union[int, None]
+    """
+    value = request.values.get(name, None)
+    if not value:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, f"'{name}' must be an integer")
+    if value < minimum:
+        abort(400, f"'{name}' must be at least {minimum}")
+    return value
+
+
+def parse_bool_parameter(request, name):
+    """
+    Returns an optional true/false query parameter of a GET request, false when missing
+    Aborts with a 400 if it is neither
+    :param request: Flask request
+    :param name: name of the parameter
+    :return: bool
+    """
+    value = request.values.get(name, '').lower()
+    if value in ('', 'false', '0'):
+        return False
+    if value in ('true', '1'):
+        return True
+    abort(400, f"'{name}' must be true or false")
+
+
+@timed('build')
+def build_sql(selection, filters, params=(), date_column='date_created'):
+    """
+    Extends a selection ending in a WHERE clause with the filters as bound
+    parameters. The SQL only depends on which filters are set, never on their
+    values, so each endpoint produces a handful of distinct statements that
+    stay in the connection's statement cache.
+    :param selection: SQL up to and including its WHERE conditions
+    :param filters: QueryFilters
+    :param params: parameters already used by the selection
+    :param date_column: column the start/end bounds apply to
+    :return: (str, list)
+    """
     sql = selection
-    if start:
-        sql += f'AND date_created >= {start} '
-    if end:
-        sql += f'AND date_created <= {end} '
-    if sensor_type:
-        sql += f'AND type = "{sensor_type}" '
-    return sql
+    params = list(params)
+    if filters.sensor_type:
+        sql += 'AND type = ? '
+        params.append(filters.sensor_type)
+    else:
+        # Spelling out every type keeps the (device_uuid, type, date_created)
+        # index usable for the date range
+        sql += f'AND type IN ({", ".join("?" * len(SENSOR_TYPES))}) '
+        params.extend(SENSOR_TYPES)
+    if filters.start is not None:
+        sql += f'AND {date_column} >= ? '
+        params.append(filters.start)
+    if filters.end is not None:
+        sql += f'AND {date_column} <= ? '
+        params.append(filters.end)
+    return sql, params
+
 
 def handle_database_connection(app):
     """
-    Decorator that takes the app name and sets up the database connection
-    for a request and then closes it when done.
+    Decorator that takes the app name and checks a pooled database connection
+    to the shard of the request's device out for a request and then returns
+    it to the pool when done.
     :param app:
     :return:
     """
@@ -56,15 +182,15 @@ def handle_database_connection(app):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Set the db that we want and open the connection
-            if app.config['TESTING']:
-                conn = sqlite3.connect('test_database.db')
-            else:
-                conn = sqlite3.connect('database.db')
-            conn.row_factory = sqlite3.Row
-            kwargs['conn'] = conn
-            return_value = func(*args, **kwargs)
-            conn.close()
-            return return_value
+            # Borrow a connection to the db that we want
+            pool = get_pool(app, kwargs.get('device_uuid'))
+            began = time.perf_counter()
+            conn = pool.acquire()
+            record_phase('acquire', time.perf_counter() - began)
+            try:
+                kwargs['conn'] = conn
+                return func(*args, **kwargs)
+            finally:
+                pool.release(conn)
         return wrapper
     return decorator